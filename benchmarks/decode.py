@@ -0,0 +1,149 @@
+"""
+Microbenchmark of the invoice decode path, comparing the old MessageToJson round-trip with the receive path of the
+sessions: the records as LndTransport.subscribe hands them out, decoded by decode_packets. The synthetic invoices carry
+coalesced records of several binary frames, as the coalescer fills them.
+
+Run from the project root, with the compiled lnd protofiles on the path:
+    python -m benchmarks.decode                                 # synthetic invoices
+    python -m benchmarks.decode --record alice 1000 invoices.bin  # record invoices from a node in creds.txt
+    python -m benchmarks.decode --invoices invoices.bin         # replay recorded invoices
+"""
+import argparse
+import base64
+import json
+import secrets
+import struct
+import time
+
+from google.protobuf.json_format import MessageToJson
+
+import lightning_pb2 as ln
+from helpers import packet as framing
+from helpers.session import connect_node, load_credentials
+from helpers.transport import LndTransport
+
+LENGTH = struct.Struct('!I')
+
+
+def synthetic_invoices(count, data_ratio=0.9, frames=4, record_size=1100):
+    """
+    Build invoices resembling settled keysend payments, a share of them without a data record.
+    @param count: The amount of invoices.
+    @param data_ratio: The share of invoices that carry a data record.
+    @param frames: The amount of frames of different tubes coalesced into every data record.
+    @param record_size: The size of a data record, shared by its frames.
+    """
+    size = record_size // frames - framing.HEADER.size
+    invoices = []
+    for i in range(count):
+        invoice = ln.Invoice(value=1, settled=True, state=ln.Invoice.SETTLED)
+        htlc = invoice.htlcs.add(amt_msat=1000)
+        htlc.custom_records[framing.KEYSEND_RECORD] = secrets.token_bytes(32)
+        htlc.custom_records[framing.SESSION_RECORD] = secrets.token_bytes(framing.SESSION_ID_SIZE)
+
+        if i < count * data_ratio:
+            segments = [(50000 + (i + f) % 16, i, secrets.token_bytes(size), 0) for f in range(frames)]
+            htlc.custom_records[framing.DATA_RECORD] = framing.encode_packets(framing.FRAME_VERSION, segments)
+        invoices.append(invoice)
+    return invoices
+
+
+class ReplayStub:
+    """
+    Stands in for the Lightning stub of a node, streaming the given invoices.
+    """
+
+    def __init__(self, invoices):
+        self.invoices = invoices
+
+    def SubscribeInvoices(self, request, metadata=None):
+        return iter(self.invoices)
+
+
+def load_invoices(path):
+    """
+    Load invoices written by record_invoices, length prefixed serialized messages.
+    """
+    invoices = []
+    with open(path, 'rb') as file:
+        while header := file.read(LENGTH.size):
+            invoices.append(ln.Invoice.FromString(file.read(LENGTH.unpack(header)[0])))
+    return invoices
+
+
+def record_invoices(node, count, path):
+    """
+    Record incoming invoices of a live node, to be replayed later on.
+    @param node: The credentials of the node, see load_credentials.
+    """
+    transport = connect_node(node['pk'], node['cert'], node['mac'], node['port'])
+    invoices = transport.stub.SubscribeInvoices(ln.InvoiceSubscription(), metadata=[('macaroon', transport.macaroon)])
+
+    with open(path, 'wb') as file:
+        for i, invoice in enumerate(invoices):
+            data = invoice.SerializeToString()
+            file.write(LENGTH.pack(len(data)) + data)
+            if i + 1 == count:
+                return
+
+
+def json_path(invoices):
+    """
+    The previous decode path: convert the message to a dict and dig out the base64 encoded record.
+    """
+    for invoice in invoices:
+        msg = json.loads(MessageToJson(invoice))
+        try:
+            payload = msg['htlcs'][0]['customRecords'][str(framing.DATA_RECORD)]
+        except KeyError:
+            continue
+        framing.decode_packets(base64.b64decode(payload))
+
+
+def direct_path(invoices):
+    """
+    The current decode path: the records as the transport hands them to the receivers, decoded into their frames.
+    """
+    node = LndTransport('', ReplayStub(invoices), None, b'')
+    for records in node.subscribe():
+        payload = records.get(framing.DATA_RECORD)
+        if payload is None:
+            continue
+        framing.decode_packets(payload)
+
+
+def measure(func, invoices, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(invoices)
+        best = min(best, time.perf_counter() - start)
+    return len(invoices) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--invoices', help='File with recorded invoices')
+    parser.add_argument('--record', nargs=3, metavar=('NODE', 'COUNT', 'FILE'), help='Record invoices of a node')
+    parser.add_argument('--count', type=int, default=10000, help='Amount of synthetic invoices')
+    parser.add_argument('--frames', type=int, default=4, help='Frames coalesced into every synthetic record')
+    parser.add_argument('--creds', default='creds.txt', help='Credentials of the nodes, see load_credentials')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.record:
+        nodes = load_credentials(args.creds)
+        record_invoices(nodes[args.record[0]], int(args.record[1]), args.record[2])
+        return
+
+    invoices = load_invoices(args.invoices) if args.invoices else synthetic_invoices(args.count, frames=args.frames)
+
+    before = measure(json_path, invoices, args.rounds)
+    after = measure(direct_path, invoices, args.rounds)
+    print(f'MessageToJson round-trip: {before:>12,.0f} invoices/sec')
+    print(f'Transport records:        {after:>12,.0f} invoices/sec')
+    print(f'Speedup:                  {after / before:>12.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Microbenchmark of the hostname checks of the Submarine, comparing the substring scan over a list of domains with the
+compiled RuleSet.
+
+Run from the project root:
+    python -m benchmarks.rules                              # synthetic list of 50000 domains
+    python -m benchmarks.rules --list easylist.txt          # an adblock list or hosts file
+"""
+import argparse
+import random
+import string
+import time
+
+from helpers.rules import RuleSet
+
+TLDS = ['com', 'net', 'org', 'io', 'de', 'nl', 'co.uk']
+
+
+def random_domain():
+    labels = [''.join(random.choices(string.ascii_lowercase, k=random.randint(4, 12)))
+              for _ in range(random.randint(1, 2))]
+    return '.'.join(labels + [random.choice(TLDS)])
+
+
+def synthetic_list(count):
+    return [f'||{random_domain()}^' for _ in range(count)]
+
+
+def hostnames_for(domains, count, hit_ratio=0.2):
+    """
+    Hostnames to check, a share of them subdomains of listed domains.
+    """
+    hostnames = []
+    for _ in range(count):
+        if domains and random.random() < hit_ratio:
+            hostnames.append(f'www.{random.choice(domains)}')
+        else:
+            hostnames.append(f'www.{random_domain()}')
+    return hostnames
+
+
+def measure(func, hostnames, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for hostname in hostnames:
+            func(hostname)
+        best = min(best, time.perf_counter() - start)
+    return best / len(hostnames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--list', help='File with the rules, synthetic rules when not given')
+    parser.add_argument('--count', type=int, default=50000, help='Amount of synthetic rules')
+    parser.add_argument('--lookups', type=int, default=2000, help='Amount of hostnames checked per round')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.list:
+        with open(args.list, encoding='utf-8', errors='replace') as file:
+            lines = file.read().splitlines()
+    else:
+        lines = synthetic_list(args.count)
+
+    start = time.perf_counter()
+    rules = RuleSet(lines)
+    compiled = time.perf_counter() - start
+
+    # The substring scan the Submarine used to do, over the domains the compiled rules understood
+    domains = [line.strip('|^') for line in lines if line.startswith('||') and rules.match(line.strip('|^'))]
+    hostnames = hostnames_for(domains, args.lookups)
+
+    before = measure(lambda hostname: any(map(hostname.__contains__, domains)), hostnames, args.rounds)
+    after = measure(rules.match, hostnames, args.rounds)
+    print(f'Rules:            {len(rules):>12,} compiled in {compiled:.2f}s, {rules.skipped:,} skipped')
+    print(f'Substring scan:   {before * 1e6:>12,.2f} us/lookup')
+    print(f'Suffix trie:      {after * 1e6:>12,.2f} us/lookup')
+    print(f'Speedup:          {before / after:>12,.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+Load test of a Periscope serving many Submarines at once, over a stand-in for LND.
+The stand-in delivers every keysend payment to the invoice subscription of its destination after a configurable delay,
+so the Periscope runs unmodified while the lightning network is simulated in process. Every client registers,
+opens a tube through the Periscope to a local origin server and downloads a response, all clients at the same time.
+
+Run from the project root, with the compiled lnd protofiles on the path:
+    python -m benchmarks.sessions
+    python -m benchmarks.sessions --clients 10 100 300 --size 65536 --latency 0.2
+    python -m benchmarks.sessions --routes
+    python -m benchmarks.sessions --transport loopback    # the overhead of the protocol, without lightning
+"""
+import argparse
+import queue
+import random
+import secrets
+import socket
+import socketserver
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lightning_pb2 as ln
+
+from helpers.coalescer import Coalescer
+from helpers.logger import Logger
+from helpers.routes import RouteManager
+from helpers.transport import LndTransport, LoopbackNetwork, TcpTransport
+from helpers.throttle import Throttle
+from submarine.session import Session as SubmarineSession
+
+# The periscope imports its session module the way it does when run from its own directory
+sys.path.insert(0, 'periscope')
+from periscope import Periscope
+
+
+class StandInNetwork:
+
+    def __init__(self, latency=0.05, jitter=0.02, failure_rate=0.0, fee=1, pathfinding=0.02, hubs=3):
+        """
+        The lightning network between the stand-in nodes.
+        @param latency: Average seconds between sending a payment and its arrival at the destination.
+        @param jitter: Random deviation of the latency in seconds.
+        @param failure_rate: Share of the payments that fail without arriving.
+        @param fee: Routing fee in sat of every successful payment.
+        @param pathfinding: Seconds a node spends finding a route, for every SendPaymentV2 and QueryRoutes call.
+        @param hubs: The amount of routing nodes every payment goes through, each one slower than the one before.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.fee = fee
+        self.pathfinding = pathfinding
+        self.hubs = [secrets.token_hex(33) for _ in range(hubs)]
+        self.nodes = {}
+        self.payments = 0
+        self.searches = 0
+
+    def node(self, pk: str = None):
+        """
+        Add a stand-in node.
+        @return: The transport to hand to a session.
+        """
+        node = StandInNode(self, pk or secrets.token_hex(33))
+        self.nodes[node.pk] = node
+        return LndTransport(node.pk, node, node, b'')
+
+    def deliver(self, destination, custom_records, delay):
+        """
+        Let a payment take its time, and settle it at the destination unless it fails.
+        @return: Whether the payment arrived.
+        """
+        time.sleep(max(random.gauss(self.latency * delay, self.jitter), 0))
+        if destination is None or random.random() < self.failure_rate:
+            return False
+
+        self.payments += 1
+        htlc = ln.InvoiceHTLC(custom_records=dict(custom_records))
+        destination.invoices.put(ln.Invoice(htlcs=[htlc], state=ln.Invoice.SETTLED))
+        return True
+
+
+class StandInNode:
+
+    def __init__(self, network: StandInNetwork, pk: str):
+        """
+        Serves the calls of LND the sessions use, as both the Lightning and the Router stub.
+        """
+        self.network = network
+        self.pk = pk
+        self.invoices = queue.Queue()
+
+    def SubscribeInvoices(self, request, metadata=None):
+        while True:
+            yield self.invoices.get()
+
+    def SendPaymentV2(self, request, metadata=None):
+        # The node finds a route over the fastest hub for every single payment
+        network = self.network
+        network.searches += 1
+        time.sleep(network.pathfinding)
+
+        if not network.deliver(network.nodes.get(bytes(request.dest).hex()), request.dest_custom_records, 1.0):
+            yield ln.Payment(status=ln.Payment.FAILED, failure_reason=ln.PaymentFailureReason.FAILURE_REASON_NO_ROUTE)
+            return
+        yield ln.Payment(status=ln.Payment.SUCCEEDED, value_sat=request.amt, fee_sat=network.fee)
+
+    def QueryRoutes(self, request, metadata=None):
+        # One route over the first hub that is not excluded, the hubs getting slower in order
+        network = self.network
+        network.searches += 1
+        time.sleep(network.pathfinding)
+
+        ignored = {bytes(getattr(pair, 'to')).hex() for pair in request.ignored_pairs}
+        hubs = [(i, hub) for i, hub in enumerate(network.hubs) if hub not in ignored]
+        if request.pub_key not in network.nodes or not hubs:
+            return ln.QueryRoutesResponse()
+
+        i, hub = hubs[0]
+        hops = [ln.Hop(chan_id=2 * i + 1, pub_key=hub), ln.Hop(chan_id=2 * i + 2, pub_key=request.pub_key)]
+        return ln.QueryRoutesResponse(routes=[ln.Route(hops=hops, total_fees_msat=network.fee * 1000,
+                                                       total_amt_msat=(request.amt + network.fee) * 1000)])
+
+    def SendToRouteV2(self, request, metadata=None):
+        # No route search, the payment takes the given hub
+        network = self.network
+        final = request.route.hops[-1]
+        hub = network.hubs.index(request.route.hops[0].pub_key)
+
+        if not network.deliver(network.nodes.get(final.pub_key), final.custom_records, 1.0 + 0.5 * hub):
+            return ln.HTLCAttempt(status=ln.HTLCAttempt.FAILED,
+                                  failure=ln.Failure(code=ln.Failure.TEMPORARY_CHANNEL_FAILURE))
+        return ln.HTLCAttempt(status=ln.HTLCAttempt.SUCCEEDED, route=request.route)
+
+
+class TcpNetwork:
+
+    def __init__(self):
+        """
+        Nodes of the local TCP transport within this process, listening on free ports.
+        """
+        self.peers = {}
+        self.payments = 0
+
+    def node(self):
+        node = CountingTcpTransport(self, secrets.token_hex(33))
+        node.connect()
+        self.peers[node.pk] = (node.host, node.port)
+        return node
+
+
+class CountingTcpTransport(TcpTransport):
+
+    def __init__(self, network: TcpNetwork, pk: str):
+        super().__init__(pk, 0, network.peers)
+        self.network = network
+
+    def send(self, request):
+        updates = super().send(request)
+        if updates[0].status == ln.Payment.SUCCEEDED:
+            self.network.payments += 1
+        return updates
+
+
+class Origin(socketserver.ThreadingTCPServer):
+    """
+    The remote host, answering every request with a fixed amount of bytes and closing the connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, size):
+        self.size = size
+        super().__init__(('localhost', 0), OriginHandler)
+
+
+class OriginHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.request.recv(4096)
+        self.request.sendall(b'x' * self.server.size)
+        self.request.shutdown(socket.SHUT_WR)
+
+
+def run_client(network, periscope_pk, pool, size, results, logger, routes=False):
+    """
+    Register a submarine session, download a response through a tube, and record how long every step took.
+    """
+    arrived = threading.Event()
+    session = SubmarineSession(None, None, None, None, lambda tube_idx: None, logger, local_nodes=[network.node()])
+    if routes:
+        session.routes = RouteManager(logger, session.metrics)
+    session.deliverable_func = lambda tube_idx: arrived.set()
+    coalescer = Coalescer(session)
+    throttle = Throttle(0.0, session.send_batch, coalescer, pool=pool)
+
+    start = time.monotonic()
+    if not session.register(periscope_pk):
+        results.append(None)
+        return
+    registered = time.monotonic()
+
+    port = 1
+    session.create_tube(None, port, 'localhost')
+    coalescer.write(port, b'GET / HTTP/1.1\r\n\r\n')
+
+    # The periscope confirms the connection before the response follows
+    expected = len(b'HTTP/1.1 200 Connection established\r\n\r\n') + size
+    received = 0
+    first_byte = None
+    while received < expected:
+        if not arrived.wait(60):
+            break
+        arrived.clear()
+        while (data := session.get_packet(port)) is not None:
+            if not data:
+                break
+            first_byte = first_byte or time.monotonic()
+            received += len(data)
+
+    done = time.monotonic()
+    throttle.stop()
+    coalescer.close()
+    results.append((registered - start, (first_byte or done) - registered, done - registered, received >= expected))
+
+
+def percentile(values, share):
+    return sorted(values)[min(int(len(values) * share), len(values) - 1)] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--size', type=int, default=16384, help='bytes downloaded by every client')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds a payment takes on average')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--pathfinding', type=float, default=0.02, help='seconds a node spends finding a route')
+    parser.add_argument('--routes', action='store_true', help='send over cached routes through SendToRouteV2')
+    parser.add_argument('--workers', type=int, default=256, help='payment workers of the periscope and the clients')
+    parser.add_argument('--transport', default='standin', choices=['standin', 'loopback', 'tcp'],
+                        help='the simulated lightning network, or the protocol alone over loopback or local tcp')
+    args = parser.parse_args()
+
+    if args.transport == 'loopback':
+        network = LoopbackNetwork()
+    elif args.transport == 'tcp':
+        network = TcpNetwork()
+    else:
+        network = StandInNetwork(args.latency, args.jitter, args.failure_rate, pathfinding=args.pathfinding)
+    origin = Origin(args.size)
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+
+    periscope_node = network.node()
+    logger = Logger('LOAD', 'error')
+    threading.Thread(target=Periscope, daemon=True,
+                     kwargs=dict(node=None, local_nodes=[periscope_node], remote_port=origin.server_address[1],
+                                 workers=args.workers, log_level='error', route_cache=args.routes)).start()
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+
+    print(f'{"clients":>8} {"ok":>5} {"register p50":>13} {"ttfb p50":>9} {"ttfb p95":>9} {"done p95":>9} '
+          f'{"payments/s":>11} {"searches":>9} {"wall s":>7}')
+    for count in args.clients:
+        results = []
+        payments = network.payments
+        searches = getattr(network, 'searches', 0)
+        start = time.monotonic()
+        threads = [threading.Thread(target=run_client, daemon=True,
+                                    args=(network, periscope_node.pk, pool, args.size, results, logger, args.routes))
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.monotonic() - start
+
+        completed = [result for result in results if result is not None and result[3]]
+        print(f'{count:>8} {len(completed):>5} '
+              f'{statistics.median([r[0] for r in completed]) if completed else float("nan"):>13.3f} '
+              f'{statistics.median([r[1] for r in completed]) if completed else float("nan"):>9.3f} '
+              f'{percentile([r[1] for r in completed], 0.95):>9.3f} {percentile([r[2] for r in completed], 0.95):>9.3f} '
+              f'{(network.payments - payments) / wall:>11.1f} {getattr(network, "searches", 0) - searches:>9} {wall:>7.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+"""
+End-to-end benchmark of the proxy, replacing bench.sh. A Periscope and a Submarine run in process over a stand-in for
+LND, next to a local HTTPS origin serving fixed sets of pages, and every set is downloaded through the Submarine by a
+number of clients at once, each over its own tube. Results are written as JSON to be compared between commits.
+
+Measured per page set and amount of concurrent tubes:
+    throughput, time to set up the tunnel, time to first byte of every response,
+    p50/p95/p99 latency of the payments carrying the packets, from sending to being taken from the subscription,
+    payments and fees per MB downloaded, and CPU seconds per MB of the whole process, origin and clients included.
+
+Run from the project root, with the compiled lnd protofiles on the path:
+    python -m benchmarks.suite
+    python -m benchmarks.suite --sets page bulk --tubes 1 8 32 --output before.json
+    python -m benchmarks.suite --output after.json --compare before.json
+    python -m benchmarks.suite --transport loopback     # the protocol alone, without lightning
+"""
+import argparse
+import http.client
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import lightning_pb2 as ln
+
+from benchmarks.sessions import StandInNetwork, TcpNetwork
+from helpers import packet as framing
+from helpers.throttle import RateController
+from helpers.transport import Transport, LoopbackNetwork
+
+
+def load_submarine():
+    """
+    Load the module of the Submarine. It imports its session module as 'session' like the Periscope does, the way they
+    do when run from their own directories, so the session module of the Submarine takes that name while it loads.
+    """
+    periscope_session = sys.modules.get('session')
+    sys.modules['session'] = importlib.import_module('submarine.session')
+    try:
+        spec = importlib.util.spec_from_file_location('submarine_proxy', os.path.join('submarine', 'submarine.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.modules['session'] = periscope_session
+    return module
+
+
+# The Periscope has been loaded from its own directory by the sessions benchmark
+from periscope import Periscope
+Submarine = load_submarine().Submarine
+
+MB = 2 ** 20
+
+
+def page_sets():
+    """
+    The fixed sets of pages, the same bytes on every run.
+    @return: dict of set names to lists of (path, content) tuples.
+    """
+    rng = random.Random(1)
+    sets = {
+        # Many small responses, dominated by the round trips
+        'small': [(f'/small/{i}', 4096) for i in range(16)],
+        # A document with its assets, as a browser would load them over one connection
+        'page': [('/page/index.html', 60 * 1024)] + [(f'/page/asset/{i}', rng.randint(2, 40) * 1024) for i in range(15)],
+        # A single large download, dominated by the throughput
+        'bulk': [('/bulk/file', 512 * 1024)],
+    }
+    return {name: [(path, rng.randbytes(size)) for path, size in pages] for name, pages in sets.items()}
+
+
+def self_signed(directory):
+    """
+    Create a certificate for localhost with openssl.
+    @return: The paths of the certificate and the key.
+    """
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                    '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost'],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+class Origin(ThreadingHTTPServer):
+    """
+    The remote host, serving the pages over HTTPS with keep-alive.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, pages, context: ssl.SSLContext = None):
+        self.pages = pages
+        super().__init__(('localhost', 0), OriginHandler)
+        # The handshake takes place on the thread of the connection, not holding up the accepting thread
+        if context is not None:
+            self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.do_handshake()
+        super().setup()
+
+    def do_GET(self):
+        body = self.server.pages.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Ledger:
+
+    def __init__(self):
+        """
+        The payments of both sides, their delivery latency and their fees.
+        """
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.latencies = []
+        self.payments = 0
+        self.fees = 0
+
+    def sending(self, preimage: bytes):
+        with self.lock:
+            self.sent[preimage] = time.perf_counter()
+
+    def update(self, update, preimage: bytes):
+        with self.lock:
+            if update.status == ln.Payment.SUCCEEDED:
+                self.payments += 1
+                self.fees += update.fee_sat
+            elif update.status == ln.Payment.FAILED:
+                self.sent.pop(preimage, None)
+
+    def arrived(self, preimage: bytes):
+        with self.lock:
+            sent = self.sent.pop(preimage, None)
+            if sent is not None:
+                self.latencies.append(time.perf_counter() - sent)
+
+    def take(self):
+        """
+        @return: The payments, fees and latencies since the previous call.
+        """
+        with self.lock:
+            taken = self.payments, self.fees, self.latencies
+            self.payments, self.fees, self.latencies = 0, 0, []
+        return taken
+
+
+class MeasuredTransport(Transport):
+
+    def __init__(self, transport: Transport, ledger: Ledger):
+        """
+        Passes the payments of a transport on, noting them in the ledger. The keysend preimage tells them apart.
+        Routes are not cached through it, the payments take the plain send of the transport.
+        """
+        super().__init__(transport.pk)
+        self.transport = transport
+        self.ledger = ledger
+
+    def connect(self):
+        self.transport.connect()
+
+    def ready(self, timeout: float):
+        self.transport.ready(timeout)
+
+    def subscribe(self):
+        return self.arrivals(self.transport.subscribe())
+
+    def arrivals(self, payments):
+        for records in payments:
+            self.ledger.arrived(records.get(framing.KEYSEND_RECORD))
+            yield records
+
+    def send(self, request):
+        preimage = request.dest_custom_records[framing.KEYSEND_RECORD]
+        self.ledger.sending(preimage)
+        for update in self.transport.send(request):
+            self.ledger.update(update, preimage)
+            yield update
+
+
+class BenchSubmarine(Submarine):
+    """
+    Signals the steps of its startup, as the constructor only returns once the Submarine stops.
+    """
+    started = {}
+
+    def milestone(self, step: str):
+        super().milestone(step)
+        event = self.started.get(step)
+        if event is not None:
+            event.set()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def fetch(proxy_port, origin_port, pages, context, timeout, results):
+    """
+    Download pages over a single tunnel, as a browser would over one connection.
+    Appends the setup time and a (time to first byte, size, complete) tuple for every page to the results.
+    """
+    if context is not None:
+        connection = http.client.HTTPSConnection('localhost', proxy_port, timeout=timeout, context=context)
+    else:
+        connection = http.client.HTTPConnection('localhost', proxy_port, timeout=timeout)
+    connection.set_tunnel('localhost', origin_port)
+
+    downloads = []
+    setup = None
+    try:
+        start = time.perf_counter()
+        connection.connect()
+        setup = time.perf_counter() - start
+
+        for path, body in pages:
+            start = time.perf_counter()
+            connection.request('GET', path)
+            response = connection.getresponse()
+            ttfb = time.perf_counter() - start
+            data = response.read()
+            downloads.append((ttfb, len(data), data == body))
+    except (OSError, http.client.HTTPException):
+        pass
+    finally:
+        connection.close()
+
+    # Pages that could not be downloaded count as incomplete
+    downloads += [(None, 0, False)] * (len(pages) - len(downloads))
+    results.append((setup, downloads))
+
+
+def percentile(values, share):
+    return sorted(values)[min(int(len(values) * share), len(values) - 1)] if values else None
+
+
+def run(name, pages, tubes, proxy_port, origin_port, context, ledger, timeout):
+    """
+    Download a page set through a number of tubes at once.
+    @return: The measurements of the run.
+    """
+    ledger.take()
+    results = []
+    threads = [threading.Thread(target=fetch, args=(proxy_port, origin_port, pages, context, timeout, results),
+                                daemon=True) for _ in range(tubes)]
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    payments, fees, latencies = ledger.take()
+
+    downloads = [download for _, tube_downloads in results for download in tube_downloads]
+    size = sum(download[1] for download in downloads)
+    ttfbs = [download[0] for download in downloads if download[0] is not None]
+    setups = [setup for setup, _ in results if setup is not None]
+    megabytes = size / MB
+
+    def per_mb(value):
+        # Nothing to relate to when every download failed
+        return value / megabytes if size else None
+
+    return {
+        'set': name,
+        'tubes': tubes,
+        'requests': len(downloads),
+        'failed': sum(1 for download in downloads if not download[2]),
+        'bytes': size,
+        'wall_s': wall,
+        'throughput_bytes_s': size / wall,
+        'setup_s_p50': percentile(setups, 0.5),
+        'ttfb_s_p50': percentile(ttfbs, 0.5),
+        'ttfb_s_p95': percentile(ttfbs, 0.95),
+        'packet_latency_s_p50': percentile(latencies, 0.5),
+        'packet_latency_s_p95': percentile(latencies, 0.95),
+        'packet_latency_s_p99': percentile(latencies, 0.99),
+        'payments': payments,
+        'payments_per_mb': per_mb(payments),
+        'fees_sat': fees,
+        'fees_sat_per_mb': per_mb(fees),
+        'cpu_s': cpu,
+        'cpu_s_per_mb': per_mb(cpu),
+    }
+
+
+def start(args, pages, ledger):
+    """
+    Start the origin, the Periscope and the Submarine.
+    @return: The port of the Submarine, the port of the origin and the client TLS context, None for plain HTTP.
+    """
+    server_context = client_context = None
+    if not args.no_tls:
+        cert, key = self_signed(tempfile.mkdtemp(prefix='periscope-bench-'))
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(cert, key)
+        client_context = ssl.create_default_context(cafile=cert)
+
+    origin = Origin({path: body for set_pages in pages.values() for path, body in set_pages}, server_context)
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+
+    if args.transport == 'loopback':
+        network = LoopbackNetwork()
+    elif args.transport == 'tcp':
+        network = TcpNetwork()
+    else:
+        network = StandInNetwork(args.latency, args.jitter, args.failure_rate, args.fee, pathfinding=args.pathfinding)
+    periscope_node = MeasuredTransport(network.node(), ledger)
+    submarine_node = MeasuredTransport(network.node(), ledger)
+
+    # The same settings as the Periscope and the Submarine are started with by their main functions
+    threading.Thread(target=Periscope, daemon=True,
+                     kwargs=dict(node=None, local_nodes=[periscope_node], remote_port=origin.server_address[1],
+                                 controller_factory=partial(RateController, rate=200.0, max_rate=1000.0),
+                                 log_level='error')).start()
+
+    registered = threading.Event()
+    BenchSubmarine.started['registered'] = registered
+    proxy_port = free_port()
+    threading.Thread(target=BenchSubmarine, daemon=True,
+                     args=(None, periscope_node.pk),
+                     kwargs=dict(local_nodes=[submarine_node], rate_controller=RateController(), log_level='error',
+                                 listen_port=proxy_port)).start()
+    if not registered.wait(30):
+        raise SystemExit('The Submarine did not register at the Periscope')
+
+    return proxy_port, origin.server_address[1], client_context
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_header():
+    print(f'{"set":>6} {"tubes":>5} {"failed":>6} {"MB/s":>7} {"setup p50":>9} {"ttfb p50":>9} {"ttfb p95":>9} '
+          f'{"pkt p50":>8} {"pkt p95":>8} {"pkt p99":>8} {"pay/MB":>7} {"fee/MB":>7} {"cpu/MB":>7}')
+
+
+def print_row(r):
+    def number(value, digits=3):
+        return f'{value:.{digits}f}' if value is not None else '-'
+
+    print(f'{r["set"]:>6} {r["tubes"]:>5} {r["failed"]:>6} {r["throughput_bytes_s"] / MB:>7.3f} '
+          f'{number(r["setup_s_p50"]):>9} {number(r["ttfb_s_p50"]):>9} {number(r["ttfb_s_p95"]):>9} '
+          f'{number(r["packet_latency_s_p50"]):>8} {number(r["packet_latency_s_p95"]):>8} '
+          f'{number(r["packet_latency_s_p99"]):>8} {number(r["payments_per_mb"], 0):>7} '
+          f'{number(r["fees_sat_per_mb"], 0):>7} {number(r["cpu_s_per_mb"], 2):>7}', flush=True)
+
+
+def compare(rows, path):
+    """
+    Print the change of every measurement against the results of an earlier run.
+    """
+    with open(path) as file:
+        previous = json.load(file)
+    before = {(r['set'], r['tubes']): r for r in previous['results']}
+
+    print(f'\nCompared to {previous.get("commit") or path}:')
+    for r in rows:
+        old = before.get((r['set'], r['tubes']))
+        if old is None:
+            continue
+        changes = []
+        for key in ('throughput_bytes_s', 'ttfb_s_p50', 'ttfb_s_p95', 'packet_latency_s_p95', 'payments_per_mb',
+                    'cpu_s_per_mb'):
+            if old.get(key) and r.get(key) is not None:
+                changes.append(f'{key} {(r[key] - old[key]) / old[key]:+.1%}')
+        print(f'{r["set"]:>6} {r["tubes"]:>5}  ' + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sets', nargs='+', default=['small', 'page', 'bulk'], choices=['small', 'page', 'bulk'])
+    parser.add_argument('--tubes', type=int, nargs='+', default=[1, 8], help='amounts of concurrent tubes')
+    parser.add_argument('--transport', default='standin', choices=['standin', 'loopback', 'tcp'],
+                        help='the simulated lightning network, or the protocol alone over loopback or local tcp')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds a payment takes on average')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--fee', type=int, default=1, help='routing fee in sat of every payment')
+    parser.add_argument('--pathfinding', type=float, default=0.02, help='seconds a node spends finding a route')
+    parser.add_argument('--no-tls', action='store_true', help='serve plain HTTP, without openssl')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds after which a client gives up')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the simulated network')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    pages = page_sets()
+    ledger = Ledger()
+    proxy_port, origin_port, context = start(args, pages, ledger)
+
+    # Every row is printed once its run is done, the whole suite takes minutes on the simulated network
+    print_header()
+    rows = []
+    for name in args.sets:
+        for tubes in args.tubes:
+            rows.append(run(name, pages[name], tubes, proxy_port, origin_port, context, ledger, args.timeout))
+            print_row(rows[-1])
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'commit': git_commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       'python': platform.python_version(), 'settings': vars(args), 'results': rows}, file, indent=2)
+    if args.compare:
+        compare(rows, args.compare)
+
+    # The Submarine and the Periscope run on threads of their own that do not stop
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Microbenchmark of the socket loop bookkeeping, showing how the cost of a wakeup grows with the amount of open tubes.
+The previous loop rebuilt its select lists and found tubes by scanning, the current one uses a SocketMap.
+Every wakeup delivers a single byte on one random tube, closing a tube is measured separately.
+
+Run from the project root:
+    python -m benchmarks.wakeup
+    python -m benchmarks.wakeup --tubes 10 100 1000 5000 --wakeups 2000
+"""
+import argparse
+import random
+import select
+import selectors
+import socket
+import time
+
+from helpers.socket_map import SocketMap
+
+
+def open_tubes(count):
+    """
+    Create connected socket pairs, the first socket of each pair is served by the loop and the second one feeds it.
+    """
+    pairs = [socket.socketpair() for _ in range(count)]
+    for served, _ in pairs:
+        served.setblocking(False)
+    return pairs
+
+
+def close_tubes(pairs):
+    for served, peer in pairs:
+        served.close()
+        peer.close()
+
+
+def select_wakeups(pairs, wakeups):
+    """
+    The previous loop: filter the inputs by fileno, select over all of them and find the tube of the ready socket.
+    @return: Average seconds per wakeup, None if select can not handle this many sockets.
+    """
+    inputs = [served for served, _ in pairs]
+    socket_tube_dict = {served: idx for idx, served in enumerate(inputs)}
+
+    elapsed = 0.0
+    for _ in range(wakeups):
+        random.choice(pairs)[1].send(b'x')
+
+        start = time.perf_counter()
+        inputs = [s for s in inputs if s.fileno() != -1]
+        try:
+            readable, _, _ = select.select(inputs, [], inputs, 1)
+        except ValueError:
+            return None
+        for s in readable:
+            s.recv(1)
+            _ = socket_tube_dict[s]
+        elapsed += time.perf_counter() - start
+
+    return elapsed / wakeups
+
+
+def selector_wakeups(pairs, wakeups):
+    """
+    The current loop: a single select call on the registered sockets, the tube is the data of the selector key.
+    @return: Average seconds per wakeup.
+    """
+    sockets = SocketMap()
+    for idx, (served, _) in enumerate(pairs):
+        sockets.sockets[idx] = served
+        sockets.selector.register(served, selectors.EVENT_READ, idx)
+
+    elapsed = 0.0
+    for _ in range(wakeups):
+        random.choice(pairs)[1].send(b'x')
+
+        start = time.perf_counter()
+        for s, tube_idx, _ in sockets.select(1):
+            s.recv(1)
+        elapsed += time.perf_counter() - start
+
+    sockets.selector.close()
+    return elapsed / wakeups
+
+
+def scan_close(pairs):
+    """
+    Look up a tube the way the previous close_socket did, by scanning the dictionary of sockets.
+    """
+    socket_tube_dict = {served: idx for idx, (served, _) in enumerate(pairs)}
+    tube_idx = len(pairs) - 1
+
+    start = time.perf_counter()
+    for s, idx in socket_tube_dict.items():
+        if idx == tube_idx:
+            del socket_tube_dict[s]
+            break
+    return time.perf_counter() - start
+
+
+def map_close(pairs):
+    """
+    Remove a tube from a SocketMap.
+    """
+    sockets = SocketMap()
+    for idx, (served, _) in enumerate(pairs):
+        sockets.add(idx, served)
+
+    start = time.perf_counter()
+    sockets.remove(len(pairs) - 1)
+    elapsed = time.perf_counter() - start
+
+    sockets.selector.close()
+    return elapsed
+
+
+def microseconds(seconds):
+    return 'n/a' if seconds is None else f'{seconds * 1e6:.1f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tubes', type=int, nargs='+', default=[10, 100, 500, 1000, 2000])
+    parser.add_argument('--wakeups', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f'{"tubes":>8} {"select us":>12} {"selectors us":>14} {"scan close us":>15} {"map close us":>14}')
+    for count in args.tubes:
+        pairs = open_tubes(count)
+        try:
+            print(f'{count:>8} {microseconds(select_wakeups(pairs, args.wakeups)):>12} '
+                  f'{microseconds(selector_wakeups(pairs, args.wakeups)):>14} '
+                  f'{microseconds(scan_close(pairs)):>15} {microseconds(map_close(pairs)):>14}')
+        finally:
+            close_tubes(pairs)
+
+
+if __name__ == '__main__':
+    main()
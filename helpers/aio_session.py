@@ -0,0 +1,233 @@
+import asyncio
+import time
+
+import grpc
+
+from helpers import packet as framing
+from helpers.transport import Transport
+
+
+class AioSession:
+    """
+    Mixin that runs a Session on asyncio, to be placed before the Submarine or Periscope Session in the bases.
+    The protocol handling is inherited untouched, only the payments go through the asyncio counterparts of the
+    transports: grpc.aio calls for LND nodes, threads for the other transports.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Events that wake up the tasks delivering packets to the sockets
+        self.wakeups = {}
+
+    def create_channel(self, cert: bytes, port):
+        """
+        Open an asyncio gRPC channel towards the local LND node.
+        """
+        creds = grpc.ssl_channel_credentials(cert)
+        return grpc.aio.secure_channel(f'localhost:{port}', creds)
+
+    async def receiver(self, node: Transport = None):
+        """
+        Consume the incoming payments and direct the packets, best to be started as a task for every local node.
+        @param node: The local node to receive on, defaults to the primary node.
+        """
+        node = node or self.local_nodes[0]
+
+        async for records in node.aio_subscribe():
+
+            # Retrieve the message content, payments that do not carry a data record are ignored
+            payload = records.get(framing.DATA_RECORD)
+            if payload is None:
+                continue
+
+            # Parse the packets, binary frames and legacy packets are both accepted
+            try:
+                packets = framing.decode_packets(payload)
+            except (ValueError, UnicodeDecodeError) as e:
+                self.logger.log_error(f'Received a malformed packet: {e}')
+                continue
+            self.dispatch(records.get(framing.HANDSHAKE_RECORD), packets)
+
+    async def send(self, data: bytes, packet_idx: int, tube_idx: int):
+        """
+        Send a formatted packet with the data to the linked node, see Session.send.
+        """
+        return await self.send_batch([(tube_idx, packet_idx, data, 0)])
+
+    async def send_batch(self, segments, records=None):
+        """
+        Send a single payment carrying one or more packets, see Session.send_batch.
+        The routes are left to the local node, the RouteManager only serves the threaded runtime.
+        """
+        failed = []
+        while (path := self.paths.pick(exclude=failed)) is not None:
+            request, dest = self.payment_request(segments, path.target_pk, records)
+            if request is None:
+                return
+
+            start = time.time()
+            status = None
+            fee = 0
+            try:
+                async for update in path.local.aio_send(request):
+                    self.payment_update(update, request, dest, segments)
+                    status = update.status
+                    fee = update.fee_sat
+            except grpc.RpcError as e:
+                self.logger.log_error(f'Payment over {path} could not be sent: {e.code()}')
+                self.failures.inc(reason=e.code().name)
+
+            if self.payment_attempt(path, status, time.time() - start):
+                return fee
+            failed.append(path)
+
+        self.payment_failed(segments)
+        return False
+
+    def start_receivers(self):
+        """
+        Start a receiving task for every local node, as well as the task acknowledging the received packets.
+        @return: The tasks.
+        """
+        tasks = [asyncio.ensure_future(self.receiver(node)) for node in self.local_nodes]
+        tasks.append(asyncio.ensure_future(self.feedback_loop()))
+        return tasks
+
+    async def feedback_loop(self):
+        """
+        Periodically acknowledge the received packets, see Session.acknowledge.
+        """
+        while True:
+            await asyncio.sleep(self.ack_interval / 4)
+            self.acknowledge()
+
+    def send_session_message(self, data: str):
+        """
+        Schedule a session message, callers that depend on its delivery can await the returned task.
+        @param data: The session message to be send.
+        @return: The task sending the message.
+        """
+        return asyncio.ensure_future(self.send(data=data.encode(), packet_idx=0, tube_idx=0))
+
+    def wakeup(self, tube_idx: int):
+        """
+        Signal the delivering task of a tube that packets have arrived.
+        """
+        event = self.wakeups.get(tube_idx)
+        if event is not None:
+            event.set()
+
+    async def next_packet(self, tube_idx: int):
+        """
+        Wait for the next in-order packet of a tube.
+        @param tube_idx: The index of the tube.
+        @return: The packet content, empty when the peer closed the connection.
+        """
+        tube = self.tubes[tube_idx]
+        event = self.wakeups.setdefault(tube_idx, asyncio.Event())
+
+        while True:
+            packet = tube.packet_queue.get(tube.receive_index)
+            if packet is not None:
+                return tube.get_packet()
+
+            event.clear()
+            await event.wait()
+
+    def local_socket_close(self, tube_idx: int):
+        super().local_socket_close(tube_idx)
+        self.wakeups.pop(int(tube_idx), None)
+
+    def remote_socket_close(self, tube_idx: int):
+        super().remote_socket_close(tube_idx)
+        self.wakeups.pop(int(tube_idx), None)
+
+
+class AioProxy:
+    """
+    Shared plumbing of the asyncio Submarine and Periscope, every tube is served by two tasks:
+    one reading from the socket into the transaction queue, and one writing received packets to the socket.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.session = None
+        self.t_queue = None
+
+        # Writers and tasks of every open tube
+        self.writers = {}
+        self.tasks = {}
+
+    def attach(self, tube_idx: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Start piping between a connection and its tube.
+        """
+        self.writers[tube_idx] = writer
+        self.tasks[tube_idx] = [asyncio.ensure_future(self.socket_to_tube(tube_idx, reader)),
+                                asyncio.ensure_future(self.tube_to_socket(tube_idx, writer))]
+
+    async def socket_to_tube(self, tube_idx: int, reader: asyncio.StreamReader):
+        """
+        Read the connection and queue the data for the peer, the coalescer cuts it into transmittable chunks.
+        """
+        while True:
+            try:
+                data = await reader.read(16384)
+
+            except (ConnectionResetError, ConnectionAbortedError, OSError) as e:
+                self.logger.log_error(
+                    f'Exception occurred on tube {tube_idx}, will close down socket and inform peer: {e}')
+
+                # Discard the socket locally and inform peer
+                self.session.local_socket_close(tube_idx)
+                return
+
+            if tube_idx not in self.session.tubes:
+                return
+
+            # Send data through the tunnel, waits while too much is pending
+            self.t_queue.write(tube_idx, data)
+            await self.t_queue.drained()
+
+            if not data:
+                self.logger.log_inform(
+                    f'Socket {tube_idx} concluded gracefully, will close down socket and inform peer')
+                self.close_socket(tube_idx)
+                return
+
+    async def tube_to_socket(self, tube_idx: int, writer: asyncio.StreamWriter):
+        """
+        Write the packets of a tube to the connection as soon as they are in order.
+        """
+        while True:
+            data = await self.session.next_packet(tube_idx)
+            if not data:
+                continue
+
+            try:
+                writer.write(data)
+                await writer.drain()
+            except (ConnectionResetError, ConnectionAbortedError, OSError) as e:
+                self.logger.log_error(
+                    f'Exception occurred on tube {tube_idx}, will close down socket and inform peer: {e}')
+                self.session.local_socket_close(tube_idx)
+                return
+
+            if self.logger.debug:
+                self.logger.log_debug(f'Sending {len(data)} to socket', 'socket')
+
+    def close_socket(self, tube_idx):
+        """
+        Cleanup for the closing tube.
+        @param tube_idx: tube identifier.
+        """
+        tube_idx = int(tube_idx)
+        writer = self.writers.pop(tube_idx, None)
+        if writer is None:
+            raise Exception(f'The socket {tube_idx} has already been removed')
+
+        for task in self.tasks.pop(tube_idx, []):
+            task.cancel()
+        writer.close()
+        self.logger.log_inform(f'Successfully closed socket on port {tube_idx}')
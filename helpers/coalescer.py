@@ -0,0 +1,443 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+
+from helpers import fec
+from helpers import packet as framing
+
+
+def check_weight(weight: float, name):
+    """
+    @raise ValueError: When the weight is not positive, a tube of weight 0 would never get a turn.
+    """
+    if not weight > 0:
+        raise ValueError(f'The weight of {name} must be positive, not {weight}')
+
+
+class Coalescer:
+
+    def __init__(self, session, linger=0.005, high_water=256, fec_block=0, interactive_size=512, host_weights=None):
+        """
+        Sits between the socket loops and the Throttle in place of a plain FIFO queue.
+        Pending data of one or more tubes is packed into payments that fill up the data record, small writes are
+        held back for at most the linger time so they can share a payment with more data.
+        @param session: The session, which determines the capacity of a payment and assigns the packet indexes.
+        @param linger: Maximum time in seconds that data waits for a payment to fill up.
+        @param high_water: The amount of pending payments at which writers should hold off.
+        @param fec_block: The amount of packets covered by a parity packet sent in place of a dummy payment, 0 disables it.
+        @param interactive_size: Tubes with at most this many bytes pending skip the round robin and go first.
+        @param host_weights: dict of hostname suffix to the share of its tubes in the round robin, 1 by default.
+        @raise ValueError: When any of the host weights is not positive.
+        """
+        for suffix, weight in (host_weights or {}).items():
+            check_weight(weight, suffix)
+
+        self.session = session
+        self.linger = linger
+        self.high_water = high_water
+        self.fec_block = fec_block
+        self.interactive_size = interactive_size
+
+        # Deficit round robin state: the weights set per tube or per host, the unused deficit of every tube,
+        # and the tube whose turn it is
+        self.weights = {}
+        self.host_weights = host_weights or {}
+        self.deficit = {}
+        self.turn = None
+
+        # Tube to start with when looking for packets to cover with parity
+        self.parity_turn = 0
+
+        # Pending runs of [flags, bytes] per tube, and the tubes whose socket concluded
+        self.pending = OrderedDict()
+        self.closing = set()
+        self.size = 0
+
+        # Arrival time of the oldest data that is still pending
+        self.since = None
+
+        # Session messages riding along with the next payment as (deadline, message) pairs,
+        # and packets that have to be sent again as (tube_idx, packet_idx, data, flags) tuples
+        self.control = deque()
+        self.retransmit = deque()
+
+        self.lock = threading.Condition()
+        self.closed = False
+
+        # Acknowledgements and retransmissions of the session are routed through here
+        session.coalescer = self
+
+    def write(self, tube_idx: int, data: bytes):
+        """
+        Queue data read from the socket of a tube, empty data marks the socket as concluded.
+        """
+        flags, data = self.compress(tube_idx, data)
+        with self.lock:
+            self.add(tube_idx, data, flags)
+            self.lock.notify()
+
+    def get(self):
+        """
+        Wait until a payment is due, and take its packets.
+        @return: The arguments for Session.send_batch, None once the coalescer has been closed.
+        """
+        with self.lock:
+            while not self.closed:
+                if self.ready():
+                    segments = self.pack()
+                    if segments:
+                        return (segments,)
+
+                deadline = self.deadline()
+                self.lock.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    def dummy(self):
+        """
+        The arguments of a dummy payment, which carries its creation time for latency measurements.
+        With forward error correction enabled the slot carries parity of the recently sent packets instead, as long as
+        there are any. Pending session messages fill up the rest of the record, so acknowledgements rarely need a
+        payment of their own.
+        """
+        if self.session.frame_version == framing.LEGACY_VERSION:
+            return ([(-1, -1, str(time.time()).encode(), 0)],)
+
+        with self.lock:
+            segments = []
+            room = self.session.record_size
+            if self.fec_block:
+                room = self.take_parity(segments, room)
+            if not segments:
+                segments.append((-1, -1, str(time.time()).encode(), 0))
+                room -= framing.frame_size(len(segments[0][2]))
+            self.take_control(segments, room)
+        return (segments,)
+
+    def post(self, message: bytes, delay: float = 0.0):
+        """
+        Queue a session message to ride along with the next payment, once the delay passed it gets a payment of its own.
+        """
+        with self.lock:
+            self.control.append((time.monotonic() + delay, message))
+            self.lock.notify()
+
+    def resend(self, segments):
+        """
+        Queue packets that have to be sent again, they keep their index and go ahead of new data.
+        @param segments: list of (tube_idx, packet_idx, data, flags) tuples.
+        """
+        with self.lock:
+            self.retransmit.extend(segments)
+            self.lock.notify()
+
+    def compress(self, tube_idx: int, data: bytes):
+        """
+        Compress the data if a codec has been negotiated for the tube.
+        @return: The frame flags and the data.
+        """
+        tube = self.session.tubes.get(tube_idx)
+        if not data or tube is None or tube.compressor is None:
+            return 0, data
+        return tube.compressor.compress(data)
+
+    def add(self, tube_idx: int, data: bytes, flags: int = 0):
+        runs = self.pending.setdefault(tube_idx, deque())
+
+        if data:
+            # Runs with the same flags can share frames
+            if runs and runs[-1][0] == flags:
+                runs[-1][1] += data
+            else:
+                runs.append([flags, bytearray(data)])
+            self.size += len(data)
+        else:
+            self.closing.add(tube_idx)
+
+        if self.since is None:
+            self.since = time.monotonic()
+
+    def capacity(self):
+        """
+        The size of the data record, legacy peers can only receive a single packet per record.
+        With forward error correction the records are kept a little smaller, so the parity of a full packet still fits.
+        """
+        if self.session.frame_version == framing.LEGACY_VERSION:
+            return self.session.chunk_size
+        if self.fec_block:
+            return self.session.record_size - fec.PARITY.size
+        return self.session.record_size
+
+    def deadline(self):
+        """
+        The moment at which a payment becomes due at the latest, None if nothing is pending.
+        """
+        deadlines = [deadline for deadline, _ in self.control]
+        if self.since is not None:
+            deadlines.append(self.since + self.linger)
+        return min(deadlines) if deadlines else None
+
+    def ready(self):
+        """
+        A payment is due when its record can be filled, a tube concluded, packets await retransmission,
+        or data or a session message has been waiting long enough.
+        """
+        if self.retransmit:
+            return True
+        if self.control and min(deadline for deadline, _ in self.control) <= time.monotonic():
+            return True
+        if not self.pending:
+            return False
+        if self.closing or self.since + self.linger <= time.monotonic():
+            return True
+        return framing.frame_size(self.size) + framing.HEADER.size * (len(self.pending) - 1) >= self.capacity()
+
+    def pack(self):
+        """
+        Take pending data for a single payment.
+        Session messages and retransmissions go first, followed by the tubes with only a little data pending such as
+        requests, handshakes and closes. The remaining room is shared among the bulk tubes by deficit round robin.
+        @return: list of (tube_idx, packet_idx, data, flags) tuples.
+        """
+        legacy = self.session.frame_version == framing.LEGACY_VERSION
+        overhead = 0 if legacy else framing.HEADER.size
+        room = self.capacity()
+        segments = []
+
+        # Session messages and retransmissions go ahead of new data
+        if not legacy:
+            room = self.take_control(segments, room)
+        while self.retransmit and len(self.retransmit[0][2]) + overhead <= room and not (legacy and segments):
+            segment = self.retransmit.popleft()
+            segments.append(segment)
+            room -= len(segment[2]) + overhead
+
+        self.discard_deleted()
+
+        # Priority lane for interactive tubes, which are sent whole so they are not held up by bulk transfers
+        for tube_idx in list(self.pending):
+            if self.pending_size(tube_idx) <= self.interactive_size:
+                room = self.take(tube_idx, segments, room, room, overhead, legacy)
+
+        # Deficit round robin, the tube at the front keeps its turn until its deficit has been used up
+        while self.pending and room > overhead and not (legacy and segments):
+            tube_idx = next(iter(self.pending))
+            if self.turn != tube_idx:
+                self.turn = tube_idx
+                # Every turn allows at least one byte past the frame overhead, however small the weight
+                quantum = max(int(self.quantum() * self.weight(tube_idx)), overhead + 1)
+                self.deficit[tube_idx] = self.deficit.get(tube_idx, 0) + quantum
+
+            left = self.take(tube_idx, segments, room, self.deficit[tube_idx], overhead, legacy)
+            # A tube closed in the meantime has been discarded along with its deficit
+            self.deficit[tube_idx] = self.deficit.get(tube_idx, 0) - (room - left)
+            room = left
+
+            if tube_idx not in self.pending:
+                # Idle tubes do not save up a deficit
+                self.deficit.pop(tube_idx, None)
+                self.turn = None
+            elif self.deficit[tube_idx] <= overhead:
+                self.pending.move_to_end(tube_idx)
+                self.turn = None
+            else:
+                # The record is full, the turn continues in the next payment
+                break
+
+        self.since = time.monotonic() if self.pending else None
+        return segments
+
+    def take(self, tube_idx: int, segments, room: int, budget: int, overhead: int, legacy: bool):
+        """
+        Cut pending data of a tube into packets, and conclude the tube once everything has been taken.
+        @param tube_idx: The index of the tube.
+        @param segments: The segments of the payment, extended in place.
+        @param room: The space left in the record.
+        @param budget: The space the tube may use.
+        @param overhead: The size of a frame header.
+        @param legacy: Whether the peer only accepts a single packet per record.
+        @return: The space left in the record.
+        """
+        # The tube may have been closed since the deleted tubes were discarded
+        tube = self.session.tubes.get(tube_idx)
+        if tube is None:
+            self.discard(tube_idx)
+            return room
+
+        runs = self.pending[tube_idx]
+        budget = min(budget, room)
+
+        # A frame carries a single run, as the flags apply to the whole payload
+        while runs and budget > overhead and not (legacy and segments):
+            flags, buffer = runs[0]
+            take = min(len(buffer), budget - overhead)
+            segment = (tube_idx, tube.assign_index(), bytes(buffer[:take]), flags)
+            tube.remember(*segment[1:])
+            segments.append(segment)
+            del buffer[:take]
+            self.size -= take
+            room -= take + overhead
+            budget -= take + overhead
+            if not buffer:
+                runs.popleft()
+
+        if runs:
+            return room
+
+        # Everything has been sent, conclude the tube with an empty packet when there is room for it
+        if tube_idx in self.closing:
+            if room < overhead or (legacy and segments):
+                return room
+            segment = (tube_idx, tube.assign_index(), b'', 0)
+            tube.remember(*segment[1:])
+            segments.append(segment)
+            self.closing.discard(tube_idx)
+            room -= overhead
+        del self.pending[tube_idx]
+        return room
+
+    def discard_deleted(self):
+        """
+        Drop the pending data of tubes that have been deleted in the meantime, it can no longer be delivered.
+        """
+        for tube_idx in list(self.pending):
+            if tube_idx not in self.session.tubes:
+                self.discard(tube_idx)
+
+    def discard(self, tube_idx: int):
+        """
+        Drop the pending data and state of a single tube.
+        @param tube_idx: The index of the tube.
+        """
+        self.size -= self.pending_size(tube_idx)
+        del self.pending[tube_idx]
+        self.closing.discard(tube_idx)
+        self.deficit.pop(tube_idx, None)
+        self.weights.pop(tube_idx, None)
+
+    def pending_size(self, tube_idx: int):
+        return sum(len(buffer) for _, buffer in self.pending[tube_idx])
+
+    def quantum(self):
+        """
+        The record space a tube of weight 1 gets per turn.
+        """
+        return self.capacity()
+
+    def weight(self, tube_idx: int):
+        """
+        The share of a tube in the round robin, set for the tube itself or else by the suffix of its hostname.
+        """
+        if tube_idx in self.weights:
+            return self.weights[tube_idx]
+
+        tube = self.session.tubes.get(tube_idx)
+        hostname = tube.hostname if tube is not None else None
+        for suffix, weight in self.host_weights.items():
+            if hostname and hostname.endswith(suffix):
+                return weight
+        return 1.0
+
+    def set_weight(self, tube_idx: int, weight: float):
+        """
+        Give a tube a larger or smaller share of the payments than the other bulk tubes.
+        @raise ValueError: When the weight is not positive.
+        """
+        check_weight(weight, tube_idx)
+        with self.lock:
+            self.weights[tube_idx] = weight
+
+    def take_control(self, segments, room: int):
+        """
+        Move pending session messages into a payment for as far as they fit.
+        @param segments: The segments of the payment, extended in place.
+        @param room: The space left in the record.
+        @return: The space left after adding the messages.
+        """
+        while self.control and framing.frame_size(len(self.control[0][1])) <= room:
+            _, message = self.control.popleft()
+            segments.append((0, 0, message, 0))
+            room -= framing.frame_size(len(message))
+        return room
+
+    def take_parity(self, segments, room: int):
+        """
+        Add parity packets to a payment, at most one per tube, taking turns in which tube goes first.
+        @param segments: The segments of the payment, extended in place.
+        @param room: The space left in the record.
+        @return: The space left after adding the parity packets.
+        """
+        tubes = list(self.session.tubes.values())
+        for i in range(len(tubes)):
+            if room <= framing.HEADER.size + fec.PARITY.size:
+                break
+            segment = tubes[(self.parity_turn + i) % len(tubes)].protect(self.fec_block, room - framing.HEADER.size)
+            if segment is not None:
+                segments.append(segment)
+                room -= framing.frame_size(len(segment[2]))
+
+        self.parity_turn += 1
+        return room
+
+    def close(self):
+        """
+        Stop handing out payments, waking up the throttle waiting for one.
+        """
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def empty(self):
+        return not self.pending and not self.retransmit
+
+    def qsize(self):
+        """
+        The approximate amount of payments needed for the pending data.
+        """
+        return -(-self.size // self.capacity()) + len(self.closing)
+
+
+class AioCoalescer(Coalescer):
+
+    def __init__(self, session, linger=0.005, high_water=256, fec_block=0, interactive_size=512, host_weights=None):
+        """
+        Asyncio counterpart of the Coalescer.
+        """
+        super().__init__(session, linger, high_water, fec_block, interactive_size, host_weights)
+        self.arrived = asyncio.Event()
+        self.space = asyncio.Event()
+
+    def write(self, tube_idx: int, data: bytes):
+        flags, data = self.compress(tube_idx, data)
+        self.add(tube_idx, data, flags)
+        self.arrived.set()
+
+    def post(self, message: bytes, delay: float = 0.0):
+        super().post(message, delay)
+        self.arrived.set()
+
+    def resend(self, segments):
+        super().resend(segments)
+        self.arrived.set()
+
+    async def get(self):
+        while True:
+            if self.ready():
+                segments = self.pack()
+                self.space.set()
+                if segments:
+                    return (segments,)
+
+            self.arrived.clear()
+            deadline = self.deadline()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), None if deadline is None else max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def drained(self):
+        """
+        Wait until the pending data drops below the high-water mark.
+        """
+        while self.qsize() >= self.high_water:
+            self.space.clear()
+            await self.space.wait()
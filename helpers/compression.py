@@ -0,0 +1,155 @@
+import lzma
+import zlib
+
+from helpers import packet as framing
+
+# Codecs in order of preference, and the frame flag marking data compressed by them
+CODECS = {
+    'zlib': framing.FLAG_ZLIB,
+    'lzma': framing.FLAG_LZMA,
+}
+
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+
+
+def negotiate_codecs(offered: str):
+    """
+    Select the codecs offered by the peer that are supported here, keeping the order of preference of the peer.
+    @param offered: comma separated codec names.
+    """
+    return [codec for codec in offered.split(',') if codec in CODECS]
+
+
+class TubeCompressor:
+
+    def __init__(self, codecs, probe=4, min_size=64, backoff=8, max_backoff=256):
+        """
+        Compresses the data of a single tube before it is cut into packets.
+        zlib keeps its history across blocks through a synchronised flush. lzma has no such flush, so every lzma
+        block is a self-contained stream. Blocks that do not shrink, such as TLS records, are sent as they are.
+        @param codecs: The codecs the peer is able to decode, in order of preference.
+        @param probe: The amount of blocks on which every codec is tried before settling on the best one.
+        @param min_size: Blocks smaller than this are never compressed.
+        @param backoff: The amount of blocks sent uncompressed after a block did not compress.
+        @param max_backoff: Upper limit of the backoff, which doubles for every consecutive miss.
+        """
+        self.codecs = list(codecs)
+        self.probe = probe
+        self.min_size = min_size
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.zlib = zlib.compressobj(6) if 'zlib' in self.codecs else None
+        self.scores = {codec: [0, 0] for codec in self.codecs}
+        self.codec = self.codecs[0] if self.codecs else None
+
+        self.backoff = 0
+        self.skip = 0
+        self.blocks = 0
+
+        # Bytes before and after compression, for reporting
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def attempt(self, codec, data: bytes):
+        """
+        Compress a block without committing to it.
+        @return: The compressed block, and the zlib state to continue with if it is kept.
+        """
+        if codec == 'zlib':
+            state = self.zlib.copy()
+            return state.compress(data) + state.flush(zlib.Z_SYNC_FLUSH), state
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS), None
+
+    def compress(self, data: bytes):
+        """
+        Compress a block of socket data.
+        @return: The frame flags and the data to be sent.
+        """
+        self.bytes_in += len(data)
+
+        if not self.codecs or len(data) < self.min_size or self.skip:
+            self.skip = max(self.skip - 1, 0)
+            self.bytes_out += len(data)
+            return 0, data
+
+        # Try every codec on the first blocks, afterwards only the one that did best
+        self.blocks += 1
+        candidates = self.codecs if self.blocks <= self.probe else [self.codec]
+
+        best = None
+        for codec in candidates:
+            compressed, state = self.attempt(codec, data)
+            score = self.scores[codec]
+            score[0] += len(data)
+            score[1] += len(compressed)
+            if best is None or len(compressed) < len(best[1]):
+                best = (codec, compressed, state)
+
+        if self.blocks == self.probe:
+            self.codec = min(self.scores, key=lambda c: self.scores[c][1] / max(self.scores[c][0], 1))
+
+        codec, compressed, state = best
+
+        # Not worth it, send the block as is and back off for a while
+        if len(compressed) >= len(data):
+            self.backoff = min(max(self.backoff * 2, self.initial_backoff), self.max_backoff)
+            self.skip = self.backoff
+            self.bytes_out += len(data)
+            return 0, data
+
+        self.backoff = 0
+        if state is not None:
+            self.zlib = state
+        self.bytes_out += len(compressed)
+        return CODECS[codec], compressed
+
+    @property
+    def ratio(self):
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+
+class TubeDecompressor:
+
+    def __init__(self):
+        """
+        Reverses TubeCompressor, packets have to be fed in order.
+        """
+        self.zlib = zlib.decompressobj()
+        self.lzma = None
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def decompress(self, flags: int, data: bytes):
+        """
+        @param flags: The flags of the frame the data arrived in.
+        @param data: The payload of the frame.
+        @return: The original data, possibly empty while a block is incomplete.
+        """
+        self.bytes_in += len(data)
+
+        if flags & framing.FLAG_ZLIB:
+            output = self.zlib.decompress(data)
+        elif flags & framing.FLAG_LZMA:
+            output = b''
+            while data:
+                if self.lzma is None:
+                    self.lzma = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+                output += self.lzma.decompress(data)
+
+                # A block ended within this packet, the remainder belongs to the next block
+                if self.lzma.eof:
+                    data = self.lzma.unused_data
+                    self.lzma = None
+                else:
+                    data = b''
+        else:
+            output = data
+
+        self.bytes_out += len(output)
+        return output
+
+    @property
+    def ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
@@ -0,0 +1,440 @@
+import errno
+import selectors
+import socket
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Attempt:
+
+    def __init__(self, hostname: str, port: int, callback, deadline: float):
+        """
+        A connection being set up to a host, racing its addresses against each other.
+        @param callback: Called with the connected socket and None, or None and the error once every address failed.
+        @param deadline: The moment at which the attempt is given up.
+        """
+        self.hostname = hostname
+        self.port = port
+        self.callback = callback
+        self.deadline = deadline
+
+        # Addresses that have not been tried yet, the sockets still connecting, and when to start on the next address
+        self.addresses = deque()
+        self.sockets = set()
+        self.next_at = 0.0
+        self.error = None
+        self.done = False
+
+
+def interleave(addresses):
+    """
+    Order resolved addresses by alternating the address families, starting with the family of the first address.
+    @param addresses: getaddrinfo results.
+    @return: list of (family, sockaddr) tuples.
+    """
+    families = OrderedDict()
+    for family, _, _, _, sockaddr in addresses:
+        families.setdefault(family, [])
+        if (family, sockaddr) not in families[family]:
+            families[family].append((family, sockaddr))
+
+    ordered = []
+    queues = [deque(entries) for entries in families.values()]
+    while any(queues):
+        for entries in queues:
+            if entries:
+                ordered.append(entries.popleft())
+    return ordered
+
+
+class Connector:
+
+    def __init__(self, timeout=10.0, attempt_delay=0.25, dns_ttl=60.0, negative_ttl=5.0, resolvers=4,
+                 pool_size=0, pool_after=3, pool_idle=15.0, pool_hosts=16, prewarm=(), logger=None):
+        """
+        Sets up outgoing connections from a thread of its own, so that callers never wait for DNS or a handshake.
+        Addresses are resolved on a small pool of threads and cached, the addresses of a host are then tried following
+        happy eyeballs: IPv6 and IPv4 alternate, and the next address is tried whenever the previous one failed or did
+        not connect within the attempt delay. The first connected socket wins and the others are closed.
+        Frequently requested hosts can be kept pre-connected, connections are then handed out straight from the pool.
+        @param timeout: Seconds after which a connection attempt is given up.
+        @param attempt_delay: Seconds to wait for an address to connect before racing the next one.
+        @param dns_ttl: Seconds resolved addresses are cached, getaddrinfo does not tell the TTL of the records.
+        @param negative_ttl: Seconds a failed resolution is cached.
+        @param resolvers: The amount of threads resolving addresses.
+        @param pool_size: The amount of idle connections kept per pooled host, 0 disables the pool.
+        @param pool_after: The amount of requests after which a host is pooled.
+        @param pool_idle: Seconds after which an idle pooled connection is closed, before the host is likely to do so.
+        @param pool_hosts: The maximum amount of pooled hosts.
+        @param prewarm: (hostname, port) tuples that are pooled from the start.
+        @param logger: The logger reporting unexpected errors of the connecting thread, printed when None.
+        """
+        self.logger = logger
+        self.timeout = timeout
+        self.attempt_delay = attempt_delay
+        self.dns_ttl = dns_ttl
+        self.negative_ttl = negative_ttl
+        self.resolvers = ThreadPoolExecutor(max_workers=resolvers, thread_name_prefix='resolver')
+
+        # (hostname, port) to the moment the entry expires and the addresses or the resolution error,
+        # and the callbacks waiting for a resolution that is under way
+        self.cache = {}
+        self.resolving = {}
+
+        # Pool of idle connections per host as (connected since, socket) tuples, the amount of connections being set up
+        # for it, and the recent request counts per host that decide which hosts are pooled
+        self.pool_size = pool_size
+        self.pool_after = pool_after
+        self.pool_idle = pool_idle
+        self.pool_hosts = pool_hosts
+        self.pool = {}
+        self.warming = {}
+        self.requests = OrderedDict()
+
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.attempts = []
+        self.incoming = deque()
+
+        # Self-pipe waking up the connecting thread when attempts are added
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+        for hostname, port in prewarm:
+            self.requests[(hostname, port)] = pool_after
+            self.warm(hostname, port)
+
+    def connect(self, hostname: str, port: int, callback):
+        """
+        Connect to a host without blocking, the callback is called from the connecting thread once done,
+        or right away when a pooled connection is available.
+        @param hostname: The name or address of the host.
+        @param port: The port to connect to.
+        @param callback: Called with the connected non-blocking socket and None, or with None and the error.
+        """
+        key = (hostname, port)
+        self.count(key)
+
+        sock = self.take_pooled(key)
+        if sock is not None:
+            callback(sock, None)
+            self.warm(hostname, port)
+            return
+
+        self.resolve(hostname, port, lambda addresses, error: self.start(hostname, port, addresses, error, callback))
+        self.warm(hostname, port)
+
+    def resolve(self, hostname: str, port: int, callback):
+        """
+        Look up the addresses of a host, from the cache when possible.
+        @param callback: Called with the getaddrinfo results and None, or with None and the error.
+        """
+        key = (hostname, port)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                cached = entry
+            else:
+                cached = None
+                # Lookups of the same host share a single resolution
+                waiting = self.resolving.get(key)
+                if waiting is not None:
+                    waiting.append(callback)
+                    return
+                self.resolving[key] = [callback]
+
+        if cached is not None:
+            _, addresses, error = cached
+            callback(addresses, error)
+            return
+
+        self.resolvers.submit(self.lookup, hostname, port)
+
+    def lookup(self, hostname: str, port: int):
+        """
+        Resolve a host on a resolver thread, cache the outcome and hand it to the waiting callbacks.
+        """
+        key = (hostname, port)
+        try:
+            addresses = socket.getaddrinfo(hostname, port, type=socket.SOCK_STREAM)
+            error = None
+            expires = time.monotonic() + self.dns_ttl
+        except OSError as e:
+            addresses = None
+            error = e
+            expires = time.monotonic() + self.negative_ttl
+
+        with self.lock:
+            self.cache[key] = (expires, addresses, error)
+            callbacks = self.resolving.pop(key, [])
+
+            # Expired entries are dropped now and then, keeping the cache from growing with every host ever seen
+            if len(self.cache) > 4096:
+                now = time.monotonic()
+                self.cache = {k: v for k, v in self.cache.items() if v[0] > now}
+
+        for callback in callbacks:
+            callback(addresses, error)
+
+    def start(self, hostname: str, port: int, addresses, error, callback):
+        """
+        Hand a resolved host to the connecting thread.
+        """
+        if error is not None:
+            callback(None, error)
+            return
+
+        attempt = Attempt(hostname, port, callback, time.monotonic() + self.timeout)
+        attempt.addresses.extend(interleave(addresses))
+        self.incoming.append(attempt)
+        try:
+            self.wake_w.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def loop(self):
+        """
+        The connecting thread, racing the addresses of every attempt and completing them.
+        An unexpected error only fails the attempt it occurred in, the thread keeps serving the others.
+        """
+        while self.running:
+            try:
+                self.step()
+            except Exception as e:
+                self.report(f'Unexpected error in the connecting thread: {e!r}')
+                # Do not spin on an error that keeps recurring
+                time.sleep(0.1)
+
+    def step(self):
+        """
+        A single round of the connecting thread: wait for sockets or deadlines, then advance every attempt.
+        """
+        now = time.monotonic()
+        due = [attempt.deadline for attempt in self.attempts]
+        due += [attempt.next_at for attempt in self.attempts if attempt.addresses]
+        timeout = max(min(due) - now, 0) if due else self.pool_idle
+
+        for key, events in self.selector.select(timeout):
+            if key.data is None:
+                try:
+                    while self.wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+
+            self.guarded(key.data, self.check, key.data, key.fileobj)
+
+        while self.incoming:
+            self.attempts.append(self.incoming.popleft())
+
+        now = time.monotonic()
+        for attempt in self.attempts:
+            if not attempt.done:
+                self.guarded(attempt, self.advance, attempt, now)
+        self.attempts = [attempt for attempt in self.attempts if not attempt.done]
+
+        self.expire_pool()
+
+    def advance(self, attempt: Attempt, now: float):
+        """
+        Give up an attempt past its deadline or out of addresses, or race its next address when due.
+        """
+        if now >= attempt.deadline:
+            self.finish(attempt, None, attempt.error or TimeoutError(f'Connecting to {attempt.hostname} timed out'))
+        elif attempt.addresses and (now >= attempt.next_at or not attempt.sockets):
+            self.try_next(attempt)
+        elif not attempt.addresses and not attempt.sockets:
+            self.finish(attempt, None, attempt.error or OSError(f'No addresses for {attempt.hostname}'))
+
+    def guarded(self, attempt: Attempt, function, *args):
+        """
+        Call a function advancing an attempt, failing only that attempt when it raises unexpectedly.
+        """
+        try:
+            function(*args)
+        except Exception as e:
+            self.report(f'Unexpected error connecting to {attempt.hostname}: {e!r}')
+            if not attempt.done:
+                self.finish(attempt, None, e)
+
+    def report(self, message: str):
+        if self.logger is not None:
+            self.logger.log_error(message)
+        else:
+            traceback.print_exc()
+
+    def try_next(self, attempt: Attempt):
+        """
+        Start connecting to the next address of an attempt.
+        """
+        family, sockaddr = attempt.addresses.popleft()
+        attempt.next_at = time.monotonic() + self.attempt_delay
+        try:
+            # Fails for address families the host does not support, such as IPv6 on hosts without it
+            sock = socket.socket(family, socket.SOCK_STREAM)
+        except OSError as e:
+            attempt.error = e
+            attempt.next_at = 0.0
+            return
+        sock.setblocking(False)
+
+        error = sock.connect_ex(sockaddr)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            attempt.error = OSError(error, f'Connecting to {sockaddr[0]} failed: {errno.errorcode.get(error, error)}')
+            sock.close()
+            # Move on to the next address right away
+            attempt.next_at = 0.0
+            return
+
+        attempt.sockets.add(sock)
+        self.selector.register(sock, selectors.EVENT_WRITE, attempt)
+
+    def check(self, attempt: Attempt, sock: socket.socket):
+        """
+        A socket of an attempt became writable, meaning it either connected or failed.
+        """
+        self.selector.unregister(sock)
+        attempt.sockets.discard(sock)
+
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            attempt.error = OSError(error, f'Connecting to {attempt.hostname} failed: {errno.errorcode.get(error, error)}')
+            sock.close()
+            # The next address is raced right away instead of after the attempt delay
+            attempt.next_at = 0.0
+            return
+
+        self.finish(attempt, sock, None)
+
+    def finish(self, attempt: Attempt, sock, error):
+        """
+        Complete an attempt, closing the sockets that lost the race.
+        """
+        attempt.done = True
+        for other in attempt.sockets:
+            try:
+                self.selector.unregister(other)
+            except (KeyError, ValueError):
+                pass
+            other.close()
+        attempt.sockets.clear()
+
+        try:
+            attempt.callback(sock, error)
+        except Exception as e:
+            self.report(f'The callback of the connection to {attempt.hostname} failed: {e!r}')
+            if sock is not None:
+                sock.close()
+
+    def count(self, key):
+        """
+        Count a request for a host, only the most recently requested hosts are remembered.
+        """
+        with self.lock:
+            self.requests[key] = self.requests.pop(key, 0) + 1
+            if len(self.requests) > 1024:
+                self.requests.popitem(last=False)
+
+    def pooled(self, key):
+        """
+        Whether idle connections are kept for a host.
+        """
+        if not self.pool_size or self.requests.get(key, 0) < self.pool_after:
+            return False
+        return key in self.pool or len(self.pool) < self.pool_hosts
+
+    def warm(self, hostname: str, port: int):
+        """
+        Top up the idle connections of a host, if it is requested often enough to be pooled.
+        """
+        key = (hostname, port)
+        with self.lock:
+            if not self.pooled(key):
+                return
+            idle = self.pool.setdefault(key, deque())
+            wanted = self.pool_size - len(idle) - self.warming.get(key, 0)
+            if wanted <= 0:
+                return
+            self.warming[key] = self.warming.get(key, 0) + wanted
+
+        for _ in range(wanted):
+            self.resolve(hostname, port, lambda addresses, error: self.start(
+                hostname, port, addresses, error, lambda sock, e: self.add_pooled(key, sock)))
+
+    def add_pooled(self, key, sock):
+        with self.lock:
+            self.warming[key] = max(self.warming.get(key, 0) - 1, 0)
+            if sock is not None:
+                self.pool.setdefault(key, deque()).append((time.monotonic(), sock))
+
+    def take_pooled(self, key):
+        """
+        Take an idle connection to a host that is still open.
+        @return: The socket, None if there is none.
+        """
+        while True:
+            with self.lock:
+                idle = self.pool.get(key)
+                if not idle:
+                    return None
+                since, sock = idle.popleft()
+
+            if time.monotonic() - since < self.pool_idle and alive(sock):
+                return sock
+            sock.close()
+
+    def expire_pool(self):
+        """
+        Close the idle connections that have been waiting for too long, and forget the hosts no longer pooled.
+        """
+        if not self.pool:
+            return
+
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for key, idle in list(self.pool.items()):
+                while idle and now - idle[0][0] >= self.pool_idle:
+                    expired.append(idle.popleft()[1])
+                if not idle and not self.warming.get(key):
+                    del self.pool[key]
+        for sock in expired:
+            sock.close()
+
+    def stop(self):
+        """
+        Stop connecting, and close the pooled connections.
+        """
+        self.running = False
+        try:
+            self.wake_w.send(b'\0')
+        except BlockingIOError:
+            pass
+        self.resolvers.shutdown(wait=False)
+        with self.lock:
+            for idle in self.pool.values():
+                for _, sock in idle:
+                    sock.close()
+            self.pool.clear()
+
+
+def alive(sock: socket.socket):
+    """
+    Whether an idle connection is still open, without consuming any data.
+    """
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b''
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
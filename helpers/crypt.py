@@ -1,6 +1,8 @@
 import secrets
 import hashlib
+import threading
 import time
+from collections import deque
 
 
 class Crypt:
@@ -18,3 +20,52 @@ class Crypt:
             yield preimage, phash
 
 
+class PreimagePool:
+
+    def __init__(self, batch_size=256, low_water=64):
+        """
+        Pre-generated preimage and hash pairs for keysend payments, refilled in the background.
+        Pairs are handed out by popping from a deque, which is atomic, so any amount of senders can take them without locking.
+        @param batch_size: The amount of pairs generated in one go.
+        @param low_water: The amount of pairs left at which the pool is refilled.
+        """
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self.pairs = deque()
+
+        # Set whenever the pool runs low, waking up the refilling thread
+        self.wanted = threading.Event()
+
+        self.pairs.extend(self.generate(batch_size))
+        threading.Thread(target=self.refiller, daemon=True).start()
+
+    def generate(self, amount):
+        """
+        Create preimages and their hashes, the randomness of the whole batch is drawn at once.
+        @return: list of (preimage, hash) tuples.
+        """
+        randomness = secrets.token_bytes(32 * amount)
+        preimages = [randomness[i:i + 32] for i in range(0, len(randomness), 32)]
+        return [(preimage, hashlib.sha256(preimage).digest()) for preimage in preimages]
+
+    def take(self):
+        """
+        Hand out an unused preimage and hash pair.
+        @return: tuple of preimage and hash.
+        """
+        try:
+            pair = self.pairs.popleft()
+        except IndexError:
+            # The pool ran dry before the refill caught up, create a pair on the spot
+            pair = self.generate(1)[0]
+
+        if len(self.pairs) < self.low_water:
+            self.wanted.set()
+        return pair
+
+    def refiller(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            while len(self.pairs) < self.low_water + self.batch_size:
+                self.pairs.extend(self.generate(self.batch_size))
@@ -0,0 +1,59 @@
+import struct
+
+# [count][length][flags] followed by the XOR of the payloads, each padded to the longest one
+# count = 1 byte amount of consecutive packets covered, starting at the packet index of the parity frame
+# length = 2 bytes XOR of the payload lengths
+# flags = 1 byte XOR of the frame flags
+PARITY = struct.Struct('!BHB')
+
+
+def xor(blocks):
+    """
+    XOR byte strings of possibly different lengths, the shorter ones are padded with zeroes.
+    """
+    size = max((len(block) for block in blocks), default=0)
+    value = 0
+    for block in blocks:
+        value ^= int.from_bytes(block.ljust(size, b'\0'), 'big')
+    return value.to_bytes(size, 'big')
+
+
+def encode_parity(packets) -> bytes:
+    """
+    Build the parity of a block of packets, which allows a single lost packet of the block to be rebuilt.
+    @param packets: list of (data, flags) tuples of consecutive packets.
+    @return: The payload of the parity frame.
+    """
+    length = flags = 0
+    for data, packet_flags in packets:
+        length ^= len(data)
+        flags ^= packet_flags
+    return PARITY.pack(len(packets), length, flags) + xor([data for data, _ in packets])
+
+
+def parity_size(packets) -> int:
+    """
+    The size of the parity payload of a block of packets.
+    """
+    return PARITY.size + max((len(data) for data, _ in packets), default=0)
+
+
+def parity_count(payload: bytes) -> int:
+    """
+    The amount of packets covered by a parity payload.
+    """
+    return payload[0]
+
+
+def recover(payload: bytes, others):
+    """
+    Rebuild the single missing packet of a block.
+    @param payload: The payload of the parity frame.
+    @param others: list of (data, flags) tuples of every other packet of the block.
+    @return: The data and flags of the missing packet.
+    """
+    _, length, flags = PARITY.unpack_from(payload)
+    for data, packet_flags in others:
+        length ^= len(data)
+        flags ^= packet_flags
+    return xor([payload[PARITY.size:]] + [data for data, _ in others])[:length], flags
@@ -0,0 +1,507 @@
+import hashlib
+import json
+import math
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from helpers.metrics import Registry
+
+# Largest request or response head accepted, in bytes
+MAX_HEAD = 65536
+# Responses that may be stored when they carry freshness information or a validator
+CACHEABLE_STATUS = {200, 203, 300, 301, 404, 410}
+# Hop-by-hop headers of the client, replaced when the request is forwarded
+HOP_HEADERS = {'connection', 'proxy-connection', 'keep-alive', 'proxy-authorization', 'te', 'upgrade'}
+
+
+class HeadReader:
+
+    def __init__(self, timeout=5.0):
+        """
+        Collects the request head of a freshly accepted connection as it arrives, reading only when the connection is
+        readable so the proxy loop never waits for a client. The body may follow in the same read.
+        @param timeout: Seconds the client has to send its head, what has arrived by then is taken as is.
+        """
+        self.data = bytearray()
+        self.deadline = time.monotonic() + timeout
+
+    def read(self, connection: socket.socket):
+        """
+        Take what a readable connection has to offer.
+        @return: Whether reading is over, the head is complete or the client stopped sending or sent too much.
+        @raise OSError: When reading from the connection fails.
+        """
+        try:
+            chunk = connection.recv(16384)
+        except BlockingIOError:
+            return False
+        self.data += chunk
+        return not chunk or b'\r\n\r\n' in self.data or len(self.data) >= MAX_HEAD
+
+    def expired(self, now: float):
+        return now >= self.deadline
+
+
+def parse_head(data: bytes):
+    """
+    Parse the start line and the headers of an HTTP message.
+    @return: (start line, dict of lowercase header names to values, length of the head), None while incomplete.
+    """
+    end = data.find(b'\r\n\r\n')
+    if end < 0:
+        return None
+
+    lines = data[:end].decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name, value = name.strip().lower(), value.strip()
+        headers[name] = f'{headers[name]}, {value}' if name in headers else value
+    return lines[0], headers, end + 4
+
+
+def cache_control(headers: dict):
+    """
+    The directives of the Cache-Control header, valueless directives map to True.
+    """
+    directives = {}
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') if value else True
+    return directives
+
+
+def http_date(value):
+    """
+    @return: The epoch time of an HTTP date, None when missing or malformed.
+    """
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers: dict, now: float):
+    """
+    The seconds a response stays fresh, from max-age or Expires, or a tenth of its age since Last-Modified.
+    """
+    directives = cache_control(headers)
+    if 'no-cache' in directives:
+        return 0
+    if 'max-age' in directives:
+        try:
+            return max(int(directives['max-age']), 0)
+        except ValueError:
+            return 0
+
+    date = http_date(headers.get('date')) or now
+    if 'expires' in headers:
+        expires = http_date(headers['expires'])
+        return max(expires - date, 0) if expires is not None else 0
+
+    last_modified = http_date(headers.get('last-modified'))
+    if last_modified is not None:
+        return max((date - last_modified) / 10, 0)
+    return 0
+
+
+def response_age(headers: dict, now: float):
+    """
+    The seconds a response has already spent on its way, by its Age header or its Date, whichever is older.
+    """
+    try:
+        age = max(int(headers.get('age', '0')), 0)
+    except ValueError:
+        age = 0
+    date = http_date(headers.get('date'))
+    return max(age, now - date if date is not None else 0)
+
+
+class Request:
+
+    def __init__(self, method: str, url: str, hostname: str, port: int, path: str, headers: dict, body: bytes):
+        """
+        A request of a client in the absolute form used towards forward proxies.
+        @param body: Whatever followed the head in the first read, passed on as is.
+        """
+        self.method = method
+        self.url = url
+        self.hostname = hostname
+        self.port = port
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    @classmethod
+    def parse(cls, data: bytes):
+        """
+        @return: The request, None when the head is incomplete or the request is not addressed to a proxy.
+        """
+        parsed = parse_head(data)
+        if parsed is None:
+            return None
+        start, headers, length = parsed
+
+        parts = start.split(' ')
+        if len(parts) != 3:
+            return None
+        method, target, _ = parts
+
+        # Tunnels keep the authority form, plain requests carry the full URL
+        if method == 'CONNECT':
+            hostname, _, port = target.rpartition(':')
+            return cls(method, target, hostname, int(port) if port.isdigit() else 443, '', headers, data[length:])
+        if not target.startswith('http://'):
+            return None
+
+        authority, slash, path = target[len('http://'):].partition('/')
+        hostname, _, port = authority.partition(':')
+        return cls(method, target, hostname, int(port) if port.isdigit() else 80, slash + path or '/', headers,
+                   data[length:])
+
+    def forward(self, conditional: dict = None):
+        """
+        The request as sent to the host, in origin form on a connection that closes after the response.
+        @param conditional: Headers turning the request into a revalidation of a cached response.
+        """
+        headers = {name: value for name, value in self.headers.items() if name not in HOP_HEADERS}
+        headers['host'] = self.headers.get('host', self.hostname)
+        headers['connection'] = 'close'
+        headers.update(conditional or {})
+
+        head = f'{self.method} {self.path} HTTP/1.1\r\n' + ''.join(f'{n}: {v}\r\n' for n, v in headers.items())
+        return (head + '\r\n').encode('latin-1') + self.body
+
+    def cacheable(self):
+        """
+        Whether the response to this request may be served from or stored in the cache.
+        """
+        directives = cache_control(self.headers)
+        return self.method == 'GET' and 'authorization' not in self.headers and 'no-store' not in directives
+
+    def max_age(self):
+        """
+        The age in seconds up to which the client accepts a stored response without a revalidation, None for any fresh
+        response. no-cache and max-age=0 make every stored response go past the host.
+        """
+        directives = cache_control(self.headers)
+        if 'no-cache' in directives or 'no-cache' in self.headers.get('pragma', ''):
+            return 0
+        if 'max-age' in directives:
+            try:
+                return max(int(directives['max-age']), 0)
+            except ValueError:
+                return 0
+        return None
+
+
+class CacheEntry:
+
+    def __init__(self, url, size, expires, etag=None, last_modified=None, vary=None, generated=None):
+        """
+        The index record of a stored response, the response itself is kept in a file of the cache directory.
+        @param expires: Epoch time after which the response has to be revalidated.
+        @param vary: dict of the request headers named by Vary to their values, the response only serves matching requests.
+        @param generated: Epoch time the host sent the response, its age counts from there. None for the index records
+        of earlier versions.
+        """
+        self.url = url
+        self.size = size
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.vary = vary or {}
+        self.generated = generated
+
+    @property
+    def filename(self):
+        return hashlib.sha256(self.url.encode()).hexdigest() + '.http'
+
+    def fresh(self, now: float = None, request: Request = None):
+        """
+        Whether the response may be served without asking the host.
+        @param request: The request to serve, which may ask for a younger response or a revalidation.
+        """
+        now = now or time.time()
+        if now >= self.expires:
+            return False
+        limit = request.max_age() if request is not None else None
+        return limit is None or (self.generated is not None and now - self.generated <= limit)
+
+    def matches(self, request: Request):
+        return all(request.headers.get(name) == value for name, value in self.vary.items())
+
+    def validators(self):
+        """
+        The headers revalidating the stored response with the host.
+        """
+        conditional = {}
+        if self.etag:
+            conditional['if-none-match'] = self.etag
+        if self.last_modified:
+            conditional['if-modified-since'] = self.last_modified
+        return conditional
+
+
+class HttpCache:
+
+    def __init__(self, directory: str, max_bytes=64 * 2 ** 20, metrics: Registry = None, payment_cost=None,
+                 chunk_size=None):
+        """
+        Size-bounded cache of HTTP responses on disk, evicting the least recently used responses first.
+        Responses are stored as received, so they are replayed to the client byte for byte. The index survives restarts.
+        @param directory: The directory holding the responses and the index, created when missing.
+        @param max_bytes: The maximum size of the stored responses together, a single response may take an eighth.
+        @param metrics: Registry receiving the counters of the cache.
+        @param payment_cost: Callable returning the average cost of a payment in sat, to report the sats saved.
+        @param chunk_size: Callable returning the amount of bytes a payment carries, to count the payments saved.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry = max_bytes // 8
+        self.chunk_size = chunk_size
+        self.index_path = os.path.join(directory, 'index.json')
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+        m = metrics if metrics is not None else Registry()
+        self.requests = m.counter('cache_requests_total', 'Plain HTTP requests by cache outcome', ('result',))
+        self.bytes_served = m.counter('cache_bytes_served_total', 'Response bytes served from the cache')
+        self.payments_saved = m.counter('cache_payments_saved_total', 'Payments avoided by serving from the cache')
+        self.evictions = m.counter('cache_evictions_total', 'Responses evicted to stay within the size bound')
+        m.gauge('cache_entries', 'Responses stored', function=lambda: len(self.entries))
+        m.gauge('cache_size_bytes', 'Bytes of responses stored', function=lambda: self.size)
+        m.gauge('cache_hit_ratio', 'Share of cacheable requests answered without transferring the response',
+                function=self.hit_ratio)
+        if payment_cost is not None:
+            m.gauge('cache_sats_saved', 'Estimated sats saved by serving from the cache',
+                    function=lambda: self.payments_saved.value() * payment_cost())
+
+    def load(self):
+        """
+        Read the index of a previous run, skipping responses whose file has gone missing.
+        """
+        try:
+            with open(self.index_path) as file:
+                records = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        for record in records:
+            entry = CacheEntry(**record)
+            path = os.path.join(self.directory, entry.filename)
+            if os.path.exists(path):
+                self.entries[entry.url] = entry
+                self.size += entry.size
+
+    def save(self):
+        """
+        Write the index in least recently used order, replacing the previous one at once.
+        """
+        temporary = f'{self.index_path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump([vars(entry) for entry in self.entries.values()], file)
+        os.replace(temporary, self.index_path)
+
+    def hit_ratio(self):
+        hits = self.requests.value(result='hit') + self.requests.value(result='revalidated')
+        total = hits + self.requests.value(result='miss')
+        return hits / total if total else None
+
+    def served(self, result: str, size: int):
+        """
+        Count a response served from the cache.
+        @param result: 'hit' for a fresh response, the request was not sent at all, or 'revalidated' for a stored response
+        confirmed by the host, which took a single payment for its confirmation.
+        @param size: The size of the response.
+        """
+        self.requests.inc(result=result)
+        self.bytes_served.inc(size)
+        if self.chunk_size is not None:
+            payments = math.ceil(size / self.chunk_size())
+            self.payments_saved.inc(payments + 1 if result == 'hit' else max(payments - 1, 0))
+
+    def lookup(self, request: Request):
+        """
+        @return: The entry stored for the request, fresh or not, None when there is none.
+        """
+        with self.lock:
+            entry = self.entries.get(request.url)
+            if entry is None or not entry.matches(request):
+                return None
+            self.entries.move_to_end(request.url)
+            return entry
+
+    def read(self, entry: CacheEntry):
+        """
+        @return: The stored response, None when its file could not be read.
+        """
+        try:
+            with open(os.path.join(self.directory, entry.filename), 'rb') as file:
+                return file.read()
+        except OSError:
+            self.remove(entry.url)
+            return None
+
+    def storable(self, request: Request, status: int, headers: dict):
+        """
+        Whether a response may be stored, it needs to be fresh for a while or carry a validator to be of any use.
+        """
+        directives = cache_control(headers)
+        if not request.cacheable() or status not in CACHEABLE_STATUS:
+            return False
+        if 'no-store' in directives or 'set-cookie' in headers or headers.get('vary', '').strip() == '*':
+            return False
+        return bool(freshness_lifetime(headers, time.time()) or 'etag' in headers or 'last-modified' in headers)
+
+    def store(self, request: Request, headers: dict, response: bytes):
+        """
+        Store a complete response, evicting the least recently used ones to make room.
+        """
+        if len(response) > self.max_entry:
+            return
+
+        vary = {name.strip().lower(): request.headers.get(name.strip().lower())
+                for name in headers.get('vary', '').split(',') if name.strip()}
+        # Time spent in other caches on the way counts against the freshness
+        now = time.time()
+        generated = now - response_age(headers, now)
+        entry = CacheEntry(request.url, len(response), generated + freshness_lifetime(headers, now),
+                           headers.get('etag'), headers.get('last-modified'), vary, generated)
+
+        path = os.path.join(self.directory, entry.filename)
+        with open(f'{path}.tmp', 'wb') as file:
+            file.write(response)
+        os.replace(f'{path}.tmp', path)
+
+        with self.lock:
+            previous = self.entries.pop(entry.url, None)
+            if previous is not None:
+                self.size -= previous.size
+            self.entries[entry.url] = entry
+            self.size += entry.size
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions.inc()
+                try:
+                    os.remove(os.path.join(self.directory, evicted.filename))
+                except OSError:
+                    pass
+            self.save()
+
+    def refresh(self, entry: CacheEntry, headers: dict):
+        """
+        The host confirmed a stored response is still valid, extend its freshness by the headers of the confirmation.
+        """
+        now = time.time()
+        with self.lock:
+            entry.generated = now - response_age(headers, now)
+            entry.expires = entry.generated + freshness_lifetime(headers, now)
+            entry.etag = headers.get('etag', entry.etag)
+            self.save()
+
+    def remove(self, url: str):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is None:
+                return
+            self.size -= entry.size
+            self.save()
+        try:
+            os.remove(os.path.join(self.directory, entry.filename))
+        except OSError:
+            pass
+
+
+class Exchange:
+
+    def __init__(self, cache: HttpCache, request: Request, entry: CacheEntry = None):
+        """
+        Follows the response of a plain HTTP request on its way to the client, storing it when it is cacheable.
+        @param entry: The stored response being revalidated, replayed to the client when the host confirms it.
+        """
+        self.cache = cache
+        self.request = request
+        self.entry = entry
+
+        self.head = bytearray()
+        self.headers = None
+        self.response = None
+        # Whether the rest of the response is discarded, after replaying the stored one
+        self.replayed = False
+        self.done = False
+
+    def feed(self, data, ended=False):
+        """
+        Pass the next in-order data of the tube.
+        @param ended: Whether the host closed the connection, the tube delivered its last packet. Empty data alone does
+        not tell, the codec may hold data back.
+        @return: The bytes to write to the client, None when there is no data.
+        """
+        if ended:
+            self.finish()
+            return data
+        if not data:
+            return data
+        if self.replayed:
+            return b''
+
+        if self.headers is None:
+            self.head += data
+            parsed = parse_head(self.head)
+            if parsed is None:
+                if len(self.head) < MAX_HEAD:
+                    return b''
+                parsed = ('', {}, 0)
+            start, self.headers, _ = parsed
+            data, self.head = bytes(self.head), None
+
+            status = start.split(' ', 2)[1] if start.count(' ') >= 1 else ''
+            status = int(status) if status.isdigit() else 0
+
+            # The stored response is still valid, the client gets it in full as it did not ask for a revalidation
+            if status == 304 and self.entry is not None:
+                stored = self.cache.read(self.entry)
+                if stored is not None:
+                    self.cache.refresh(self.entry, self.headers)
+                    self.cache.served('revalidated', len(stored))
+                    self.replayed = True
+                    return stored
+            if self.entry is not None:
+                self.cache.requests.inc(result='miss')
+
+            if self.cache.storable(self.request, status, self.headers):
+                self.response = bytearray()
+
+        if self.response is not None:
+            self.response += data
+            if len(self.response) > self.cache.max_entry:
+                self.response = None
+        return data
+
+    def finish(self):
+        """
+        The host closed the connection, store the response if it arrived in full.
+        """
+        if self.done or self.response is None:
+            return
+        self.done = True
+
+        body = len(self.response) - (self.response.find(b'\r\n\r\n') + 4)
+        length = self.headers.get('content-length')
+        if length is not None and (not length.isdigit() or int(length) != body):
+            return
+        if 'chunked' in self.headers.get('transfer-encoding', '') and not self.response.endswith(b'0\r\n\r\n'):
+            return
+        self.cache.store(self.request, self.headers, bytes(self.response))
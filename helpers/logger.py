@@ -1,3 +1,16 @@
+import atexit
+import json
+import queue
+import threading
+import time
+
+# Log levels, messages below the level of the logger are discarded
+DEBUG = 10
+INFO = 20
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'error': ERROR}
+
+
 class LogColors:
     OKBLUE = '\033[34m'
     OKGREEN = '\033[32m'
@@ -10,18 +23,150 @@ class LogColors:
 
 class Logger:
 
-    def __init__(self, owner: str):
+    def __init__(self, owner: str, level=INFO, path: str = None, console=True, buffer=4096,
+                 sampling=None, rate_limits=None):
+        """
+        Logs from a background thread, so that neither the socket loop nor the payment threads wait for the terminal.
+        Records are buffered up to a bound, beyond which they are dropped and counted rather than blocking the caller.
+        Per-packet messages are logged at the DEBUG level, hot paths check the debug attribute before building them.
+        @param owner: The name shown in front of every message.
+        @param level: The lowest level logged, either one of the level constants or its name.
+        @param path: File to append the records to as JSON lines, None to not write a file.
+        @param console: Whether to print the records to the terminal.
+        @param buffer: The maximum amount of records waiting to be written.
+        @param sampling: dict of category to n, only one in n messages of the category is logged.
+        @param rate_limits: dict of category to the maximum amount of messages per second, the excess is dropped.
+        """
         self.owner = owner
         self.length = 50
+        self.level = LEVELS.get(level, level)
+        self.debug = self.level <= DEBUG
+
+        self.console = console
+        self.file = open(path, 'a') if path is not None else None
+
+        self.sampling = sampling or {}
+        self.seen = {}
+        self.rate_limits = rate_limits or {}
+        # Token bucket per rate limited category: (tokens, last refill)
+        self.buckets = {}
+        # Guards the sampling state and the count of dropped records, both shared by every logging thread
+        self.lock = threading.Lock()
+
+        self.records = queue.Queue(maxsize=buffer)
+        self.dropped = 0
+
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def set_level(self, level):
+        self.level = LEVELS.get(level, level)
+        self.debug = self.level <= DEBUG
 
     def log_error(self, message):
-        print(f'{f"{LogColors.FAIL}[{self.owner}]": <46}   {message}{LogColors.ENDC}')
+        if self.level <= ERROR:
+            self.emit(ERROR, 'error', None, message)
 
     def log_inform(self, message):
-        print(f'{f"{LogColors.INFORM}[{self.owner}]{LogColors.ENDC}": <50}   {message}')
+        if self.level <= INFO:
+            self.emit(INFO, 'inform', None, message)
+
+    def log_debug(self, message, category='debug'):
+        if self.debug:
+            self.emit(DEBUG, category, None, message)
 
     def log_receive(self, source, message):
-        print(f'{f"{LogColors.OKGREEN}[{source} → {self.owner}]{LogColors.ENDC}": <50}   {message}')
+        if self.debug:
+            self.emit(DEBUG, 'receive', source, message)
 
     def log_send(self, dest, message):
-        print(f'{f"{LogColors.OKBLUE}[{self.owner} → {dest}]{LogColors.ENDC}": <50}   {message}')
+        if self.debug:
+            self.emit(DEBUG, 'send', dest, message)
+
+    def allowed(self, category: str):
+        """
+        Apply the sampling and the rate limit of a category.
+        @return: Whether the message is to be logged.
+        """
+        with self.lock:
+            every = self.sampling.get(category)
+            if every:
+                seen = self.seen.get(category, 0)
+                self.seen[category] = seen + 1
+                if seen % every:
+                    return False
+
+            rate = self.rate_limits.get(category)
+            if rate:
+                now = time.monotonic()
+                tokens, last = self.buckets.get(category, (rate, now))
+                tokens = min(rate, tokens + (now - last) * rate)
+                if tokens < 1:
+                    self.buckets[category] = (tokens, now)
+                    return False
+                self.buckets[category] = (tokens - 1, now)
+        return True
+
+    def emit(self, level: int, category: str, peer, message):
+        """
+        Hand a record to the writer thread, dropping it if the buffer is full.
+        """
+        if (self.sampling or self.rate_limits) and not self.allowed(category):
+            return
+        try:
+            self.records.put_nowait((time.time(), level, category, peer, message))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def format(self, category: str, peer, message):
+        if category == 'error':
+            return f'{f"{LogColors.FAIL}[{self.owner}]": <46}   {message}{LogColors.ENDC}'
+        if category == 'receive':
+            return f'{f"{LogColors.OKGREEN}[{peer} → {self.owner}]{LogColors.ENDC}": <50}   {message}'
+        if category == 'send':
+            return f'{f"{LogColors.OKBLUE}[{self.owner} → {peer}]{LogColors.ENDC}": <50}   {message}'
+        return f'{f"{LogColors.INFORM}[{self.owner}]{LogColors.ENDC}": <50}   {message}'
+
+    def write(self, record):
+        timestamp, level, category, peer, message = record
+        if self.console:
+            print(self.format(category, peer, message))
+        if self.file is not None:
+            entry = {'time': timestamp, 'owner': self.owner, 'level': level, 'category': category, 'message': str(message)}
+            if peer is not None:
+                entry['peer'] = str(peer)
+            self.file.write(json.dumps(entry) + '\n')
+
+    def write_records(self):
+        """
+        Write the buffered records, reporting the amount of records dropped in the meantime.
+        The file is closed by this thread once it has written everything, so no record is written to a closed file.
+        """
+        while True:
+            record = self.records.get()
+
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self.write((time.time(), ERROR, 'error', None, f'Dropped {dropped} log records, the buffer was full'))
+            if record is None:
+                break
+            self.write(record)
+
+            # Flush the file once the buffer has been emptied rather than for every record
+            if self.file is not None and self.records.empty():
+                self.file.flush()
+
+        if self.file is not None:
+            self.file.close()
+
+    def close(self):
+        """
+        Write the remaining records and stop the writer thread, which closes the file once it is done.
+        """
+        if not self.writer.is_alive():
+            return
+        self.records.put(None)
+        self.writer.join(timeout=5)
@@ -0,0 +1,230 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the default histogram buckets, payment latencies in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds for fees in sat
+FEE_BUCKETS = (0, 1, 2, 5, 10, 20, 40)
+# Upper bounds for the handling of a single packet in seconds
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{str(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name: str, description: str, labels=()):
+        """
+        A named series, optionally split by labels.
+        @param name: The name of the metric, as exposed.
+        @param description: Help text of the metric.
+        @param labels: Names of the labels, values are given as keyword arguments when updating the metric.
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def remove(self, **labels):
+        """
+        Drop the series of a label combination that will not be updated anymore, such as a closed tube.
+        """
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+    def samples(self):
+        """
+        @return: list of (suffix, label names, label values, value) tuples.
+        """
+        with self.lock:
+            return [('', self.labels, key, value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labels=(), function=None):
+        """
+        A value that goes up and down, either set directly or read from a function when collected.
+        @param function: Callable returning the value, or a dict of label value tuples to values for labelled gauges.
+        """
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [('', self.labels, key, v) for key, v in value.items() if v is not None]
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Distribution of observations over fixed buckets, taking constant memory however many are observed.
+        @param buckets: Upper bounds of the buckets, in increasing order.
+        """
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # Counts per bucket with one for the values beyond the last bound, followed by the sum and the count
+                series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, series in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), series):
+                    cumulative += count
+                    samples.append(('_bucket', self.labels + ('le',), key + (bound,), cumulative))
+                samples.append(('_sum', self.labels, key, series[-2]))
+                samples.append(('_count', self.labels, key, series[-1]))
+        return samples
+
+    def mean(self, **labels):
+        series = self.values.get(self.key(labels))
+        return series[-2] / series[-1] if series and series[-1] else None
+
+
+class Registry:
+
+    def __init__(self, prefix='periscope'):
+        """
+        The metrics of a Submarine or Periscope.
+        @param prefix: Prepended to the name of every metric when exposed.
+        """
+        self.prefix = prefix
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=(), function=None):
+        return self.register(Gauge(name, description, labels, function))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            name = f'{self.prefix}_{metric.name}'
+            lines.append(f'# HELP {name} {metric.description}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for suffix, names, values, value in metric.samples():
+                lines.append(f'{name}{suffix}{label_text(names, values)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        The metrics as a dict, for the snapshot files.
+        """
+        snapshot = {'time': time.time()}
+        for metric in list(self.metrics.values()):
+            snapshot[metric.name] = [{'series': metric.name + suffix, 'labels': dict(zip(names, values)), 'value': value}
+                                     for suffix, names, values, value in metric.samples()]
+        return snapshot
+
+    def write_snapshot(self, path):
+        """
+        Write a snapshot, replacing the previous one at once so readers never see a partial file.
+        """
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.snapshot(), file, default=str)
+        os.replace(temporary, path)
+
+    def serve(self, port, host='localhost'):
+        """
+        Expose the metrics over HTTP at /metrics, from a background thread.
+        @return: The server, which can be shut down.
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def snapshot_every(self, path, interval=60.0):
+        """
+        Write a snapshot file periodically, from a background thread.
+        """
+        def writer():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_snapshot(path)
+                except OSError:
+                    pass
+
+        threading.Thread(target=writer, daemon=True).start()
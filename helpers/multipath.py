@@ -0,0 +1,106 @@
+import threading
+import time
+
+from helpers.transport import Transport
+
+
+class Path:
+
+    def __init__(self, local: Transport, target_pk: str):
+        """
+        A combination of a local node and a peer public key that payments can be striped over.
+        """
+        self.local = local
+        self.target_pk = target_pk
+
+        # Smoothed payment latency in seconds, None until the first payment completed
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0.0
+        self.current_weight = 0.0
+
+    def __repr__(self):
+        return f'{self.local.pk[:8]}→{self.target_pk[:8]}'
+
+
+class PathSelector:
+
+    def __init__(self, alpha=0.2, failure_limit=3, backoff=5.0, max_backoff=60.0):
+        """
+        Weighted round-robin over the available paths, weighing every path by its inverse latency.
+        @param alpha: Smoothing factor of the latency average.
+        @param failure_limit: Consecutive failures after which a path is taken out of rotation.
+        @param backoff: Initial time a failing path is left out, doubled for every further failure.
+        @param max_backoff: Upper limit of the time a path is left out.
+        """
+        self.paths = []
+        self.alpha = alpha
+        self.failure_limit = failure_limit
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    def set_paths(self, local_nodes, target_pks):
+        """
+        Build a path for every combination of local node and peer, keeping the statistics of existing paths.
+        """
+        with self.lock:
+            existing = {(p.local.pk, p.target_pk): p for p in self.paths}
+            self.paths = [existing.get((node.pk, pk)) or Path(node, pk) for node in local_nodes for pk in target_pks]
+
+    def weight(self, path: Path, default: float):
+        return 1.0 / max(path.latency if path.latency is not None else default, 0.001)
+
+    def pick(self, exclude=()):
+        """
+        Select the next path by smooth weighted round-robin.
+        @param exclude: Paths that should not be picked, for instance because they just failed.
+        @return: The path, or None if there are no paths left.
+        """
+        with self.lock:
+            now = time.time()
+            candidates = [p for p in self.paths if p not in exclude and p.down_until <= now]
+
+            # All remaining paths are down, try them anyway rather than dropping the packet
+            if not candidates:
+                candidates = [p for p in self.paths if p not in exclude]
+            if not candidates:
+                return None
+
+            # Paths without measurements get the average latency, so they are tried early on
+            known = [p.latency for p in candidates if p.latency is not None]
+            default = sum(known) / len(known) if known else 1.0
+
+            total = 0.0
+            best = None
+            for path in candidates:
+                weight = self.weight(path, default)
+                path.current_weight += weight
+                total += weight
+                if best is None or path.current_weight > best.current_weight:
+                    best = path
+
+            best.current_weight -= total
+            return best
+
+    def record_success(self, path: Path, latency: float):
+        with self.lock:
+            path.latency = latency if path.latency is None else (1 - self.alpha) * path.latency + self.alpha * latency
+            path.failures = 0
+            path.down_until = 0.0
+
+    def record_failure(self, path: Path, latency: float):
+        """
+        Penalise a failed path, and take it out of rotation after repeated failures.
+        """
+        with self.lock:
+            path.failures += 1
+            penalised = max(latency, path.latency or 0.0) * 2
+            path.latency = penalised if path.latency is None else (1 - self.alpha) * path.latency + self.alpha * penalised
+
+            if path.failures >= self.failure_limit:
+                excess = path.failures - self.failure_limit
+                path.down_until = time.time() + min(self.backoff * 2 ** excess, self.max_backoff)
+
+    def __len__(self):
+        return len(self.paths)
@@ -1,3 +1,38 @@
+import base64
+import struct
+
+# Custom record types used by the protocol
+KEYSEND_RECORD = 5482373484
+DATA_RECORD = 9780141036144
+# Identifies the session of a submarine, so a periscope can serve several of them
+SESSION_RECORD = 9780141036145
+# Offer of a session request: [public keys]:[frame versions]:[previous session record], next to the plain request
+# 0:[public key] that legacy periscopes understand, they do not read unknown records
+HANDSHAKE_RECORD = 9780141036146
+
+# Size of the session identifier, and the room its record takes up in the onion including the type and length
+SESSION_ID_SIZE = 8
+SESSION_RECORD_SIZE = 9 + 1 + SESSION_ID_SIZE
+
+# Frame versions, 0 being the legacy base64 text format
+LEGACY_VERSION = 0
+FRAME_VERSION = 1
+SUPPORTED_VERSIONS = (LEGACY_VERSION, FRAME_VERSION)
+
+# [version][flags][tube_idx][packet_idx][length]
+# version = 1 byte, never an ascii character so it can be told apart from legacy packets
+# flags = 1 byte bitfield
+# tube_idx = 4 bytes signed, -1 being dummy traffic and 0 session messages
+# packet_idx = 4 bytes signed sequence number, -1 for dummy traffic
+# length = 2 bytes payload length
+HEADER = struct.Struct('!BBiiH')
+
+# Frame flags, marking the codec the payload has been compressed with, or a parity packet of the tube
+FLAG_ZLIB = 0x01
+FLAG_LZMA = 0x02
+FLAG_PARITY = 0x04
+
+
 class Packet:
 
     def __init__(self, string):
@@ -11,4 +46,151 @@ class Packet:
         # [A][B][C]
         # A = 1 digit long message type indicator
         # B = 4 digits long request identifier
-        # C = Variable length message payload
\ No newline at end of file
+        # C = Variable length message payload
+
+
+def encode_frame(tube_idx: int, packet_idx: int, data: bytes, flags: int = 0) -> bytes:
+    """
+    Build a binary frame, the header followed by the raw payload.
+    @param tube_idx: The index of the tube the data belongs to.
+    @param packet_idx: The sequence number of the packet within the tube.
+    @param data: The payload.
+    @param flags: Frame flags.
+    @return: The frame as bytes.
+    """
+    return HEADER.pack(FRAME_VERSION, flags, tube_idx, packet_idx, len(data)) + data
+
+
+def decode_frame(record: bytes, offset: int = 0):
+    """
+    Parse a binary frame.
+    @param record: The content of the data record.
+    @param offset: The position of the frame within the record.
+    @return: tuple of tube_idx, packet_idx, flags and payload.
+    @raise ValueError: When the frame is truncated or of an unsupported version.
+    """
+    if len(record) - offset < HEADER.size:
+        raise ValueError('Truncated frame header')
+
+    version, flags, tube_idx, packet_idx, length = HEADER.unpack_from(record, offset)
+    if version != FRAME_VERSION:
+        raise ValueError(f'Unsupported frame version {version}')
+
+    start = offset + HEADER.size
+    payload = record[start:start + length]
+    if len(payload) != length:
+        raise ValueError(f'Truncated frame, expected {length} bytes but got {len(payload)}')
+
+    return tube_idx, packet_idx, flags, payload
+
+
+def encode_legacy(tube_idx: int, packet_idx: int, data: bytes) -> bytes:
+    """
+    Build a packet in the legacy text format: [tube_idx]:[packet_idx]:[str(base64 content)]
+    """
+    return f'{tube_idx}:{packet_idx}:{str(base64.b64encode(data))}'.encode()
+
+
+def decode_legacy(record: bytes):
+    """
+    Parse a packet in the legacy text format.
+    @return: tuple of tube_idx, packet_idx, flags and payload.
+    @raise ValueError: When the packet is malformed.
+    """
+    parts = record.decode('utf-8').split(':', 2)
+    if len(parts) != 3:
+        raise ValueError('Malformed legacy packet')
+    tube_idx, packet_idx, content = parts
+    return int(tube_idx), int(packet_idx), 0, base64.b64decode(content[2:-1])
+
+
+def encode_packet(version: int, tube_idx: int, packet_idx: int, data: bytes) -> bytes:
+    """
+    Encode a packet according to the negotiated frame version.
+    """
+    if version == LEGACY_VERSION:
+        return encode_legacy(tube_idx, packet_idx, data)
+    return encode_frame(tube_idx, packet_idx, data)
+
+
+def encode_packets(version: int, segments) -> bytes:
+    """
+    Encode one or more packets into a single data record, binary frames are simply placed back to back.
+    @param version: The negotiated frame version, legacy records can only hold a single packet.
+    @param segments: list of (tube_idx, packet_idx, data, flags) tuples.
+    """
+    if version == LEGACY_VERSION:
+        if len(segments) != 1 or segments[0][3]:
+            raise ValueError('Legacy packets can not be coalesced or carry flags')
+        return encode_legacy(*segments[0][:3])
+    return b''.join(encode_frame(tube_idx, packet_idx, data, flags) for tube_idx, packet_idx, data, flags in segments)
+
+
+def decode_packet(record: bytes):
+    """
+    Decode a packet of any supported version, binary frames are recognised by their leading version byte.
+    @return: tuple of tube_idx, packet_idx, flags and payload.
+    @raise ValueError: When the record is empty or malformed.
+    """
+    if not record:
+        raise ValueError('Empty record')
+    if record[0] == FRAME_VERSION:
+        return decode_frame(record)
+    return decode_legacy(record)
+
+
+def decode_packets(record: bytes):
+    """
+    Decode every packet held by a data record.
+    @return: list of tuples of tube_idx, packet_idx, flags and payload.
+    @raise ValueError: When the record is empty or any of its packets is malformed.
+    """
+    if not record:
+        raise ValueError('Empty record')
+    if record[0] != FRAME_VERSION:
+        return [decode_legacy(record)]
+
+    packets = []
+    offset = 0
+    while offset < len(record):
+        packet = decode_frame(record, offset)
+        packets.append(packet)
+        offset += HEADER.size + len(packet[3])
+    return packets
+
+
+def frame_size(data_length: int) -> int:
+    """
+    The size a payload of the given length takes up within a coalesced record.
+    """
+    return HEADER.size + data_length
+
+
+def is_handshake(packets):
+    """
+    Whether the decoded packets of a data record hold a session request, the first message of a submarine.
+    """
+    return any(tube_idx == 0 and payload.startswith(b'0:') for tube_idx, _, _, payload in packets)
+
+
+def negotiate_version(offered: str) -> int:
+    """
+    Pick the highest frame version supported by both sides.
+    @param offered: comma separated versions offered by the peer, empty for legacy peers.
+    @return: the agreed upon version
+    """
+    versions = {int(v) for v in offered.split(',') if v.isdigit()}
+    common = versions.intersection(SUPPORTED_VERSIONS)
+    return max(common) if common else LEGACY_VERSION
+
+
+def payload_capacity(version: int, record_size: int) -> int:
+    """
+    The amount of application bytes that fit in a data record of the given size.
+    @param version: The frame version in use.
+    @param record_size: The usable size of the data record in bytes.
+    """
+    if version == LEGACY_VERSION:
+        # Base64 inflates by a third, and the textual header takes up roughly 15 bytes
+        return (record_size - 15) * 3 // 4
+    return record_size - HEADER.size
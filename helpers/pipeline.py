@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+
+from helpers import packet as framing
+from helpers.metrics import Registry, STAGE_BUCKETS
+
+
+def droppable(payload: bytes):
+    """
+    Whether a record may be dropped under load, as its packets are requested again by the acknowledgements.
+    Only records of binary frames of tubes qualify, reading just the frame headers.
+    """
+    if not payload or payload[0] != framing.FRAME_VERSION:
+        return False
+
+    offset = 0
+    while offset + framing.HEADER.size <= len(payload):
+        _, _, tube_idx, _, length = framing.HEADER.unpack_from(payload, offset)
+        if tube_idx == 0:
+            return False
+        offset += framing.HEADER.size + length
+    return True
+
+
+class ReceivePipeline:
+
+    def __init__(self, dispatch, logger, metrics: Registry = None, decode_workers=1, queue_size=4096, block=False):
+        """
+        Splits the receive side into stages, so the invoice stream is never held up by the handling of its packets.
+        The stream stage only takes the data record from the invoice, a pool of decode workers parses the packets, and a
+        single dispatch thread hands them to the tubes and the session handlers, which are not safe to call concurrently.
+        The stages are joined by bounded queues. When a queue is full, a record holding nothing but binary frames of tubes
+        is dropped and counted, as the acknowledgements request its packets again. Records holding session messages,
+        which are never sent again, and legacy records, whose senders do not retransmit, wait for room instead.
+        Records are only dispatched in order with a single decode worker.
+        @param dispatch: Called with the context and the decoded packets of a record, on the dispatch thread.
+        @param logger: The logger.
+        @param metrics: Registry receiving the counters and timings of the stages.
+        @param decode_workers: The amount of threads decoding records.
+        @param queue_size: The maximum amount of records waiting in front of the decode and dispatch stages.
+        @param block: Wait for room in a full queue instead of dropping any record, at the expense of the stream.
+        """
+        self.dispatch = dispatch
+        self.logger = logger
+        self.block = block
+
+        self.decoding = queue.Queue(maxsize=queue_size)
+        self.dispatching = queue.Queue(maxsize=queue_size)
+
+        m = metrics if metrics is not None else Registry()
+        self.received = m.counter('receive_records_total', 'Data records taken from the invoice stream')
+        self.malformed = m.counter('receive_malformed_total', 'Data records that could not be decoded')
+        self.dropped = m.counter('receive_dropped_total', 'Records dropped as the queue of a stage was full', ('stage',))
+        self.blocked = m.counter('receive_blocked_total', 'Records that waited for room in the queue of a stage', ('stage',))
+        self.timing = m.histogram('receive_stage_seconds', 'Time spent handling a record per stage', ('stage',),
+                                  buckets=STAGE_BUCKETS)
+        self.waiting = m.histogram('receive_queue_seconds', 'Time a record waited in front of a stage', ('stage',),
+                                   buckets=STAGE_BUCKETS)
+        m.gauge('receive_queue_depth', 'Records waiting in front of a stage', ('stage',),
+                function=lambda: {('decode',): self.decoding.qsize(), ('dispatch',): self.dispatching.qsize()})
+
+        for _ in range(decode_workers):
+            threading.Thread(target=self.decoder, daemon=True).start()
+        threading.Thread(target=self.dispatcher, daemon=True).start()
+
+    def put(self, payload: bytes, context=None):
+        """
+        Hand a data record over from the invoice stream, which returns to the stream right away.
+        @param payload: The content of the data record.
+        @param context: Passed along to the dispatch function, such as the session the record belongs to.
+        @return: Whether the record was accepted.
+        """
+        start = time.monotonic()
+        recoverable = droppable(payload)
+        accepted = self.enqueue(self.decoding, (start, payload, context, recoverable), 'decode', recoverable)
+        if accepted:
+            self.received.inc()
+        self.timing.observe(time.monotonic() - start, stage='stream')
+        return accepted
+
+    def enqueue(self, stage_queue: queue.Queue, item, stage: str, recoverable: bool):
+        """
+        Place a record in front of a stage, dropping or waiting for room when the stage is behind.
+        @param recoverable: Whether the record may be dropped, see droppable.
+        """
+        try:
+            stage_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            if recoverable and not self.block:
+                self.dropped.inc(stage=stage)
+                return False
+
+        self.blocked.inc(stage=stage)
+        stage_queue.put(item)
+        return True
+
+    def decoder(self):
+        """
+        Decode worker, parsing the packets out of the data records.
+        """
+        while True:
+            queued_at, payload, context, recoverable = self.decoding.get()
+            start = time.monotonic()
+            self.waiting.observe(start - queued_at, stage='decode')
+
+            try:
+                packets = framing.decode_packets(payload)
+            except Exception as e:
+                # A worker never stops on a record, whatever it holds
+                self.malformed.inc()
+                self.logger.log_error(f'Received a malformed packet: {e}')
+                continue
+
+            done = time.monotonic()
+            self.timing.observe(done - start, stage='decode')
+            self.enqueue(self.dispatching, (done, packets, context), 'dispatch', recoverable)
+
+    def dispatcher(self):
+        """
+        Dispatch thread, handing the decoded packets to the session.
+        """
+        while True:
+            queued_at, packets, context = self.dispatching.get()
+            start = time.monotonic()
+            self.waiting.observe(start - queued_at, stage='dispatch')
+
+            try:
+                self.dispatch(context, packets)
+            except Exception as e:
+                self.logger.log_error(f'Could not dispatch a record: {e!r}')
+            self.timing.observe(time.monotonic() - start, stage='dispatch')
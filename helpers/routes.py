@@ -0,0 +1,251 @@
+import threading
+import time
+
+import grpc
+
+import lightning_pb2 as ln
+import router_pb2 as routerrpc
+from helpers.metrics import Registry
+from helpers.transport import LndTransport
+
+# Failures reported by a node along the route that mean the route is outdated, its policy or its channels changed
+STALE_FAILURES = {'FEE_INSUFFICIENT', 'INCORRECT_CLTV_EXPIRY', 'CHANNEL_DISABLED', 'UNKNOWN_NEXT_PEER',
+                  'EXPIRY_TOO_SOON', 'AMOUNT_BELOW_MINIMUM', 'FINAL_INCORRECT_CLTV_EXPIRY'}
+
+
+class CachedRoute:
+
+    def __init__(self, route):
+        """
+        A route to the peer as found by QueryRoutes, with the statistics of the payments sent over it.
+        """
+        self.route = route
+        self.fee_msat = route.total_fees_msat
+        # Smoothed and best observed latency in seconds, None until the first payment completed
+        self.latency = None
+        self.baseline = None
+        self.failures = 0
+        self.down_until = 0.0
+
+    def __repr__(self):
+        return '→'.join(hop.pub_key[:8] for hop in self.route.hops)
+
+
+class RouteSet:
+
+    def __init__(self):
+        """
+        The ranked routes from a local node to a peer.
+        """
+        self.routes = []
+        self.fetched = 0.0
+        self.refreshing = False
+
+
+class RouteManager:
+
+    def __init__(self, logger, metrics: Registry = None, amount=1, fee_limit_msat=40000, final_cltv_delta=40,
+                 alternatives=3, ttl=300.0, alpha=0.2, drift=2.0, failure_limit=3, backoff=5.0, max_backoff=60.0):
+        """
+        Sends the payments to a peer over cached routes through SendToRouteV2, instead of having LND find a route for
+        every single payment to the same destination. The routes are queried once through QueryRoutes, ranked by their
+        measured latency and fee, and queried again when they expire, fail because a node changed its policy, or drift
+        away from the latency they started out with. Payments go through SendPaymentV2 until a route is known.
+        @param logger: The logger.
+        @param metrics: Registry receiving the counters of the route cache.
+        @param amount: The amount of every payment in sat, routes are only valid for this amount.
+        @param fee_limit_msat: Routes charging more in fees are not used.
+        @param final_cltv_delta: The CLTV delta of the final hop, as for the keysend payments.
+        @param alternatives: The amount of routes queried per peer, every next one avoiding the first channel of the
+        routes found before.
+        @param ttl: Seconds after which the routes are queried again, to pick up changed fees and new channels.
+        @param alpha: Smoothing factor of the latency average.
+        @param drift: Factor by which the latency of the best route may rise above its best latency before the routes
+        are queried again.
+        @param failure_limit: Consecutive temporary failures after which a route is left out for a while.
+        @param backoff: Initial time a failing route is left out, doubled for every further failure.
+        @param max_backoff: Upper limit of the time a route is left out.
+        """
+        self.logger = logger
+        self.amount = amount
+        self.fee_limit_msat = fee_limit_msat
+        self.final_cltv_delta = final_cltv_delta
+        self.alternatives = alternatives
+        self.ttl = ttl
+        self.alpha = alpha
+        self.drift = drift
+        self.failure_limit = failure_limit
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # Route sets by (local node public key, peer public key)
+        self.sets = {}
+        self.lock = threading.Lock()
+
+        m = metrics if metrics is not None else Registry()
+        self.queries = m.counter('route_queries_total', 'QueryRoutes calls, by outcome', ('outcome',))
+        self.sent = m.counter('route_payments_total', 'Payments by the way they were routed', ('method',))
+        self.invalidations = m.counter('route_invalidations_total', 'Cached routes dropped or re-queried',
+                                       ('reason',))
+        m.gauge('cached_routes', 'Routes cached per peer', ('local', 'peer'),
+                function=lambda: {(lo[:16], peer[:16]): len(s.routes) for (lo, peer), s in list(self.sets.items())})
+
+    def send(self, node: LndTransport, target_pk: str, request):
+        """
+        Send a keysend payment over the best cached route to the peer.
+        @param node: The local node to pay from.
+        @param target_pk: The public key of the peer.
+        @param request: The SendPaymentRequest of the payment, its hash and custom records are sent along the route.
+        @return: The Payment updates, as SendPaymentV2 would stream them.
+        @raise grpc.RpcError: When the node could not be reached, the route is accounted a failure all the same.
+        """
+        cached = self.pick(node, target_pk)
+        if cached is None:
+            self.sent.inc(method='pathfinding')
+            return node.send(request)
+
+        # The keysend preimage and the data travel in the payload of the final hop
+        route = ln.Route()
+        route.CopyFrom(cached.route)
+        route.hops[-1].custom_records.update(request.dest_custom_records)
+
+        start = time.time()
+        try:
+            attempt = node.routerstub.SendToRouteV2(routerrpc.SendToRouteRequest(payment_hash=request.payment_hash,
+                                                                                 route=route),
+                                                    metadata=[('macaroon', node.macaroon)])
+        except grpc.RpcError:
+            # The session falls back to another path, the route is left out after repeated errors like any other
+            self.record_failure(node, target_pk, cached, None)
+            raise
+        self.sent.inc(method='route')
+
+        if attempt.status == ln.HTLCAttempt.SUCCEEDED:
+            self.record_success(node, target_pk, cached, time.time() - start)
+            return [ln.Payment(status=ln.Payment.SUCCEEDED, value_sat=self.amount,
+                               fee_sat=route.total_fees_msat // 1000, fee_msat=route.total_fees_msat)]
+
+        self.record_failure(node, target_pk, cached, attempt.failure)
+        return [ln.Payment(status=ln.Payment.FAILED, failure_reason=ln.PaymentFailureReason.FAILURE_REASON_ERROR)]
+
+    def pick(self, node: LndTransport, target_pk: str):
+        """
+        The best available route to the peer. The routes are queried in the background when none are cached or they
+        expired, so no payment waits for the query, expired routes stay in use meanwhile.
+        @return: The route, None when no route is known yet.
+        """
+        with self.lock:
+            route_set = self.sets.setdefault((node.pk, target_pk), RouteSet())
+            if time.time() - route_set.fetched > self.ttl and not route_set.refreshing:
+                route_set.refreshing = True
+                threading.Thread(target=self.refresh, args=(node, target_pk), daemon=True).start()
+
+            now = time.time()
+            candidates = [r for r in route_set.routes if r.down_until <= now] or route_set.routes
+            if not candidates:
+                return None
+
+            # Routes without measurements are assumed as fast as the average, so they are tried early on
+            known = [r.latency for r in candidates if r.latency is not None]
+            default = sum(known) / len(known) if known else 0.0
+            return min(candidates, key=lambda r: (r.latency if r.latency is not None else default, r.fee_msat))
+
+    def query(self, node: LndTransport, target_pk: str):
+        """
+        Find routes to the peer, every next route avoiding the first channel of the routes found before.
+        @return: The routes, best first.
+        """
+        routes = []
+        ignored = []
+        for _ in range(self.alternatives):
+            request = ln.QueryRoutesRequest(pub_key=target_pk, amt=self.amount, final_cltv_delta=self.final_cltv_delta,
+                                            fee_limit=ln.FeeLimit(fixed_msat=self.fee_limit_msat),
+                                            use_mission_control=True, dest_features=[9], ignored_pairs=ignored)
+            try:
+                response = node.stub.QueryRoutes(request, metadata=[('macaroon', node.macaroon)])
+            except grpc.RpcError as e:
+                # No further route once every channel has been excluded
+                self.queries.inc(outcome='failed' if not routes else 'exhausted')
+                if not routes:
+                    self.logger.log_error(f'Could not query routes to {target_pk[:16]}: {e.code()}')
+                break
+
+            self.queries.inc(outcome='succeeded')
+            found = [route for route in response.routes if route.total_fees_msat <= self.fee_limit_msat]
+            routes.extend(found)
+            if not found or len(found[0].hops) < 2:
+                break
+            first = found[0].hops[0]
+            ignored.append(ln.NodePair(**{'from': bytes.fromhex(node.pk), 'to': bytes.fromhex(first.pub_key)}))
+        return routes
+
+    def refresh(self, node: LndTransport, target_pk: str):
+        """
+        Query the routes to the peer again, keeping the statistics of the routes found before.
+        """
+        key = (node.pk, target_pk)
+        try:
+            routes = self.query(node, target_pk)
+        finally:
+            with self.lock:
+                self.sets[key].refreshing = False
+
+        with self.lock:
+            route_set = self.sets[key]
+            existing = {self.channels(r.route): r for r in route_set.routes}
+            route_set.routes = [existing.get(self.channels(route)) or CachedRoute(route) for route in routes]
+            # Without any route the query is repeated after the backoff, meanwhile LND finds the routes itself
+            route_set.fetched = time.time() if routes else time.time() - self.ttl + self.backoff
+
+        if routes:
+            self.logger.log_inform(f'Cached {len(routes)} routes to {target_pk[:16]}: {route_set.routes}')
+
+    @staticmethod
+    def channels(route):
+        return tuple(hop.chan_id for hop in route.hops)
+
+    def invalidate(self, node: LndTransport, target_pk: str, cached: CachedRoute = None):
+        """
+        Drop a route, or all routes to the peer, so they are queried again on the next payment.
+        """
+        with self.lock:
+            route_set = self.sets.get((node.pk, target_pk))
+            if route_set is None:
+                return
+            if cached is not None and cached in route_set.routes:
+                route_set.routes.remove(cached)
+            if cached is None or not route_set.routes:
+                route_set.fetched = 0.0
+
+    def record_success(self, node: LndTransport, target_pk: str, cached: CachedRoute, latency: float):
+        with self.lock:
+            previous = cached.latency if cached.latency is not None else latency
+            cached.latency = (1 - self.alpha) * previous + self.alpha * latency
+            cached.baseline = min(cached.baseline or latency, latency)
+            cached.failures = 0
+            cached.down_until = 0.0
+            drifted = cached.latency > cached.baseline * self.drift
+
+        # The route got slow, other routes may have become faster in the meantime
+        if drifted:
+            self.invalidations.inc(reason='drift')
+            with self.lock:
+                cached.baseline = cached.latency
+                self.sets[(node.pk, target_pk)].fetched = 0.0
+
+    def record_failure(self, node: LndTransport, target_pk: str, cached: CachedRoute, failure):
+        """
+        Drop a route that is outdated, and leave out a route for a while after repeated temporary failures.
+        """
+        code = ln.Failure.FailureCode.Name(failure.code) if failure is not None else 'UNKNOWN'
+        if code in STALE_FAILURES:
+            self.invalidations.inc(reason=code.lower())
+            self.logger.log_error(f'Dropping route {cached} to {target_pk[:16]}: {code}')
+            self.invalidate(node, target_pk, cached)
+            return
+
+        with self.lock:
+            cached.failures += 1
+            if cached.failures >= self.failure_limit:
+                excess = cached.failures - self.failure_limit
+                cached.down_until = time.time() + min(self.backoff * 2 ** excess, self.max_backoff)
@@ -0,0 +1,253 @@
+import re
+import threading
+import time
+
+from helpers.metrics import Registry
+
+# Key of the value stored at the node of a domain in the trie, distinct from any label
+END = object()
+
+# Characters of a hostname, rules made up of anything else apply to paths and are of no use to a tunnel
+HOSTNAME_CHARACTERS = re.compile(r'^[a-z0-9.-]+$')
+# A hostname of labels joined by single dots, without a leading or trailing dot
+HOSTNAME = re.compile(r'^[a-z0-9-]+(\.[a-z0-9-]+)*$')
+
+# Options that do not narrow down the requests a rule applies to, rules with any other option are left out
+NEUTRAL_OPTIONS = {'important', 'all', 'document', 'popup'}
+
+# Addresses hosts files point blocked domains to
+SINKHOLES = {'0.0.0.0', '127.0.0.1', '::', '::1'}
+
+
+class DomainTrie:
+
+    def __init__(self):
+        """
+        Domains stored by their labels in reverse, so a lookup takes one step per label of the hostname however many
+        domains are stored. A domain matches itself and all of its subdomains.
+        """
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, domain: str, value):
+        """
+        Store a value for a domain and its subdomains, replacing the value stored for the same domain.
+        @raise ValueError: When the domain has an empty label.
+        """
+        labels = domain.lower().strip('.').split('.')
+        if not all(labels):
+            raise ValueError(f'Empty label in domain {domain!r}')
+
+        node = self.root
+        for label in reversed(labels):
+            node = node.setdefault(label, {})
+        if END not in node:
+            self.size += 1
+        node[END] = value
+
+    def lookup(self, hostname: str):
+        """
+        @return: The value of the most specific domain the hostname falls under, None if there is none. An empty label
+        matches no domain, the lookup ends at the domains above it.
+        """
+        node = self.root
+        found = None
+        for label in reversed(hostname.lower().rstrip('.').split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(END, found)
+        return found
+
+
+class RuleSet:
+
+    def __init__(self, lines=()):
+        """
+        Block and allow rules for the hostnames tubes are opened to, compiled for lookups in microseconds.
+        Understands the domain rules of adblock lists such as EasyList, hosts files and plain domain lists:
+            ||ads.example.com^      blocks the domain and its subdomains
+            @@||cdn.example.com^    allows the domain and its subdomains, overruling the block of a parent domain
+            0.0.0.0 ads.example.com and ads.example.com, as in hosts files and domain lists
+            *telemetry*             blocks every hostname containing the text
+        A more specific domain takes precedence, allowed hostnames are never blocked by a keyword. Rules for paths and
+        element hiding rules are skipped, as only the hostname of a tube is known.
+        @param lines: The rules, one per line.
+        """
+        self.domains = DomainTrie()
+        self.keywords = []
+        self.pattern = None
+        self.skipped = 0
+        self.add_lines(lines)
+
+    def __len__(self):
+        return len(self.domains) + len(self.keywords)
+
+    def load(self, path: str):
+        """
+        Add the rules of a list file.
+        """
+        with open(path, encoding='utf-8', errors='replace') as file:
+            self.add_lines(file)
+
+    def add_lines(self, lines):
+        for line in lines:
+            if not self.add(line):
+                self.skipped += 1
+
+        # The keywords are searched for at once, a single pass over the hostname
+        if self.keywords:
+            self.pattern = re.compile('|'.join(re.escape(keyword) for keyword in self.keywords))
+
+    def add(self, line: str):
+        """
+        Add a single rule, the keyword pattern is compiled by add_lines.
+        @return: Whether the line held a rule that applies to hostnames, comments count as applying.
+        """
+        rule = line.strip()
+        if not rule or rule[0] in '![#':
+            return True
+        if '##' in rule or '#@#' in rule or '#?#' in rule:
+            return False
+
+        allow = rule.startswith('@@')
+        if allow:
+            rule = rule[2:]
+
+        rule, _, options = rule.partition('$')
+        if options and not set(options.lower().split(',')) <= NEUTRAL_OPTIONS:
+            return False
+
+        # Hosts files list an address in front of the domain
+        parts = rule.split()
+        if len(parts) == 2 and parts[0] in SINKHOLES:
+            rule = parts[1]
+        elif len(parts) != 1:
+            return False
+
+        rule = rule.lower()
+        if rule.startswith('*') and rule.endswith('*') and len(rule) > 2 and HOSTNAME_CHARACTERS.match(rule[1:-1]):
+            if allow:
+                return False
+            self.keywords.append(rule[1:-1])
+            return True
+
+        if rule.startswith('||'):
+            rule = rule[2:]
+        rule = rule.rstrip('|').rstrip('^')
+        if '.' not in rule or not HOSTNAME.match(rule):
+            return False
+
+        # Allowing a domain overrules a block of the same domain, whatever the order of the lists
+        current = self.domains.lookup(rule)
+        if not (current is not None and current[0] and current[1] == rule):
+            self.domains.add(rule, (allow, rule))
+        return True
+
+    def match(self, hostname: str):
+        """
+        @return: The rule blocking the hostname, None when it is not blocked.
+        """
+        found = self.domains.lookup(hostname)
+        if found is not None:
+            allow, rule = found
+            return None if allow else f'||{rule}^'
+
+        hit = self.pattern.search(hostname.lower()) if self.pattern is not None else None
+        return f'*{hit.group()}*' if hit is not None else None
+
+
+class CostBudget:
+
+    def __init__(self, metrics: Registry = None, host_budget=None, period_budget=None, tube_budget=None, period=3600.0,
+                 over_budget='refuse', throttle_weight=0.1):
+        """
+        Keeps track of the sats spent on every host and tube, and turns down new tubes once a budget is spent.
+        Budgets apply to a period, the spending is counted from zero again at the start of every period.
+        @param metrics: Registry receiving the spending and the tubes turned down.
+        @param host_budget: Sats that may be spent per host and period, None for no limit.
+        @param period_budget: Sats that may be spent on all hosts together per period, None for no limit.
+        @param tube_budget: Sats a single tube may spend before it is throttled, None for no limit.
+        @param period: Length of a period in seconds.
+        @param over_budget: 'refuse' to turn down new tubes to a host over its budget, 'throttle' to open them with a
+        smaller share of the payments.
+        @param throttle_weight: The share in the round robin of a throttled tube, see Coalescer.set_weight.
+        """
+        self.host_budget = host_budget
+        self.period_budget = period_budget
+        self.tube_budget = tube_budget
+        self.period = period
+        self.over_budget = over_budget
+        self.throttle_weight = throttle_weight
+
+        # Called with the index of a tube that spent its budget, set to lower its share of the payments
+        self.throttle_func = None
+
+        # Sats spent in the current period by host, and by tube over its lifetime
+        self.period_start = time.monotonic()
+        self.hosts = {}
+        self.tubes = {}
+        self.throttled = set()
+        self.lock = threading.Lock()
+
+        m = metrics if metrics is not None else Registry()
+        self.spent = m.counter('host_spent_sats_total', 'Sats spent on the payments of every host', ('host',))
+        self.turned_down = m.counter('budget_tubes_total', 'Tubes refused or throttled by a budget',
+                                     ('action', 'reason'))
+        m.gauge('budget_period_spent_sats', 'Sats spent on all hosts in the current period',
+                function=lambda: sum(self.hosts.values()))
+
+    def roll(self):
+        """
+        Start a new period once the current one has passed, the lock is held.
+        """
+        now = time.monotonic()
+        if now - self.period_start >= self.period:
+            self.period_start = now - (now - self.period_start) % self.period
+            self.hosts.clear()
+
+    def charge(self, hostname: str, tube_idx: int, sats: float):
+        """
+        Count the part of a payment spent on a tube, and throttle the tube once it spent its own budget.
+        """
+        with self.lock:
+            self.roll()
+            self.hosts[hostname] = self.hosts.get(hostname, 0) + sats
+            spent = self.tubes[tube_idx] = self.tubes.get(tube_idx, 0) + sats
+            throttle = self.tube_budget is not None and spent > self.tube_budget and tube_idx not in self.throttled
+            if throttle:
+                self.throttled.add(tube_idx)
+        self.spent.inc(sats, host=hostname)
+
+        if throttle and self.throttle_func is not None:
+            self.turned_down.inc(action='throttle', reason='tube')
+            self.throttle_func(tube_idx)
+
+    def forget(self, tube_idx: int):
+        """
+        Drop the spending of a closed tube, the spending of its host stays counted.
+        """
+        with self.lock:
+            self.tubes.pop(tube_idx, None)
+            self.throttled.discard(tube_idx)
+
+    def check(self, hostname: str):
+        """
+        Decide on a new tube to a host.
+        @return: (action, reason) with action 'open', 'throttle' or 'refuse', and the budget that has been spent.
+        """
+        with self.lock:
+            self.roll()
+            reason = None
+            if self.period_budget is not None and sum(self.hosts.values()) >= self.period_budget:
+                reason = 'period'
+            elif self.host_budget is not None and self.hosts.get(hostname, 0) >= self.host_budget:
+                reason = 'host'
+
+        if reason is None:
+            return 'open', None
+        self.turned_down.inc(action=self.over_budget, reason=reason)
+        return self.over_budget, reason
@@ -1,99 +1,371 @@
-import base64
 import codecs
-import json
-import os
 import csv
-import sys
+import os
 import time
+from threading import Thread, Event, Lock
 
 import grpc
-from google.protobuf.json_format import MessageToJson
 
 import router_pb2 as routerrpc
 import router_pb2_grpc as routerstub
 import lightning_pb2 as ln
 import lightning_pb2_grpc as lnrpc
-from helpers.crypt import Crypt
+from helpers.crypt import PreimagePool
 from helpers.logger import Logger
+from helpers.multipath import PathSelector
+from helpers.compression import TubeCompressor, negotiate_codecs
+from helpers.metrics import Registry, FEE_BUCKETS
+from helpers.pipeline import ReceivePipeline
+from helpers.transport import Transport, LndTransport
+from helpers import packet as framing
 
 os.environ["GRPC_SSL_CIPHER_SUITES"] = 'HIGH+ECDSA'
 
 
-class Session:
+def secure_channel(cert: bytes, port):
+    """
+    Open the gRPC channel towards a local LND node.
+    @param cert: The content of the tls.cert file.
+    @param port: The gRPC port of the node.
+    """
+    creds = grpc.ssl_channel_credentials(cert)
+    return grpc.secure_channel(f'localhost:{port}', creds)
+
+
+def connect_node(pk, cert, macaroon, port, create_channel=secure_channel):
+    """
+    Connect to a local LND node.
+    @param pk: The public key of the node.
+    @param cert: The tls.cert filepath.
+    @param macaroon: The admin.macaroon filepath.
+    @param port: The gRPC port of the node.
+    @param create_channel: Callable opening the channel from the certificate and the port.
+    @return: The LndTransport.
+    """
+    channel = create_channel(open(cert, 'rb').read(), port)
+    macaroon = codecs.encode(open(macaroon, 'rb').read(), 'hex')
+    return LndTransport(pk, lnrpc.LightningStub(channel), routerstub.RouterStub(channel), macaroon, channel)
+
+
+def wait_ready(nodes, timeout=10.0):
+    """
+    Wait for the transports of the local nodes to be connected, rather than connecting on the first call.
+    The transports connect at the same time, see Transport.connect.
+    @raise TimeoutError: When a transport did not connect within the timeout.
+    """
+    for node in nodes:
+        node.connect()
+    deadline = time.monotonic() + timeout
+    for node in nodes:
+        node.ready(max(deadline - time.monotonic(), 0))
+
+
+def load_credentials(path):
+    """
+    Read the credentials of the nodes, one node per line: name,tls.cert path,admin.macaroon path,public key,gRPC port.
+    @return: dict of node names to dicts with the cert, mac, pk and port of the node.
+    """
+    nodes = {}
+    with open(path) as credentials:
+        for row in csv.reader(credentials, delimiter=','):
+            nodes[row[0]] = {'cert': row[1], 'mac': row[2], 'pk': row[3], 'port': row[4]}
+    return nodes
+
 
-    def __init__(self, pk, cert, macaroon, port, close_socket_func, logger: Logger):
-        self.pk = pk
-        self.target_pk = None
+class Session:
 
-        cert = open(cert, 'rb').read()
-        creds = grpc.ssl_channel_credentials(cert)
-        channel = grpc.secure_channel(f'localhost:{port}', creds)
-        self.stub = lnrpc.LightningStub(channel)
-        self.routerstub = routerstub.RouterStub(channel)
+    def __init__(self, pk, cert, macaroon, port, close_socket_func, logger: Logger, local_nodes=None, crypt=None):
+        """
+        @param local_nodes: Transports shared with other sessions or other than LND, used instead of connecting to the
+        LND node given by pk, cert, macaroon and port.
+        @param crypt: PreimagePool shared with other sessions.
+        """
+        # Local nodes and peer public keys, payments are striped over every combination of the two
+        self.local_nodes = []
+        self.target_pks = []
+        self.paths = PathSelector()
 
-        self.macaroon = codecs.encode(open(macaroon, 'rb').read(), 'hex')
+        if local_nodes is None:
+            self.add_local_node(pk, cert, macaroon, port)
+        else:
+            self.local_nodes.extend(local_nodes)
+        self.pk = self.local_nodes[0].pk
 
-        self.crypt = Crypt().crypt_pair_generator()
+        # Preimages for the keysend payments, shared by every sending thread
+        self.crypt = crypt or PreimagePool()
         self.tubes = {}
 
+        # Sent along with every payment when set, a Periscope serving several submarines tells them apart by it
+        self.session_record = None
+
         self.close_socket = close_socket_func
         self.logger: Logger = logger
 
+        # Called with the index of a tube that has in-order data to be delivered to its socket, set by the proxy loop
+        self.deliverable_func = None
+
+        # Set once the handshake completed, whatever its outcome, and once every receiver subscribed to its invoices
+        self.handshake_done = Event()
+        self.subscribed = Event()
+        self.subscriptions = 0
+        self.subscription_lock = Lock()
+
+        # Frame version agreed upon during the handshake, legacy until negotiated
+        self.frame_version = framing.LEGACY_VERSION
+        # Usable size of the data record, the route determines what fits in the onion
+        self.record_size = 987
+
+        # Codecs offered for compression of the tubes, and the compression counters of closed tubes per host
+        self.codecs = ()
+        self.compression_totals = {}
+
+        # Coalescer carrying the acknowledgements, set once it has been created
+        self.coalescer = None
+        # Stages between the invoice streams and the tubes, created along with the receivers
+        self.pipeline = None
+        self.decode_workers = 1
+        # Timing of the acknowledgements, gaps in the received packets are reported after they persisted for a while
+        self.ack_interval = 1.0
+        self.nack_delay = 1.0
+        self.nack_interval = 3.0
+
+        # Amount and fees paid in sat
         self.total_cost = 0
-        self.avg_latency = []
 
-    def receiver(self):
+        # RouteManager sending the payments over cached routes, None to let LND find the route of every payment
+        self.routes = None
+
+        # CostBudget counting the sats spent on every host, None to not keep track
+        self.budget = None
+
+        self.metrics = Registry()
+        self.create_metrics()
+
+    def create_metrics(self):
+        """
+        Register the metrics of the session, all of them take constant memory apart from the series of open tubes.
+        """
+        m = self.metrics
+        self.payment_latency = m.histogram('payment_latency_seconds', 'Duration of payment attempts', ('outcome',))
+        self.dummy_latency = m.histogram('dummy_latency_seconds', 'Delay of the dummy payments of the peer')
+        self.payments = m.counter('payments_total', 'Payments by outcome, after trying every path', ('outcome',))
+        self.failures = m.counter('payment_failures_total', 'Failed payment attempts by reason', ('reason',))
+        self.fees = m.counter('fees_sat_total', 'Routing fees paid in sat')
+        self.amounts = m.counter('amount_sat_total', 'Amount paid in sat, excluding fees')
+        self.payment_fee = m.histogram('payment_fee_sat', 'Routing fee per payment in sat', buckets=FEE_BUCKETS)
+        self.packets_sent = m.counter('packets_sent_total', 'Packets delivered to the peer')
+        self.bytes_sent = m.counter('payload_bytes_sent_total', 'Payload bytes delivered to the peer')
+        self.packets_received = m.counter('packets_received_total', 'Packets received from the peer')
+        self.bytes_received = m.counter('payload_bytes_received_total', 'Payload bytes received from the peer')
+
+        m.gauge('fee_sat_per_packet', 'Average routing fee per delivered packet',
+                function=lambda: self.fees.value() / max(self.packets_sent.value(), 1))
+        m.gauge('fee_msat_per_byte', 'Average routing fee per delivered payload byte',
+                function=lambda: self.fees.value() * 1000 / max(self.bytes_sent.value(), 1))
+        m.gauge('open_tubes', 'Tubes currently open', function=lambda: len(self.tubes))
+        m.gauge('tube_bytes_sent', 'Payload bytes delivered to the peer per open tube', ('tube', 'host'),
+                function=lambda: {(idx, t.hostname): t.bytes_sent for idx, t in list(self.tubes.items())})
+        m.gauge('tube_bytes_received', 'Payload bytes received from the peer per open tube', ('tube', 'host'),
+                function=lambda: {(idx, t.hostname): t.bytes_received for idx, t in list(self.tubes.items())})
+
+    def instrument(self, t_queue, throttle):
+        """
+        Expose the state of the coalescer and the throttle feeding the session.
+        """
+        m = self.metrics
+        m.gauge('queue_depth', 'Payments worth of data waiting to be sent', function=t_queue.qsize)
+        m.gauge('in_flight', 'Payments dispatched but not completed', function=lambda: throttle.in_flight)
+        m.gauge('in_flight_limit', 'Payments allowed in flight', function=throttle.limit)
+        m.gauge('send_interval_seconds', 'Time between dispatching two payments', function=throttle.pace)
+        if throttle.controller is not None:
+            m.gauge('rate_controller', 'State of the rate controller', ('value',),
+                    function=lambda: {(k,): v for k, v in throttle.controller.state().items()})
+
+    def export_metrics(self, port=None, path=None, interval=60.0):
         """
-        The receiver method responsible for accepting and directing incoming lightning packets that carry data.
-        Best to be started in a threaded way.
+        Expose the metrics over HTTP on the given local port, and or write a snapshot to the given path periodically.
         """
-        request = ln.InvoiceSubscription()
+        if port is not None:
+            self.metrics.serve(port)
+            self.logger.log_inform(f'Serving metrics on http://localhost:{port}/metrics')
+        if path is not None:
+            self.metrics.snapshot_every(path, interval)
+
+    @property
+    def target_pk(self):
+        """
+        The primary public key of the peer.
+        """
+        return self.target_pks[0] if self.target_pks else None
 
-        for invoice in self.stub.SubscribeInvoices(request, metadata=[('macaroon', self.macaroon)]):
+    @target_pk.setter
+    def target_pk(self, pk):
+        self.set_targets([pk] if pk else [])
 
-            # Try to retrieve message content, excepts as a KeyError if not a message (and ignores it)
-            msg = json.loads(MessageToJson(invoice))
-            try:
-                payload = msg['htlcs'][0]['customRecords']['9780141036144']
-            except KeyError:
-                continue
+    def set_targets(self, pks):
+        """
+        Set the public keys of the peer nodes, payments will be striped across them.
+        @param pks: List of public keys.
+        """
+        self.target_pks = list(pks)
+        self.paths.set_paths(self.local_nodes, self.target_pks)
+
+    def add_local_node(self, pk, cert, macaroon, port):
+        """
+        Add a local LND node to send and receive through.
+        @param pk: The public key of the node.
+        @param cert: The tls.cert filepath.
+        @param macaroon: The admin.macaroon filepath.
+        @param port: The gRPC port of the node.
+        """
+        self.local_nodes.append(connect_node(pk, cert, macaroon, port, self.create_channel))
+        self.paths.set_paths(self.local_nodes, self.target_pks)
 
-            # Parse and split message
-            payload_decoded = base64.b64decode(payload).decode('utf-8').split(':', 2)
-            tube_idx = int(payload_decoded[0])
-            packet_idx = int(payload_decoded[1])
-            packet_content = base64.b64decode(payload_decoded[2][2:-1])
+    def create_channel(self, cert: bytes, port):
+        """
+        Open the gRPC channel towards the local LND node.
+        @param cert: The content of the tls.cert file.
+        @param port: The gRPC port of the node.
+        """
+        return secure_channel(cert, port)
 
-            # tube_idx of 0 indicates a service message
-            if tube_idx == 0:
-                service_message = str(packet_content)[2:-1]
-                self.receive_session_message(service_message)
-                continue
+    @property
+    def chunk_size(self):
+        """
+        The amount of application bytes that can be carried by a single payment.
+        """
+        return framing.payload_capacity(self.frame_version, self.record_size)
 
-            # tube_idx of -1 indicates a dummy message used to hide traffic patterns, should be ignored
-            if tube_idx == -1:
-                diff = round(float(time.time()) - float(packet_content.decode()), 3)
-                self.avg_latency.append(diff)
-                print(f"{diff}")
-                if len(self.avg_latency) == 2500:
-                    with open("latencies.txt", 'a+') as file:
-                        wr = csv.writer(file, quoting=csv.QUOTE_NONNUMERIC)
-                        wr.writerow(self.avg_latency)
-                        average = sum(self.avg_latency) / len(self.avg_latency)
-                        print("Average of the list =", round(average, 2))
+    def start_receivers(self, timeout=5.0):
+        """
+        Start a receiving thread for every local node, as well as the thread acknowledging the received packets.
+        The receivers only hand the data records to the pipeline, which decodes and dispatches them on threads of its own.
+        Returns once every receiver subscribed to its invoices, so replies to messages sent afterwards can not be missed.
+        @param timeout: The maximum amount of seconds to wait for the subscriptions.
+        @return: Whether every receiver subscribed in time.
+        """
+        self.pipeline = ReceivePipeline(self.dispatch, self.logger, self.metrics, self.decode_workers)
+        for node in self.local_nodes:
+            Thread(target=self.receiver, args=(node,)).start()
+        Thread(target=self.feedback_loop).start()
+        return self.subscribed.wait(timeout)
+
+    def warm_up(self, timeout=10.0):
+        """
+        Connect the transports of the local nodes ahead of the first call, see wait_ready.
+        """
+        start = time.monotonic()
+        wait_ready(self.local_nodes, timeout)
+        self.logger.log_inform(f'Connected to {len(self.local_nodes)} local nodes in {time.monotonic() - start:.3f}s')
+
+    def subscription_started(self):
+        """
+        Count a receiver that subscribed to its invoices, signalling once all of them did.
+        """
+        with self.subscription_lock:
+            self.subscriptions += 1
+            if self.subscriptions >= len(self.local_nodes):
+                self.subscribed.set()
+
+    def receiver(self, node: Transport = None):
+        """
+        The receiver method responsible for accepting incoming lightning packets that carry data.
+        Best to be started in a threaded way, once for every local node.
+        @param node: The local node to receive on, defaults to the primary node.
+        """
+        node = node or self.local_nodes[0]
+        payments = node.subscribe()
+        self.subscription_started()
+
+        for records in payments:
+
+            # Retrieve the message content, payments that do not carry a data record are ignored
+            payload = records.get(framing.DATA_RECORD)
+            if payload is None:
                 continue
 
-            # Direct packet to right tube
+            self.pipeline.put(payload, records.get(framing.HANDSHAKE_RECORD))
+
+    def dispatch(self, context, packets):
+        """
+        Direct the decoded packets of a data record, called from the dispatch stage of the pipeline.
+        @param context: The handshake record of the payment, None when it carries none.
+        """
+        for tube in self.receive_packets(packets):
+            self.wakeup(int(tube.identifier))
+
+    def wakeup(self, tube_idx: int):
+        """
+        Signal the proxy loop that a tube received packets, if the next packet in order is among them.
+        """
+        tube = self.tubes.get(tube_idx)
+        if tube is not None and self.deliverable_func is not None and tube.receive_index in tube.packet_queue:
+            self.deliverable_func(tube_idx)
+
+    def receive_packets(self, packets):
+        """
+        Direct decoded packets to the session handler or the right tubes.
+        @param packets: list of (tube_idx, packet_idx, flags, content) tuples.
+        @return: The tubes that received data.
+        """
+        tubes = []
+        for tube_idx, packet_idx, flags, packet_content in packets:
+            # A malformed frame is dropped on its own, the other frames of the record are still taken
             try:
-                t = self.tubes[int(tube_idx)]
-                t.packet_queue[packet_idx] = packet_content
+                tube = self.receive_frame(tube_idx, packet_idx, flags, packet_content)
+            except (ValueError, IndexError) as e:
+                self.logger.log_error(f'Dropped a malformed packet {packet_idx} of tube {tube_idx}: {e!r}')
+                continue
+            if tube is not None:
+                tubes.append(tube)
+        return tubes
 
-                source = f'{t.hostname}:{tube_idx}'
-                self.logger.log_receive(f'{source}', f'Received {sys.getsizeof(packet_content)} bytes, packet index: {packet_idx}')
+    def receive_frame(self, tube_idx: int, packet_idx: int, flags: int, packet_content: bytes):
+        """
+        Direct a single packet to the session handler or the right tube.
+        @return: The tube that received data, if any.
+        """
+        # tube_idx of 0 indicates a service message
+        if tube_idx == 0:
+            self.receive_session_message(packet_content.decode())
+            return
+
+        # tube_idx of -1 indicates a dummy message used to hide traffic patterns, should be ignored
+        if tube_idx == -1:
+            self.dummy_latency.observe(max(time.time() - float(packet_content.decode()), 0.0))
+            return
 
-            except KeyError:
-                self.logger.log_error(
-                    f'Received {sys.getsizeof(packet_content)} bytes, but tube {tube_idx} is non-existing.')
+        # Direct packet to right tube
+        try:
+            t = self.tubes[int(tube_idx)]
+
+            # Parity packets are kept aside, they only matter when a packet of their block went missing
+            if flags & framing.FLAG_PARITY:
+                t.add_parity(packet_idx, packet_content)
+            elif not t.accept(packet_idx, flags, packet_content):
+                if self.logger.debug:
+                    self.logger.log_debug(f'Dropped packet {packet_idx} of tube {tube_idx}, duplicate or outside the window',
+                                          'packet')
+                return
+            else:
+                t.bytes_received += len(packet_content)
+                self.packets_received.inc()
+                self.bytes_received.inc(len(packet_content))
+
+            repaired = t.repair()
+            if repaired:
+                self.logger.log_inform(f'Rebuilt {repaired} lost packets of tube {tube_idx} from parity')
+            elif flags & framing.FLAG_PARITY:
+                return
+
+            if self.logger.debug:
+                self.logger.log_receive(f'{t.hostname}:{tube_idx}',
+                                        f'Received {len(packet_content)} bytes, packet index: {packet_idx}')
+            return t
+
+        except KeyError:
+            self.logger.log_error(
+                f'Received {len(packet_content)} bytes, but tube {tube_idx} is non-existing.')
 
 
     def send(self, data: bytes, packet_idx: int, tube_idx: int):
@@ -102,39 +374,112 @@ class Session:
         @param data: The data to be sent.
         @param packet_idx: The index that the packet should hold, required for reconstruction.
         @param tube_idx: The index of the tube, required for directing it to the right socket on the other side.
+        @return: See send_batch.
         """
+        return self.send_batch([(tube_idx, packet_idx, data, 0)])
 
-        # The packet is attempted to be send across a non-existing tube that has likely been deleted
-        if (int(tube_idx) not in self.tubes) and int(tube_idx) != 0 and int(tube_idx) != -1:
-            return
+    def send_batch(self, segments, records=None):
+        """
+        Send a single payment carrying one or more packets, possibly of different tubes.
+        @param segments: list of (tube_idx, packet_idx, data, flags) tuples.
+        @param records: Custom records to send along with the data, such as the offer of a handshake.
+        @return: The fee in sat when the payment succeeded, False when it failed on every path, and None when none
+        of the tubes exist anymore.
+        """
+        # Failed payments are retried over the remaining paths, with a fresh preimage each time
+        failed = []
+        while (path := self.paths.pick(exclude=failed)) is not None:
+            request, dest = self.payment_request(segments, path.target_pk, records)
+            if request is None:
+                return
+
+            # Update stream has to be consumed
+            # Timeout after X seconds. Idea: Detect outliers automatically
+            start = time.time()
+            status = None
+            fee = 0
+            try:
+                # Cached routes spare LND from finding a route to the same peer for every payment
+                if self.routes is not None and path.local.routable:
+                    updates = self.routes.send(path.local, path.target_pk, request)
+                else:
+                    updates = path.local.send(request)
+                for update in updates:
+                    self.payment_update(update, request, dest, segments)
+                    status = update.status
+                    fee = update.fee_sat
+            except grpc.RpcError as e:
+                self.logger.log_error(f'Payment over {path} could not be sent: {e.code()}')
+                self.failures.inc(reason=e.code().name)
+
+            if self.payment_attempt(path, status, time.time() - start):
+                return fee
+            failed.append(path)
+
+        self.payment_failed(segments)
+        return False
+
+    def payment_attempt(self, path, status, latency: float):
+        """
+        Account for an attempt to send a payment over a path.
+        @return: Whether the attempt succeeded.
+        """
+        if status == ln.Payment.SUCCEEDED:
+            self.payment_latency.observe(latency, outcome='succeeded')
+            self.paths.record_success(path, latency)
+            return True
 
-        # Convert to base64 for safe transmission
-        enc_data = base64.b64encode(data)
+        self.payment_latency.observe(latency, outcome='failed')
+        self.paths.record_failure(path, latency)
+        return False
+
+    def payment_failed(self, segments):
+        """
+        Every path failed to deliver a payment, send its packets again rather than waiting for the peer to miss them.
+        Session messages are not repeated, as they are not idempotent, and neither are parity packets.
+        @param segments: The (tube_idx, packet_idx, data, flags) tuples carried by the payment.
+        """
+        self.payments.inc(outcome='failed')
+        segments = [segment for segment in segments
+                    if int(segment[0]) in self.tubes and not segment[3] & framing.FLAG_PARITY]
+        if segments and self.coalescer is not None:
+            self.logger.log_error(f'Payment failed on every path, retransmitting {len(segments)} packets')
+            self.coalescer.resend(segments)
+
+    def payment_request(self, segments, target_pk: str = None, records=None):
+        """
+        Build the keysend payment carrying the packets.
+        @param segments: list of (tube_idx, packet_idx, data, flags) tuples.
+        @param target_pk: The peer node to pay, defaults to the primary peer.
+        @param records: Custom records to send along with the data.
+        @return: The request and a description of its destination, both None when none of the tubes exist anymore.
+        """
+        # Packets attempted to be send across a non-existing tube that has likely been deleted are left out
+        segments = [(int(t), p, d, f) for t, p, d, f in segments if int(t) in self.tubes or int(t) in (0, -1)]
+        if not segments:
+            return None, None
 
-        # Packet: [tube_idx]:[packet_idx]:[packet_content]
-        packet = f'{tube_idx}:{packet_idx}:{str(enc_data)}'.encode()
+        # Packet: binary frames, or [tube_idx]:[packet_idx]:[packet_content] for legacy peers
+        packet = framing.encode_packets(self.frame_version, segments)
 
-        # Crypt object is occasionally occupied, retry if necessary
-        preimage = None
-        phash = None
-        while preimage is None or phash is None:
-            try:
-                preimage, phash = next(self.crypt)
-            except ValueError:
-                pass
+        # Take a fresh preimage from the pool, every payment needs its own
+        preimage, phash = self.crypt.take()
 
         # Keysend record for invoice-free transaction, as well as the data carrying record
         custom_records = {
-            5482373484: preimage,
-            9780141036144: packet
+            framing.KEYSEND_RECORD: preimage,
+            framing.DATA_RECORD: packet
         }
+        if self.session_record is not None:
+            custom_records[framing.SESSION_RECORD] = self.session_record
+        custom_records.update(records or {})
 
         # The request with the embedded custom records
         request = routerrpc.SendPaymentRequest(
             payment_hash=phash,
             amt=1,
             final_cltv_delta=40,
-            dest=bytes.fromhex(self.target_pk),
+            dest=bytes.fromhex(target_pk or self.target_pk),
             timeout_seconds=200,
             dest_custom_records=custom_records,
             fee_limit_sat=40,
@@ -142,36 +487,92 @@ class Session:
             dest_features=[9],
         )
 
-        if int(tube_idx) == 0:
-            dest = 'SUB'
-        elif int(tube_idx) == -1:
-            dest = 'DUMMY'
-        else:
-            dest = f'{self.tubes[int(tube_idx)].hostname}:{tube_idx}'
-
-        # Update stream has to be consumed
-        # Timeout after X seconds. Idea: Detect outliers automatically
-        for update in self.routerstub.SendPaymentV2(request, metadata=[('macaroon', self.macaroon)]):
+        return request, self.describe_destination(segments)
 
-            # Check for failure
-            msg = json.loads(MessageToJson(update))
-            if 'fee' in msg:
-                self.total_cost += int(msg['fee']) + int(msg['value'])
-                self.logger.log_send(dest,
-                                     f'[{round(self.total_cost * 0.00044336, 3)} Eur] {packet_idx} - Sending {sys.getsizeof(data)} bytes')
+    def describe_destination(self, segments):
+        """
+        Describe where the packets of a payment are heading, for logging.
+        """
+        labels = []
+        for tube_idx, *_ in segments:
+            if tube_idx == 0:
+                label = 'SUB'
+            elif tube_idx == -1:
+                label = 'DUMMY'
+            else:
+                tube = self.tubes.get(tube_idx)
+                label = f'{tube.hostname if tube else None}:{tube_idx}'
+            if label not in labels:
+                labels.append(label)
+        return ', '.join(labels)
+
+    def payment_update(self, update, request, dest: str, segments):
+        """
+        Process a status update of a payment sent by self.send_batch.
+        @param update: The Payment message streamed back by SendPaymentV2.
+        @param request: The request of the payment.
+        @param dest: Description of the destination, for logging.
+        @param segments: The (tube_idx, packet_idx, data, flags) tuples carried by the payment.
+        """
+        # Read the status fields directly from the payment message
+        if update.status == ln.Payment.SUCCEEDED:
+            self.total_cost += update.fee_sat + update.value_sat
+            if self.logger.debug:
+                indexes = ','.join(str(packet_idx) for _, packet_idx, *_ in segments)
+                size = sum(len(data) for _, _, data, _ in segments)
+                self.logger.log_send(dest, f'[{self.total_cost} sat] {indexes} - Sending {size} bytes')
+
+            self.payments.inc(outcome='succeeded')
+            self.fees.inc(update.fee_sat)
+            self.amounts.inc(update.value_sat)
+            self.payment_fee.observe(update.fee_sat)
+            for tube_idx, _, data, _ in segments:
+                tube = self.tubes.get(int(tube_idx))
+                if tube is not None:
+                    tube.bytes_sent += len(data)
+                    self.packets_sent.inc()
+                    self.bytes_sent.inc(len(data))
+            if self.budget is not None:
+                self.charge(update.fee_sat + update.value_sat, segments)
+
+        # Check for failure
+        if update.failure_reason:
+            reason = ln.PaymentFailureReason.Name(update.failure_reason)
+            self.logger.log_error(f"Transaction failed, reason: {reason}:{request}")
+            self.failures.inc(reason=reason)
+
+    def charge(self, cost: int, segments):
+        """
+        Split the cost of a payment over the tubes by the amount of data they sent in it, for the budgets of their hosts.
+        Payments without data of any tube, such as dummies and session messages, are not charged to a host.
+        @param cost: The amount and fee of the payment in sat.
+        @param segments: The (tube_idx, packet_idx, data, flags) tuples carried by the payment.
+        """
+        sizes = {}
+        for tube_idx, _, data, _ in segments:
+            if int(tube_idx) in self.tubes:
+                sizes[int(tube_idx)] = sizes.get(int(tube_idx), 0) + len(data)
 
-            if 'failureReason' in msg:
-                self.logger.log_error(f"Transaction failed, reason: {msg['failureReason']}:{request}")
+        total = sum(sizes.values())
+        for tube_idx, size in sizes.items():
+            tube = self.tubes.get(tube_idx)
+            if tube is not None and size:
+                self.budget.charge(tube.hostname, tube_idx, cost * size / total)
 
     def get_packet(self, tube_idx: int):
-        return self.tubes[tube_idx].get_packet()
+        """
+        Take the next packet in order of a tube.
+        @return: The packet content, None if it has not arrived yet or the tube no longer exists.
+        """
+        tube = self.tubes.get(int(tube_idx))
+        return tube.get_packet() if tube is not None else None
 
     def send_session_message(self, data: str):
         """
         Wrapper method of self.send for sending session related messages.
         @param data: The session message to be send.
         """
-        self.send(data=data.encode(), packet_idx=0, tube_idx=0)
+        return self.send(data=data.encode(), packet_idx=0, tube_idx=0)
 
 
     def receive_session_message(self, message: str):
@@ -183,6 +584,54 @@ class Session:
         raise NotImplementedError
 
 
+    def feedback_loop(self):
+        """
+        Periodically acknowledge the received packets, best to be started in a threaded way.
+        """
+        while True:
+            time.sleep(self.ack_interval / 4)
+            self.acknowledge()
+
+
+    def acknowledge(self):
+        """
+        Report the state of the reorder buffer of every tube that has news to the peer.
+        Acknowledgements ride along with other payments for up to ack_interval, requests for missing packets go out right away.
+        Legacy peers neither understand the messages nor coalesce, they are left out.
+        """
+        if self.coalescer is None or self.frame_version == framing.LEGACY_VERSION:
+            return
+
+        for tube_idx, tube in list(self.tubes.items()):
+            feedback = tube.feedback(self.nack_delay, self.nack_interval, self.ack_interval)
+            if feedback is None:
+                continue
+
+            cumulative, missing = feedback
+            message = f'5:{tube_idx}:{cumulative}:{",".join(str(idx) for idx in missing)}'
+            self.coalescer.post(message.encode(), 0.0 if missing else self.ack_interval)
+
+
+    def receive_feedback(self, value: str):
+        """
+        The peer acknowledged the packets of a tube up to an index, and possibly reported some missing ones.
+        @param value: Session message containing the port, the cumulative index and the missing indexes.
+        """
+        port, cumulative, missing = value.split(':')
+        tube = self.tubes.get(int(port))
+        if tube is None:
+            return
+
+        tube.acknowledge(int(cumulative))
+        if not missing:
+            return
+
+        segments = tube.retransmissions(int(idx) for idx in missing.split(','))
+        self.logger.log_inform(f'Peer is missing packets {missing} of tube {port}, retransmitting {len(segments)}')
+        if segments and self.coalescer is not None:
+            self.coalescer.resend(segments)
+
+
     def local_socket_close(self, tube_idx: int):
         """
         The socket has closed somewhere on this side, close and or delete all the related attributes and inform the peer.
@@ -197,7 +646,7 @@ class Session:
 
         try:
             self.tubes[int(tube_idx)].piping = False
-            del self.tubes[int(tube_idx)]
+            self.record_compression(self.tubes.pop(int(tube_idx)))
 
         except KeyError:
             self.logger.log_error(
@@ -218,7 +667,68 @@ class Session:
 
         try:
             self.tubes[int(tube_idx)].piping = False
-            del self.tubes[int(tube_idx)]
+            self.record_compression(self.tubes.pop(int(tube_idx)))
         except KeyError:
             self.logger.log_error(
                 f'Could not remove {tube_idx} from {self.tubes.keys()}, maybe it was already removed elsewhere')
+
+
+    def receive_compression_offer(self, value: str):
+        """
+        The peer offers codecs for a tube, answer with the ones supported here and start compressing with them.
+        @param value: Session message containing the port and the offered codecs.
+        """
+        port, offered = value.split(':', 1)
+        codecs = negotiate_codecs(offered)
+        tube = self.tubes.get(int(port))
+        if tube is None:
+            return
+
+        if codecs:
+            tube.compressor = TubeCompressor(codecs)
+        self.send_session_message(f'4:{port}:{",".join(codecs)}')
+
+
+    def receive_compression_answer(self, value: str):
+        """
+        The peer accepted (some of) the offered codecs for a tube.
+        @param value: Session message containing the port and the accepted codecs.
+        """
+        port, accepted = value.split(':', 1)
+        codecs = negotiate_codecs(accepted)
+        tube = self.tubes.get(int(port))
+        if tube is not None and codecs:
+            tube.compressor = TubeCompressor(codecs)
+
+
+    def record_compression(self, tube):
+        """
+        Add the compression counters of a tube that is going away to the totals of its host.
+        """
+        totals = self.compression_totals.setdefault(tube.hostname, [0, 0, 0, 0])
+        compressor = tube.compressor
+        if compressor is not None:
+            totals[0] += compressor.bytes_in
+            totals[1] += compressor.bytes_out
+            self.logger.log_inform(f'Compressed {tube.hostname}:{tube.identifier} to {compressor.ratio:.0%} when sending')
+        totals[2] += tube.decompressor.bytes_out
+        totals[3] += tube.decompressor.bytes_in
+
+
+    def compression_report(self):
+        """
+        Compression ratios per host, of the closed as well as the open tubes.
+        @return: dict of hostname to the compressed size over the original size, of the sent and the received data.
+        """
+        totals = {host: list(counters) for host, counters in self.compression_totals.items()}
+        for tube in list(self.tubes.values()):
+            counters = totals.setdefault(tube.hostname, [0, 0, 0, 0])
+            if tube.compressor is not None:
+                counters[0] += tube.compressor.bytes_in
+                counters[1] += tube.compressor.bytes_out
+            counters[2] += tube.decompressor.bytes_out
+            counters[3] += tube.decompressor.bytes_in
+
+        return {host: (sent_out / sent_in if sent_in else 1.0, received_in / received_out if received_out else 1.0)
+                for host, (sent_in, sent_out, received_out, received_in) in totals.items()}
+
@@ -0,0 +1,257 @@
+import selectors
+import socket
+from collections import deque
+
+# Selector key data of the wakeup socket, tube sockets carry their tube index instead
+WAKEUP = object()
+# Selector key data of accepted connections whose request is still being read, before they are linked to a tube
+INCOMING = object()
+
+
+class SocketMap:
+
+    def __init__(self):
+        """
+        The sockets served by a proxy loop, registered with the best selector of the platform (epoll on Linux).
+        Sockets and tubes are indexed both ways, registering, looking up and removing a tube take constant time
+        regardless of the amount of open tubes, and there is no FD_SETSIZE limit.
+        Sockets are only watched for write readiness while their tube has in-order data that has not been written,
+        other threads announce such data through notify(), which wakes up the loop.
+        Tubes can be identified by any hashable key, a Periscope serving several submarines uses (session, tube) pairs.
+        """
+        self.selector = selectors.DefaultSelector()
+
+        # Tube index to socket, the other direction is kept as the data of the selector key
+        self.sockets = {}
+
+        # Whether the tube sockets are watched for incoming data, switched off under backpressure,
+        # and the tubes that are not read from for the time being regardless
+        self.reading = True
+        self.paused = set()
+
+        # Tubes watched for write readiness, and the data the socket did not accept yet
+        self.writing = set()
+        self.outgoing = {}
+
+        # Self-pipe waking up the loop, with the tubes announced by other threads
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, WAKEUP)
+        self.pending = deque()
+        self.woken = False
+
+    def register_server(self, server: socket.socket):
+        """
+        Watch a listening socket, it is not linked to a tube and always watched for new connections.
+        """
+        self.selector.register(server, selectors.EVENT_READ, None)
+
+    def add_incoming(self, sock: socket.socket):
+        """
+        Watch a freshly accepted connection for its request, select() reports it with INCOMING as its tube.
+        """
+        self.selector.register(sock, selectors.EVENT_READ, INCOMING)
+
+    def remove_incoming(self, sock: socket.socket):
+        """
+        Stop watching an accepted connection, once its request has been read or it has been given up on.
+        """
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def events(self, tube_idx: int):
+        return ((selectors.EVENT_READ if self.reading and tube_idx not in self.paused else 0) |
+                (selectors.EVENT_WRITE if tube_idx in self.writing else 0))
+
+    def update(self, tube_idx: int):
+        """
+        Bring the registration of a socket in line with the events it should be watched for.
+        A socket watched for nothing at all is taken out of the selector, until it is watched again.
+        """
+        sock = self.sockets.get(tube_idx)
+        if sock is None or sock.fileno() < 0:
+            return
+
+        events = self.events(tube_idx)
+        try:
+            key = self.selector.get_key(sock)
+        except (KeyError, ValueError):
+            key = None
+
+        # Other threads close tubes while the loop runs, the socket may be removed and closed by now
+        try:
+            if key is None:
+                if events:
+                    self.selector.register(sock, events, tube_idx)
+                    # A removal in between may have unregistered the socket before it was registered here
+                    if self.sockets.get(tube_idx) is not sock:
+                        self.selector.unregister(sock)
+            elif not events:
+                self.selector.unregister(sock)
+            elif key.events != events:
+                self.selector.modify(sock, events, tube_idx)
+        except (KeyError, ValueError, OSError):
+            if tube_idx in self.sockets:
+                raise
+
+    def add(self, tube_idx: int, sock: socket.socket):
+        """
+        Link a socket to its tube and start watching it.
+        """
+        self.sockets[tube_idx] = sock
+        self.update(tube_idx)
+
+    def remove(self, tube_idx: int):
+        """
+        Stop watching the socket of a tube, to be called before the socket is closed.
+        @return: The socket, None if the tube had no socket (anymore).
+        """
+        self.writing.discard(tube_idx)
+        self.paused.discard(tube_idx)
+        self.outgoing.pop(tube_idx, None)
+        sock = self.sockets.pop(tube_idx, None)
+        if sock is not None:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        return sock
+
+    def get(self, tube_idx: int):
+        """
+        The socket of a tube, None if the tube has no socket (anymore).
+        """
+        return self.sockets.get(tube_idx)
+
+    def tube(self, sock: socket.socket):
+        """
+        The tube a socket belongs to, None for unknown sockets and the listening socket.
+        """
+        try:
+            return self.selector.get_key(sock).data
+        except (KeyError, ValueError):
+            return None
+
+    def set_reading(self, reading: bool):
+        """
+        Start or stop watching the tube sockets for incoming data, only touches the registrations when it changes.
+        """
+        if reading == self.reading:
+            return
+        self.reading = reading
+        # Other threads add and remove tubes meanwhile, iterate over a copy
+        for tube_idx in list(self.sockets):
+            self.update(tube_idx)
+
+    def set_paused(self, tube_idx, paused: bool):
+        """
+        Stop or resume reading from the socket of a single tube, such as the tubes of a congested peer.
+        """
+        if paused == (tube_idx in self.paused):
+            return
+        if paused:
+            self.paused.add(tube_idx)
+        else:
+            self.paused.discard(tube_idx)
+        self.update(tube_idx)
+
+    def set_writing(self, tube_idx: int, writing: bool):
+        """
+        Start or stop watching the socket of a tube for write readiness.
+        """
+        if writing == (tube_idx in self.writing):
+            return
+        if writing:
+            self.writing.add(tube_idx)
+        else:
+            self.writing.discard(tube_idx)
+        self.update(tube_idx)
+
+    def notify(self, tube_idx: int):
+        """
+        Announce that a tube has in-order data to be written, safe to be called from any thread.
+        """
+        self.pending.append(tube_idx)
+
+        # A single byte in the pipe is enough to wake up the loop, no need to add more while it has not woken up
+        if not self.woken:
+            self.woken = True
+            try:
+                self.wake_w.send(b'\0')
+            except BlockingIOError:
+                pass
+
+    def wakeup(self):
+        """
+        Empty the self-pipe and watch the sockets of the announced tubes for write readiness.
+        """
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        # Cleared only once the pipe is empty, tubes announced from here on write a byte again
+        self.woken = False
+
+        while self.pending:
+            tube_idx = self.pending.popleft()
+            if tube_idx in self.sockets:
+                self.set_writing(tube_idx, True)
+
+    def select(self, timeout: float = None):
+        """
+        Wait for sockets to become ready.
+        @return: list of (socket, tube_idx, events) tuples, tube_idx being None for the listening socket and INCOMING
+        for the connections added by add_incoming.
+        """
+        ready = []
+        for key, events in self.selector.select(timeout):
+            if key.data is WAKEUP:
+                self.wakeup()
+            else:
+                ready.append((key.fileobj, key.data, events))
+        return ready
+
+    def deliver(self, tube_idx: int, take):
+        """
+        Write the in-order data of a tube for as far as its socket accepts it without blocking.
+        Once everything has been written the socket is no longer watched for write readiness, until the next notify().
+        @param tube_idx: The index of the tube.
+        @param take: Callable returning the next in-order data of the tube, None when there is none.
+        @return: The amount of bytes written, none when the tube has been closed by another thread meanwhile.
+        @raise OSError: When writing to the socket fails.
+        """
+        sock = self.sockets.get(tube_idx)
+        if sock is None:
+            return 0
+        buffer = self.outgoing.setdefault(tube_idx, bytearray())
+        written = 0
+
+        while True:
+            if not buffer:
+                data = take()
+                if data is None:
+                    break
+                buffer += data
+                continue
+
+            try:
+                sent = sock.send(buffer)
+            except BlockingIOError:
+                # The socket is full, the remainder is written on the next write event
+                return written
+            del buffer[:sent]
+            written += sent
+
+        self.set_writing(tube_idx, False)
+        return written
+
+    def __contains__(self, tube_idx):
+        return tube_idx in self.sockets
+
+    def __len__(self):
+        return len(self.sockets)
@@ -1,28 +1,369 @@
+import asyncio
 import threading
-import queue
 import time
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateController:
+
+    def __init__(self, rate=20.0, min_rate=1.0, max_rate=200.0, window=8.0, min_window=1.0, max_window=64.0,
+                 increase=1.0, decrease=0.5, tolerance=2.0, slack=0.01, fee_limit=None, alpha=0.2):
+        """
+        Additive increase, multiplicative decrease of the payment rate and the amount of payments in flight.
+        Every completed payment grows the rate by increase per second and the window by one per window of payments,
+        for as long as the paths keep up. A failure, a smoothed latency beyond tolerance times the base latency or a fee
+        above the limit shrinks both by the decrease factor, at most once per smoothed latency.
+        @param rate: Initial payments per second.
+        @param min_rate: Floor of the rate.
+        @param max_rate: Ceiling of the rate.
+        @param window: Initial amount of payments in flight.
+        @param min_window: Floor of the window.
+        @param max_window: Ceiling of the window.
+        @param increase: Growth of the rate in payments per second, per second.
+        @param decrease: Factor applied to the rate and window on congestion.
+        @param tolerance: Latency relative to the base latency that is taken as a sign of congestion.
+        @param slack: Seconds of latency above the base latency that are never taken as congestion, whatever the ratio.
+        @param fee_limit: Fee in sat per payment that is taken as a sign of congestion, None to ignore fees.
+        @param alpha: Smoothing factor of the latency average.
+        """
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_window = min_window
+        self.max_window = max_window
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.slack = slack
+        self.fee_limit = fee_limit
+        self.alpha = alpha
+
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.window = min(max(window, min_window), max_window)
+
+        # Smoothed latency, and the base latency of uncongested paths which slowly follows the measurements upwards
+        self.latency = None
+        self.base_latency = None
+        self.last_decrease = 0.0
+
+        # Counters, for tuning
+        self.successes = 0
+        self.failures = 0
+        self.decreases = 0
+
+        self.lock = threading.Lock()
+
+    @property
+    def interval(self):
+        return 1 / self.rate
+
+    def on_success(self, latency: float, fee: int = 0):
+        """
+        A payment completed.
+        @param latency: Seconds from dispatching the payment until it completed.
+        @param fee: The fee paid in sat.
+        """
+        with self.lock:
+            self.successes += 1
+            self.measure(latency)
+
+            # Single slow payments are common on lightning, only the smoothed latency tells of congestion, and on fast
+            # paths a few milliseconds of scheduling noise would otherwise exceed any ratio of the base latency
+            threshold = max(self.base_latency * self.tolerance, self.base_latency + self.slack)
+            if self.latency > threshold or (self.fee_limit is not None and fee > self.fee_limit):
+                self.back_off()
+                return
+
+            self.rate = min(self.rate + self.increase / self.rate, self.max_rate)
+            self.window = min(self.window + 1 / self.window, self.max_window)
+
+    def on_failure(self, latency: float):
+        """
+        A payment failed on every path.
+        @param latency: Seconds from dispatching the payment until it failed.
+        """
+        with self.lock:
+            self.failures += 1
+            self.back_off()
+
+    def measure(self, latency: float):
+        self.latency = latency if self.latency is None else (1 - self.alpha) * self.latency + self.alpha * latency
+        # The base settles on the faster payments rather than the single fastest one, which jitter puts far below the
+        # rest: faster payments pull it down quickly, slower ones up slowly
+        if self.base_latency is None:
+            self.base_latency = latency
+        elif latency < self.base_latency:
+            self.base_latency += (latency - self.base_latency) * self.alpha
+        else:
+            self.base_latency += (latency - self.base_latency) * 0.01
+
+    def back_off(self):
+        """
+        Shrink the rate and window, payments that were already in flight report the same congestion so those are
+        only counted once.
+        """
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0.0):
+            return
+        self.last_decrease = now
+        self.decreases += 1
+        self.rate = max(self.rate * self.decrease, self.min_rate)
+        self.window = max(self.window * self.decrease, self.min_window)
+
+    def state(self):
+        """
+        The state of the controller.
+        @return: dict of the current values and counters.
+        """
+        with self.lock:
+            return {
+                'rate': self.rate,
+                'interval': self.interval,
+                'window': self.window,
+                'latency': self.latency,
+                'base_latency': self.base_latency,
+                'successes': self.successes,
+                'failures': self.failures,
+                'decreases': self.decreases,
+            }
+
+
+class Pacer:
+    """
+    The pacing shared by the Throttle and the AioThrottle: the time between two transactions, the amount of transactions
+    in flight and the feedback to the controller. Subclasses set interval, queue, controller, max_in_flight, in_flight,
+    last_dummy and logger.
+    """
+
+    def report(self, message: str):
+        if self.logger is not None:
+            self.logger.log_error(f'{message}: {traceback.format_exc()}')
+        else:
+            traceback.print_exc()
+
+    def limit(self):
+        """
+        The amount of transactions allowed in flight.
+        """
+        if self.controller is not None:
+            return min(int(self.controller.window), self.max_in_flight)
+        return self.max_in_flight
+
+    def pace(self):
+        """
+        The time to wait before dispatching the next transaction.
+        """
+        return self.controller.interval if self.controller is not None else self.interval
+
+    def dummy_due(self):
+        """
+        Whether a dummy transaction may be sent now, taking its turn when it may.
+        Dummy transactions keep to the configured interval, only real ones follow the controller.
+        """
+        if self.controller is not None and time.monotonic() - self.last_dummy < self.interval:
+            return False
+        self.last_dummy = time.monotonic()
+        return True
 
+    def feedback(self, result, latency: float):
+        """
+        Pass the outcome of a transaction on to the controller.
+        @param result: The fee of a successful transaction, False for a failed one and None if nothing was sent.
+        @param latency: The duration of the transaction in seconds.
+        """
+        if self.controller is None or result is None:
+            return
+        if result is False:
+            self.controller.on_failure(latency)
+        else:
+            self.controller.on_success(latency, result)
 
-class Throttle:
-    def __init__(self, interval, function, transaction_queue, send_dummy=False, dummy=None):
+    def state(self):
+        """
+        The state of the throttle and its controller, for tuning.
+        """
+        state = {'in_flight': self.in_flight, 'limit': self.limit(), 'interval': self.pace(), 'queued': self.queue.qsize()}
+        if self.controller is not None:
+            state['controller'] = self.controller.state()
+        return state
+
+
+class Throttle(Pacer):
+    def __init__(self, interval, function, transaction_queue, send_dummy=False, dummy=None,
+                 workers=8, max_in_flight=32, high_water=256, controller: RateController = None, pool=None,
+                 logger=None):
+        """
+        Paces transactions from the queue, and dispatches them over a fixed pool of workers.
+        @param interval: Time between dispatching two transactions, and between two dummy transactions when adaptive.
+        @param function: The function performing the transaction, returning its fee when it succeeded, False when it
+        failed and None when there was nothing to send.
+        @param transaction_queue: The queue holding the arguments for the function, such as a Coalescer.
+        @param send_dummy: Whether to send dummy transactions when the queue is empty.
+        @param dummy: Callable returning the arguments of a dummy transaction.
+        @param workers: The amount of worker threads performing transactions.
+        @param max_in_flight: The maximum amount of transactions that are dispatched but not yet completed.
+        @param high_water: The queue depth at which the producers are asked to hold off.
+        @param controller: Adapts the pace and the amount of transactions in flight to the measured completions,
+        instead of the fixed interval and max_in_flight.
+        @param pool: ThreadPoolExecutor shared with other throttles, used instead of a pool of workers of its own.
+        @param logger: Logger for the errors of the throttle loop, which are printed when None.
+        """
         self.interval = interval
         self.function = function
         self.queue = transaction_queue
         self.send_dummy = send_dummy
         self.dummy = dummy
+        self.high_water = high_water
+        self.controller = controller
+        self.logger = logger
+
+        # Fixed pool of workers, the condition caps the amount of transactions in flight
+        self.shared_pool = pool is not None
+        self.pool = pool or ThreadPoolExecutor(max_workers=workers, thread_name_prefix='throttle')
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.slots = threading.Condition()
+        self.last_dummy = 0.0
+
         self.e = threading.Event()
         self.t = threading.Thread(target=self.throttle)
         self.t.start()
 
+    def congested(self):
+        """
+        Backpressure signal for the socket loops, which should stop reading while this is True.
+        @return: Whether the in-flight cap or the queue high-water mark has been reached.
+        """
+        return self.in_flight >= self.limit() or self.queue.qsize() >= self.high_water
+
     def throttle(self):
-        while not self.e.wait(self.interval):
-            if self.send_dummy:
-                if self.queue.empty():
-                    self.dummy = (str(time.time()).encode(), -1, -1)
-                    arg = self.dummy
+        while not self.e.wait(self.pace()):
+            # Wait for a free slot before taking anything from the queue
+            with self.slots:
+                while self.in_flight >= self.limit():
+                    self.slots.wait()
+
+            # A transaction that cannot be packed is dropped, rather than stopping the sender
+            try:
+                if self.send_dummy and self.queue.empty():
+                    if not self.dummy_due():
+                        continue
+                    arg = self.dummy()
                 else:
                     arg = self.queue.get()
-            else:
-                arg = self.queue.get()
+                    # The queue has been closed
+                    if arg is None:
+                        continue
+            except Exception:
+                self.report('Failed to take a transaction')
+                continue
+
+            with self.slots:
+                self.in_flight += 1
+            try:
+                self.pool.submit(self.dispatch, arg)
+            except RuntimeError:
+                # The pool has been shut down, as happens when the interpreter exits
+                break
+
+    def dispatch(self, arg):
+        """
+        Perform a single transaction on a worker, and free up its slot afterwards.
+        @param arg: The arguments of the transaction.
+        """
+        start = time.monotonic()
+        try:
+            result = self.function(*arg)
+            self.feedback(result, time.monotonic() - start)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.slots:
+                self.in_flight -= 1
+                self.slots.notify()
+
+    def stop(self):
+        """
+        Stop dispatching, transactions in flight are allowed to complete.
+        """
+        self.e.set()
+        if not self.shared_pool:
+            self.pool.shutdown(wait=False)
+
+
+class AioThrottle(Pacer):
+    def __init__(self, interval, function, transaction_queue: asyncio.Queue, send_dummy=False, dummy=None,
+                 max_in_flight=32, controller: RateController = None, logger=None):
+        """
+        Asyncio counterpart of the Throttle, transactions run as tasks rather than on worker threads.
+        Backpressure comes from the bounded transaction queue, producers wait on put() when it is full.
+        @param interval: Time between dispatching two transactions, and between two dummy transactions when adaptive.
+        @param function: The coroutine function performing the transaction, see Throttle.
+        @param transaction_queue: The queue holding the arguments for the function, such as a Coalescer.
+        @param send_dummy: Whether to send dummy transactions when the queue is empty.
+        @param dummy: Callable returning the arguments of a dummy transaction.
+        @param max_in_flight: The maximum amount of transactions that are dispatched but not yet completed.
+        @param controller: Adapts the pace and the amount of transactions in flight, see Throttle.
+        @param logger: Logger for the errors of the throttle loop, see Throttle.
+        """
+        self.interval = interval
+        self.function = function
+        self.queue = transaction_queue
+        self.send_dummy = send_dummy
+        self.dummy = dummy
+        self.controller = controller
+        self.logger = logger
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.slots = asyncio.Condition()
+        self.last_dummy = 0.0
+        self.tasks = set()
+        self.t = asyncio.ensure_future(self.throttle())
+
+    async def throttle(self):
+        while True:
+            await asyncio.sleep(self.pace())
+
+            # Wait for a free slot before taking anything from the queue
+            async with self.slots:
+                await self.slots.wait_for(lambda: self.in_flight < self.limit())
+
+            # A transaction that cannot be packed is dropped, rather than stopping the sender
+            try:
+                if self.send_dummy and self.queue.empty():
+                    if not self.dummy_due():
+                        continue
+                    arg = self.dummy()
+                else:
+                    arg = await self.queue.get()
+            except Exception:
+                self.report('Failed to take a transaction')
+                continue
+
+            self.in_flight += 1
+            task = asyncio.ensure_future(self.dispatch(arg))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def dispatch(self, arg):
+        """
+        Perform a single transaction, and free up its slot afterwards.
+        @param arg: The arguments of the transaction.
+        """
+        start = time.monotonic()
+        try:
+            result = await self.function(*arg)
+            self.feedback(result, time.monotonic() - start)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            async with self.slots:
+                self.in_flight -= 1
+                self.slots.notify()
 
-            threading.Thread(target=self.function, args=arg).start()
+    def stop(self):
+        """
+        Stop dispatching, transactions in flight are allowed to complete.
+        """
+        self.t.cancel()
@@ -0,0 +1,330 @@
+import asyncio
+import queue
+import secrets
+import socket
+import struct
+import threading
+import time
+
+import grpc
+
+import lightning_pb2 as ln
+
+# Header of a record on the local TCP transport: key and length of the value
+RECORD = struct.Struct('>QI')
+# Length prefix of a payment on the local TCP transport, answered by a single status byte
+PAYMENT = struct.Struct('>I')
+SETTLED = b'\x01'
+
+
+class Transport:
+    """
+    The node a session sends and receives its payments through. Payments are keysend payments carrying custom records,
+    described by the SendPaymentRequest the session builds, and reported back as lnrpc Payment updates with their
+    status, amount, fee and failure reason, whatever carries them.
+    """
+
+    # Whether the routes of the payments can be queried and chosen, see RouteManager
+    routable = False
+
+    def __init__(self, pk: str):
+        """
+        @param pk: The public key of the node, payments are addressed to it.
+        """
+        self.pk = pk
+
+    def connect(self):
+        """
+        Start connecting, without waiting for the connection to complete.
+        """
+
+    def ready(self, timeout: float):
+        """
+        Wait for the connection started by connect.
+        @raise TimeoutError: When it did not complete within the timeout.
+        """
+
+    def subscribe(self):
+        """
+        Subscribe to the incoming payments, the subscription is in place once this returns.
+        @return: Iterator over the custom records of every incoming payment, as a dict of record key to value.
+        """
+        raise NotImplementedError
+
+    def send(self, request):
+        """
+        Send a keysend payment.
+        @param request: The SendPaymentRequest, its destination, amount, hash and custom records are used.
+        @return: Iterator over the Payment updates of the payment.
+        """
+        raise NotImplementedError
+
+    async def aio_subscribe(self):
+        """
+        Asyncio counterpart of subscribe, the incoming payments are taken from the subscription on a thread of its own.
+        @return: Asynchronous iterator over the custom records of every incoming payment.
+        """
+        loop = asyncio.get_running_loop()
+        incoming = asyncio.Queue()
+        payments = self.subscribe()
+
+        def pump():
+            try:
+                for records in payments:
+                    loop.call_soon_threadsafe(incoming.put_nowait, records)
+            finally:
+                loop.call_soon_threadsafe(incoming.put_nowait, None)
+        threading.Thread(target=pump, daemon=True).start()
+
+        while (records := await incoming.get()) is not None:
+            yield records
+
+    async def aio_send(self, request):
+        """
+        Asyncio counterpart of send, the payment is sent on a thread of the default executor.
+        @return: Asynchronous iterator over the Payment updates of the payment.
+        """
+        updates = await asyncio.get_running_loop().run_in_executor(None, lambda: list(self.send(request)))
+        for update in updates:
+            yield update
+
+
+class LndTransport(Transport):
+
+    routable = True
+
+    def __init__(self, pk, stub, routerstub, macaroon, channel=None):
+        """
+        A local LND node, reached over gRPC.
+        The stubs of a blocking channel serve subscribe and send, those of a grpc.aio channel aio_subscribe and aio_send.
+        @param pk: The public key of the node.
+        @param stub: The LightningStub of the node.
+        @param routerstub: The RouterStub of the node.
+        @param macaroon: The hex encoded admin macaroon of the node.
+        @param channel: The gRPC channel of the stubs, to wait for it to be connected.
+        """
+        super().__init__(pk)
+        self.stub = stub
+        self.routerstub = routerstub
+        self.macaroon = macaroon
+        self.channel = channel
+        self.future = None
+
+    def connect(self):
+        if self.channel is not None and self.future is None:
+            self.future = grpc.channel_ready_future(self.channel)
+
+    def ready(self, timeout: float):
+        if self.future is not None:
+            try:
+                self.future.result(timeout=timeout)
+            except grpc.FutureTimeoutError:
+                raise TimeoutError(f'The channel to {self.pk[:16]} did not connect within {timeout:.1f}s')
+
+    def subscribe(self):
+        # The call is started here, iterating merely waits for the invoices
+        invoices = self.stub.SubscribeInvoices(ln.InvoiceSubscription(), metadata=[('macaroon', self.macaroon)])
+        return (invoice.htlcs[0].custom_records for invoice in invoices if invoice.htlcs)
+
+    def send(self, request):
+        return self.routerstub.SendPaymentV2(request, metadata=[('macaroon', self.macaroon)])
+
+    async def aio_subscribe(self):
+        async for invoice in self.stub.SubscribeInvoices(ln.InvoiceSubscription(), metadata=[('macaroon', self.macaroon)]):
+            if invoice.htlcs:
+                yield invoice.htlcs[0].custom_records
+
+    async def aio_send(self, request):
+        async for update in self.routerstub.SendPaymentV2(request, metadata=[('macaroon', self.macaroon)]):
+            yield update
+
+
+class LoopbackNetwork:
+
+    def __init__(self, latency=0.0):
+        """
+        Nodes within a single process, handing every payment straight to the subscription of its destination.
+        Payments cost nothing and never fail unless the destination is unknown, so the Submarine and the Periscope run
+        at the speed of the protocol alone.
+        @param latency: Seconds every payment takes, 0 to deliver them at once.
+        """
+        self.latency = latency
+        self.nodes = {}
+        self.payments = 0
+
+    def node(self, pk: str = None):
+        """
+        Add a node to the network.
+        @param pk: The public key of the node, a random one when not given.
+        @return: The LoopbackTransport of the node.
+        """
+        node = LoopbackTransport(self, pk or secrets.token_hex(33))
+        self.nodes[node.pk] = node
+        return node
+
+
+class LoopbackTransport(Transport):
+
+    def __init__(self, network: LoopbackNetwork, pk: str):
+        super().__init__(pk)
+        self.network = network
+        self.incoming = queue.Queue()
+
+    def subscribe(self):
+        return iter(self.incoming.get, None)
+
+    def send(self, request):
+        if self.network.latency:
+            time.sleep(self.network.latency)
+
+        destination = self.network.nodes.get(bytes(request.dest).hex())
+        if destination is None:
+            return [ln.Payment(status=ln.Payment.FAILED, failure_reason=ln.PaymentFailureReason.FAILURE_REASON_NO_ROUTE)]
+
+        self.network.payments += 1
+        destination.incoming.put(dict(request.dest_custom_records))
+        return [ln.Payment(status=ln.Payment.SUCCEEDED, value_sat=request.amt, fee_sat=0)]
+
+
+def encode_records(records) -> bytes:
+    return b''.join(RECORD.pack(key, len(value)) + value for key, value in records.items())
+
+
+def decode_records(data: bytes):
+    """
+    @raise ValueError: When a record is cut short.
+    """
+    records = {}
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < RECORD.size:
+            raise ValueError('Truncated record header')
+        key, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if len(data) - offset < length:
+            raise ValueError('Truncated record')
+        records[key] = data[offset:offset + length]
+        offset += length
+    return records
+
+
+def read_exactly(sock: socket.socket, size: int):
+    """
+    @return: The bytes, None when the connection closed before all of them arrived.
+    """
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class TcpTransport(Transport):
+
+    def __init__(self, pk: str, port: int, peers, host='localhost', timeout=10.0):
+        """
+        Nodes on one machine or network reaching each other over TCP, with the processes of the Submarine and the
+        Periscope each running their own. Every payment is a length prefixed set of records, answered by the receiving
+        node once it handed them to its subscription. Connections are kept open and reused by the sending threads.
+        @param pk: The public key of the node.
+        @param port: The port the node listens on for payments, 0 for any free port.
+        @param peers: dict of public keys to (host, port) addresses of the other nodes.
+        @param host: The address the node listens on.
+        @param timeout: Seconds after which a payment that has not been answered fails.
+        """
+        super().__init__(pk)
+        self.port = port
+        self.peers = peers
+        self.host = host
+        self.timeout = timeout
+
+        self.incoming = queue.Queue()
+        self.server = None
+        self.lock = threading.Lock()
+
+        # Idle connections by destination, taken by a sending thread for the duration of a payment
+        self.idle = {}
+
+    def connect(self):
+        with self.lock:
+            if self.server is not None:
+                return
+            self.server = socket.create_server((self.host, self.port), backlog=128)
+            self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            connection, _ = self.server.accept()
+            threading.Thread(target=self.receive_loop, args=(connection,), daemon=True).start()
+
+    def receive_loop(self, connection: socket.socket):
+        """
+        Read the payments arriving on a connection, answering every one of them.
+        A malformed payment is not answered and drops the connection, the sender takes the payment as failed.
+        """
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with connection:
+            try:
+                while (header := read_exactly(connection, PAYMENT.size)) is not None:
+                    data = read_exactly(connection, PAYMENT.unpack(header)[0])
+                    if data is None:
+                        return
+                    self.incoming.put(decode_records(data))
+                    connection.sendall(SETTLED)
+            except (OSError, ValueError):
+                pass
+
+    def subscribe(self):
+        self.connect()
+        return iter(self.incoming.get, None)
+
+    def send(self, request):
+        destination = bytes(request.dest).hex()
+        address = self.peers.get(destination)
+        if address is None:
+            return [ln.Payment(status=ln.Payment.FAILED, failure_reason=ln.PaymentFailureReason.FAILURE_REASON_NO_ROUTE)]
+
+        data = encode_records(request.dest_custom_records)
+        try:
+            connection = self.take(destination, address)
+            connection.sendall(PAYMENT.pack(len(data)) + data)
+            settled = read_exactly(connection, len(SETTLED)) == SETTLED
+        except OSError:
+            settled = False
+            connection = None
+
+        if not settled:
+            if connection is not None:
+                connection.close()
+            return [ln.Payment(status=ln.Payment.FAILED, failure_reason=ln.PaymentFailureReason.FAILURE_REASON_ERROR)]
+
+        with self.lock:
+            self.idle.setdefault(destination, []).append(connection)
+        return [ln.Payment(status=ln.Payment.SUCCEEDED, value_sat=request.amt, fee_sat=0)]
+
+    def take(self, destination: str, address):
+        """
+        An idle connection to the destination, or a new one when all of them are in use.
+        """
+        with self.lock:
+            connections = self.idle.get(destination)
+            if connections:
+                return connections.pop()
+
+        connection = socket.create_connection(address, timeout=self.timeout)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+
+def tcp_transports(names, nodes, host='localhost'):
+    """
+    Local TCP transports for nodes of the credentials, every node listening on the port given for it.
+    Lets the Submarine and the Periscope run on one machine without LND, see load_credentials.
+    @param names: The names of the nodes to create the transports of.
+    @param nodes: The credentials of all nodes, the others are the peers.
+    """
+    peers = {node['pk']: (host, int(node['port'])) for node in nodes.values()}
+    return [TcpTransport(nodes[name]['pk'], int(nodes[name]['port']), peers, host) for name in names]
@@ -1,10 +1,17 @@
 import time
 import socket
+import threading
+from collections import OrderedDict
+
+from helpers import fec
+from helpers import packet as framing
+from helpers.compression import TubeDecompressor
 
 
 class Tube:
 
-    def __init__(self, tube_idx, closing_func, connection: socket.socket = None, hostname: str = None):
+    def __init__(self, tube_idx, closing_func, connection: socket.socket = None, hostname: str = None,
+                 window=1024, sent_limit=1024, history_limit=256):
         self.identifier = tube_idx
         self.packet_queue = {}
         self.connection = connection
@@ -16,6 +23,36 @@ class Tube:
         self.piping = True
 
         self.receive_index = 0
+        # Whether the last packet of the peer has been taken, an empty one marking the end of its stream
+        self.ended = False
+
+        # Compression contexts, the compressor is set once a codec has been negotiated for the tube
+        self.compressor = None
+        self.decompressor = TubeDecompressor()
+
+        # Reorder window, packets too far ahead of the delivered ones are dropped and requested again later on
+        self.window = window
+        self.highest = -1
+        self.gap_since = None
+        self.nacked_at = 0.0
+        self.acked_index = 0
+        self.acked_at = 0.0
+
+        # Packets sent to the peer that have not been acknowledged yet, kept for retransmission
+        self.sent = OrderedDict()
+        self.sent_limit = sent_limit
+        self.sent_lock = threading.Lock()
+
+        # Forward error correction: the received parity blocks, and the recently delivered packets they may need.
+        # When sending, parity_index is the first packet that is not covered by parity yet
+        self.parity = {}
+        self.history = OrderedDict()
+        self.history_limit = history_limit
+        self.parity_index = 0
+
+        # Payload bytes exchanged over the tube, for the metrics
+        self.bytes_sent = 0
+        self.bytes_received = 0
 
 
     def set_connection(self, connection: socket.socket):
@@ -35,9 +72,198 @@ class Tube:
 
 
     def get_packet(self):
+        """
+        Take the next packet in order.
+        @return: The decompressed content, None if the packet has not arrived yet. Empty content does not mean the end
+        of the stream, the codec may hold data back, see ended.
+        """
         packet = self.packet_queue.pop(self.receive_index, None)
+        if packet is None:
+            return None
 
-        if packet:
+        # Delivered packets are kept for a while, to rebuild lost packets of the same parity block
+        self.history[self.receive_index] = packet
+        if len(self.history) > self.history_limit:
+            self.history.popitem(last=False)
+
+        flags, content = packet
+        if content:
             self.receive_index += 1
+        else:
+            self.ended = True
+
+        return self.decompressor.decompress(flags, content)
+
+
+    def accept(self, packet_idx: int, flags: int, content: bytes):
+        """
+        Place a received packet in the reorder buffer.
+        @return: Whether the packet was accepted, duplicates and packets outside of the window are not.
+        """
+        if packet_idx < self.receive_index or packet_idx >= self.receive_index + self.window:
+            return False
+        if packet_idx in self.packet_queue:
+            return False
+
+        self.packet_queue[packet_idx] = (flags, content)
+
+        # A packet arriving beyond the next expected one opens a gap, which is timed from here on
+        if packet_idx > self.highest + 1 and self.gap_since is None:
+            self.gap_since = time.time()
+        self.highest = max(self.highest, packet_idx)
+        return True
+
+
+    def cumulative(self):
+        """
+        The index up to which every packet has been received.
+        """
+        idx = self.receive_index
+        while idx in self.packet_queue:
+            idx += 1
+        return idx
+
+
+    def missing(self, limit=32):
+        """
+        The indexes between the delivered packets and the highest received one that have not arrived yet.
+        @param limit: The maximum amount of indexes returned.
+        """
+        missing = []
+        for idx in range(self.receive_index, self.highest):
+            if idx not in self.packet_queue:
+                missing.append(idx)
+                if len(missing) == limit:
+                    break
+        return missing
+
+
+    def feedback(self, nack_delay: float, nack_interval: float, ack_interval: float):
+        """
+        Decide whether the peer should hear about the state of the reorder buffer.
+        Gaps are only reported after they persisted for a while, as payments regularly overtake each other.
+        @param nack_delay: The age a gap needs to reach before it is reported.
+        @param nack_interval: The time between two reports of the same gaps.
+        @param ack_interval: The minimum time between two plain acknowledgements.
+        @return: The cumulative index and the missing indexes, or None if there is nothing to report.
+        """
+        now = time.time()
+        missing = self.missing()
+
+        if not missing:
+            self.gap_since = None
+        else:
+            self.gap_since = self.gap_since or now
+            if now - self.gap_since >= nack_delay and now - self.nacked_at >= nack_interval:
+                self.nacked_at = now
+                self.acked_at = now
+                self.acked_index = self.cumulative()
+                return self.acked_index, missing
+
+        cumulative = self.cumulative()
+        if cumulative > self.acked_index and now - self.acked_at >= ack_interval:
+            self.acked_index = cumulative
+            self.acked_at = now
+            return cumulative, []
+
+
+    def remember(self, packet_idx: int, data: bytes, flags: int):
+        """
+        Keep a packet sent to the peer until it has been acknowledged, the oldest one is dropped when the buffer is full.
+        """
+        with self.sent_lock:
+            self.sent[packet_idx] = (data, flags)
+            if len(self.sent) > self.sent_limit:
+                self.sent.popitem(last=False)
+
+
+    def acknowledge(self, cumulative: int):
+        """
+        The peer received every packet below the cumulative index, they no longer have to be kept.
+        """
+        with self.sent_lock:
+            while self.sent and next(iter(self.sent)) < cumulative:
+                self.sent.popitem(last=False)
+
+
+    def retransmissions(self, missing):
+        """
+        Look up the packets the peer is missing.
+        @param missing: The packet indexes reported missing.
+        @return: list of (tube_idx, packet_idx, data, flags) tuples, for the packets that are still kept.
+        """
+        with self.sent_lock:
+            return [(int(self.identifier), idx, *self.sent[idx]) for idx in missing if idx in self.sent]
+
+
+    def received(self, packet_idx: int):
+        """
+        The (flags, content) of a received packet, None if it has not arrived or is no longer kept.
+        """
+        return self.packet_queue.get(packet_idx) or self.history.get(packet_idx)
+
+
+    def add_parity(self, packet_idx: int, payload: bytes):
+        """
+        Keep a parity block until it is either needed or covers only delivered packets.
+        Blocks too short to hold the parity header are dropped.
+        @param packet_idx: The index of the first packet covered by the block.
+        @param payload: The payload of the parity frame.
+        """
+        if len(payload) < fec.PARITY.size:
+            return
+        if packet_idx + fec.parity_count(payload) > self.receive_index:
+            self.parity[packet_idx] = payload
+
+
+    def repair(self):
+        """
+        Rebuild the lost packets of the parity blocks that miss a single packet.
+        @return: The amount of rebuilt packets.
+        """
+        repaired = 0
+        for start in sorted(self.parity):
+            payload = self.parity[start]
+            indexes = range(start, start + fec.parity_count(payload))
+
+            # Blocks that are complete or delivered entirely are of no use anymore
+            missing = [idx for idx in indexes if self.received(idx) is None]
+            if not missing or indexes.stop <= self.receive_index:
+                del self.parity[start]
+                continue
+            if len(missing) > 1:
+                continue
+
+            others = [self.received(idx) for idx in indexes if idx != missing[0]]
+            data, flags = fec.recover(payload, [(content, flags) for flags, content in others])
+            del self.parity[start]
+            if self.accept(missing[0], flags, data):
+                repaired += 1
+        return repaired
+
+
+    def protect(self, block: int, max_size: int):
+        """
+        Build a parity packet over the oldest sent packets that are not covered yet, and not acknowledged either.
+        @param block: The maximum amount of packets covered by the parity packet.
+        @param max_size: The maximum size of the parity payload.
+        @return: (tube_idx, packet_idx, data, flags) tuple of the parity packet, None if there is nothing to cover.
+        """
+        with self.sent_lock:
+            if not self.sent:
+                return None
+
+            start = max(self.parity_index, next(iter(self.sent)))
+            packets = []
+            for idx in range(start, min(start + block, self.sending_index)):
+                if idx not in self.sent or fec.parity_size(packets + [self.sent[idx]]) > max_size:
+                    break
+                packets.append(self.sent[idx])
+
+            # A packet too large to be covered is skipped
+            if not packets:
+                self.parity_index = min(start + 1, self.sending_index)
+                return None
 
-        return packet
\ No newline at end of file
+            self.parity_index = start + len(packets)
+            return int(self.identifier), start, fec.encode_parity(packets), framing.FLAG_PARITY
@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+
+from helpers.aio_session import AioSession, AioProxy
+from helpers.logger import Logger, INFO
+from helpers.session import load_credentials
+from helpers.transport import tcp_transports
+from helpers.throttle import AioThrottle, RateController
+from helpers.coalescer import AioCoalescer
+from session import Session as PeriscopeSession
+
+
+class Session(AioSession, PeriscopeSession):
+
+    def __init__(self, pk, cert, macaroon, port, new_socket_func, close_socket_func, logger, local_nodes=None):
+        super().__init__(pk, cert, macaroon, port, new_socket_func, close_socket_func, logger, local_nodes)
+        self.activated = asyncio.Event()
+        self.receiver_tasks = []
+
+    async def activate(self):
+        """
+        Listen and wait for the handshake of a submarine node before continuing.
+        @return: The public key of the submarine.
+        """
+        self.receiver_tasks = self.start_receivers()
+        await self.activated.wait()
+        return self.target_pk
+
+    def incoming_session_request(self, value):
+        super().incoming_session_request(value)
+        self.activated.set()
+
+
+class AioPeriscope(AioProxy):
+
+    def __init__(self, node, throttle_interval=0.0, throttle_dummy=False, max_in_flight=32, extra_nodes=(),
+                 linger=0.005, fec=0, rate_controller=None, weights=None, metrics_port=None, metrics_file=None,
+                 log_level=INFO, log_file=None, connect_timeout=10.0, attempt_delay=0.25, plain_ports=(80,),
+                 local_nodes=None):
+        """
+        @param local_nodes: Transports to serve through instead of the LND nodes, see helpers.transport.
+        """
+        super().__init__(Logger('PERI', log_level, log_file))
+        self.linger = linger
+        self.fec = fec
+        self.node = node
+        self.extra_nodes = extra_nodes
+        self.local_nodes = local_nodes
+        self.throttle_interval = throttle_interval
+        self.throttle_dummy = throttle_dummy
+        self.max_in_flight = max_in_flight
+        self.rate_controller = rate_controller
+        self.weights = weights
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.connecting = set()
+        self.connect_timeout = connect_timeout
+        self.attempt_delay = attempt_delay
+        # The remote ports submarines may open plain HTTP tubes to, tunnels always go to port 443
+        self.plain_ports = set(plain_ports)
+
+    async def run(self):
+        """
+        Wait for a submarine and serve its tubes until the invoice subscription ends.
+        """
+        node = self.node or {}
+        self.session = Session(node.get('pk'), node.get('cert'), node.get('mac'), node.get('port'), self.new_socket,
+                               self.close_socket, self.logger, self.local_nodes)
+        for extra in self.extra_nodes:
+            self.session.add_local_node(extra['pk'], extra['cert'], extra['mac'], extra['port'])
+
+        # Wait for a submarine registrant to appear
+        self.logger.log_inform('Waiting for incoming connections')
+        target_pk = await self.session.activate()
+        self.logger.log_inform(f'Established connection with {target_pk}')
+
+        # Start the throttle with the given parameters, fed by payments packed by the coalescer
+        self.t_queue = AioCoalescer(self.session, self.linger, fec_block=self.fec, host_weights=self.weights)
+        self.throttle = AioThrottle(self.throttle_interval, self.session.send_batch, self.t_queue, self.throttle_dummy,
+                                    self.t_queue.dummy, self.max_in_flight, self.rate_controller,
+                                    logger=self.logger)
+
+        # Expose the metrics on a local HTTP port and or as a periodically written snapshot file
+        self.session.instrument(self.t_queue, self.throttle)
+        self.session.export_metrics(self.metrics_port, self.metrics_file)
+
+        await asyncio.gather(*self.session.receiver_tasks)
+
+    def new_socket(self, port, hostname, remote_port=None):
+        """
+        Activate a new socket. This method gets called by the session object, who just received a session message that a new socket is to be established
+        The connection is set up in a task, so the receiver is not held up.
+        @param port:
+        @param hostname:
+        @param remote_port: The port of a plain HTTP tube, None for a tunnel to port 443.
+        """
+        if remote_port is not None and remote_port not in self.plain_ports:
+            self.session.connection_failed(port, f'plain HTTP to port {remote_port} is not allowed')
+            return
+
+        if port not in self.writers and port not in self.connecting:
+            self.connecting.add(port)
+            asyncio.ensure_future(self.open_connection(port, hostname, remote_port))
+
+    async def open_connection(self, port, hostname, remote_port=None):
+        """
+        Set up a new connection to the host and link it to its tube.
+        """
+        try:
+            # Racing the IPv6 and IPv4 addresses of the host
+            self.logger.log_inform(f'Trying to establish connection to {hostname}')
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(hostname, remote_port or 443, happy_eyeballs_delay=self.attempt_delay),
+                self.connect_timeout)
+            self.logger.log_inform(f'Established connection to {hostname}')
+
+        except (OSError, asyncio.TimeoutError) as e:
+            # Close the tube on the submarine as well
+            self.session.connection_failed(port, str(e) or 'timed out')
+            return
+
+        finally:
+            self.connecting.discard(port)
+
+        # Link socket to the tube object
+        self.logger.log_inform(f'New socket-tube pair for port {port}')
+        tube = self.session.tubes[int(port)]
+        tube.set_connection(writer)
+        tube.hostname = hostname
+        self.attach(port, reader, writer)
+
+        # Send confirmation of established socket back, plain HTTP tubes go straight to the response
+        if remote_port is None:
+            self.t_queue.write(port, b'HTTP/1.1 200 Connection established\r\n\r\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a submarine, tunneling its traffic over lightning payments, '
+                                                 'on a single asyncio event loop.')
+    parser.add_argument('--creds', default='../creds.txt', help='credentials of the nodes, see load_credentials')
+    parser.add_argument('--node', default='emiel', help='name of the local node in the credentials')
+    parser.add_argument('--extra-nodes', nargs='*', default=[], help='names of additional local nodes to reply through')
+    parser.add_argument('--transport', default='lnd', choices=['lnd', 'tcp'],
+                        help='receive through lnd, or straight from the submarine over tcp on the ports of the credentials')
+    parser.add_argument('--metrics-port', type=int, default=None)
+    parser.add_argument('--log-level', default='info', choices=['debug', 'info', 'error'])
+    args = parser.parse_args()
+
+    # Multiple nodes can be used by listing them in extra_nodes
+    nodes = load_credentials(args.creds)
+    local_nodes = tcp_transports([args.node, *args.extra_nodes], nodes) if args.transport == 'tcp' else None
+    extra_nodes = [nodes[name] for name in args.extra_nodes] if local_nodes is None else ()
+    asyncio.run(AioPeriscope(node=nodes[args.node], extra_nodes=extra_nodes, local_nodes=local_nodes,
+                             rate_controller=RateController(rate=200.0, max_rate=1000.0),
+                             metrics_port=args.metrics_port, log_level=args.log_level).run())
+
+
+if __name__ == '__main__':
+    main()
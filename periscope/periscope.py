@@ -1,166 +1,323 @@
-import select
-import socket
-import csv
-import sys
-import queue
+import argparse
+import selectors
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from threading import Thread
 
-from session import Session
-from helpers.logger import Logger
-from helpers.throttle import Throttle
+from session import Session, SessionManager
+from helpers.session import connect_node, load_credentials
+from helpers.transport import tcp_transports
+from helpers.logger import Logger, INFO
+from helpers.throttle import Throttle, RateController
+from helpers.coalescer import Coalescer
+from helpers.socket_map import SocketMap
+from helpers.connector import Connector
+from helpers.routes import RouteManager
 
+# Amount of bytes read from a socket at once, the coalescer cuts them into payments
+RECV_SIZE = 16384
 
-class Periscope:
-
-    def __init__(self, node, throttle_interval=0.0, throttle_dummy=False):
-        self.logger = Logger('PERI')
-
-        # Sockets from which we expect to read or write
-        self.inputs = []
-        self.outputs = []
+# Seconds between two checks of the throttles for congestion, which takes a look at every session
+BACKPRESSURE_INTERVAL = 0.01
 
-        # Dictionary object to keep track of which sockets belong to which tube
-        self.socket_tube_dict = {}
 
-        # Session object that interacts with the lightning protocol
-        self.session = Session(node['pk'], node['cert'], node['mac'], node['port'], self.new_socket,
-                               self.close_socket, self.logger)
+class Periscope:
 
-        # Wait for a submarine registrant to appear
+    def __init__(self, node, throttle_interval=0.0, throttle_dummy=False, extra_nodes=(), linger=0.005,
+                 fec=0, controller_factory=None, weights=None, metrics_port=None, metrics_file=None,
+                 log_level=INFO, log_file=None, workers=64, max_sessions=1024, idle_timeout=120.0, remote_port=443,
+                 local_nodes=None, connect_timeout=10.0, pool_size=0, prewarm=(), decode_workers=1,
+                 plain_ports=(80,), route_cache=False, dns_ttl=60.0):
+        """
+        Serves any amount of submarines at once, every one of them with its own session, coalescer and throttle.
+        @param controller_factory: Callable creating the rate controller of a session, None for a fixed pace.
+        @param workers: The amount of worker threads performing the payments, shared by every session.
+        @param max_sessions: The maximum amount of submarines served at once.
+        @param idle_timeout: Seconds without payments after which a session is closed along with its tubes, None to keep it.
+        @param remote_port: The port the tubes connect to on the remote hosts.
+        @param local_nodes: Transports to serve through instead of the LND nodes node and extra_nodes, see helpers.transport.
+        @param connect_timeout: Seconds after which connecting a tube to its host is given up.
+        @param pool_size: The amount of pre-connected sockets kept for frequently requested hosts, 0 disables the pool.
+        @param prewarm: Hostnames that are kept pre-connected from the start, given pool_size.
+        @param decode_workers: The amount of threads decoding the received data records.
+        @param plain_ports: The remote ports submarines may open plain HTTP tubes to, next to the tunnels to remote_port.
+        @param route_cache: Reply over routes queried once per submarine and cached, shared by all sessions.
+        @param dns_ttl: Seconds the addresses of the remote hosts are cached, 0 resolves them for every tube.
+        """
+        # Per-packet messages are only logged at the DEBUG level, log_file receives the records as JSON lines
+        self.logger = Logger('PERI', log_level, log_file)
+
+        # Settings of the coalescer and throttle of every session
+        self.throttle_interval = throttle_interval
+        self.throttle_dummy = throttle_dummy
+        self.linger = linger
+        self.fec = fec
+        self.controller_factory = controller_factory
+        self.weights = weights
+        self.remote_port = remote_port
+        self.plain_ports = set(plain_ports)
+
+        # Sockets from which we expect to read or write, indexed both ways between sockets and (session, tube) pairs
+        self.sockets = SocketMap()
+
+        # Connections to the remote hosts are set up off the receiving threads, the tubes being connected and the
+        # connected sockets waiting to be picked up by the server loop
+        self.connector = Connector(timeout=connect_timeout, dns_ttl=dns_ttl, pool_size=pool_size,
+                                   prewarm=[(hostname, remote_port) for hostname in prewarm], logger=self.logger)
+        self.connecting = set()
+        self.connected = deque()
+
+        # Workers shared by the throttles, so the amount of threads does not grow with the amount of sessions
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='throttle')
+
+        # The sessions of the submarines, all of them receiving and replying through the same local nodes
+        # Additional local nodes are used for replies as well, they are striped over all of them
+        if local_nodes is None:
+            local_nodes = [connect_node(n['pk'], n['cert'], n['mac'], n['port']) for n in [node, *extra_nodes]]
+        self.sessions = SessionManager(local_nodes, self.logger, self.open_session, self.close_session,
+                                       max_sessions, idle_timeout, decode_workers)
+
+        # Replies to a submarine all go the same way, its routes are looked up once for every session it opens
+        self.routes = RouteManager(self.logger, self.sessions.metrics) if route_cache else None
+
+        # Expose the metrics on a local HTTP port and or as a periodically written snapshot file
+        if metrics_port is not None:
+            self.sessions.metrics.serve(metrics_port)
+            self.logger.log_inform(f'Serving metrics on http://localhost:{metrics_port}/metrics')
+        if metrics_file is not None:
+            self.sessions.metrics.snapshot_every(metrics_file)
+
+        # Wait for submarine registrants to appear
         self.logger.log_inform('Waiting for incoming connections')
-        target_pk = self.session.activate()
-        self.logger.log_inform(f'Established connection with {target_pk}')
-
-        # Start the throttle with the given parameters if desired
-        self.t_queue = queue.Queue()
-        Throttle(throttle_interval, self.session.send, self.t_queue, throttle_dummy, (b'0', -1, -1))
+        self.sessions.start()
 
         # Start the main server loop
         self.server_loop()
 
+    def open_session(self, session_id):
+        """
+        Create the session of a new submarine, with a coalescer and throttle of its own.
+        Called by the SessionManager upon the handshake of an unknown session record.
+        """
+        session = Session(None, None, None, None, partial(self.new_socket, session_id),
+                          partial(self.close_socket, session_id), self.logger,
+                          local_nodes=self.sessions.local_nodes, crypt=self.sessions.crypt)
+        session.session_id = session_id
+        session.routes = self.routes
+
+        # The receiving threads wake up the loop as soon as a tube has data to be written to its socket
+        session.deliverable_func = lambda tube_idx: self.sockets.notify((session_id, tube_idx))
+
+        # Start the throttle with the given parameters if desired, fed by payments packed by the coalescer
+        # Parity only travels in dummy payments, so fec is of use together with throttle_dummy
+        # Bulk tubes share the payments by the weights of their hosts, given as a dict of hostname suffix to weight
+        session.coalescer = Coalescer(session, self.linger, fec_block=self.fec, host_weights=self.weights)
+        # With a rate controller the pace follows the measured payment completions of this submarine
+        controller = self.controller_factory() if self.controller_factory is not None else None
+        session.throttle = Throttle(self.throttle_interval, session.send_batch, session.coalescer, self.throttle_dummy,
+                                    session.coalescer.dummy, controller=controller, pool=self.pool,
+                                    logger=self.logger)
+        session.instrument(session.coalescer, session.throttle)
+        return session
+
+    def close_session(self, session):
+        """
+        Close the sockets of a session that has been replaced or went idle, and stop its throttle.
+        """
+        for tube_idx in list(session.tubes):
+            self.close_socket(session.session_id, tube_idx)
+            session.tubes.pop(tube_idx, None)
+        session.throttle.stop()
+        session.coalescer.close()
+
     def server_loop(self):
         """
-        The server loop of the Periscope, listens on all the sockets for data to be transmitted over lightning to the Submarine
+        The server loop of the Periscope, listens on all the sockets for data to be transmitted over lightning to the Submarines
         """
+        congested = False
+        checked = 0.0
         while True:
 
-            # No sockets to be read, wait until there are
-            while not self.inputs:
-                time.sleep(0.1)
-
-            # Purge closed sockets from the inputs
-            self.inputs = [s for s in self.inputs if s.fileno() != -1]
+            # Stop reading from the remote hosts of the submarines whose throttle is saturated
+            if time.monotonic() - checked >= BACKPRESSURE_INTERVAL:
+                congested = self.apply_backpressure()
+                checked = time.monotonic()
 
-            try:
-                # Wait for at least one of the sockets to be ready for processing
-                readable, writable, exceptional = select.select(self.inputs, self.outputs, self.inputs, 1)
-            except ValueError as v:
-                # Purge closed sockets from the inputs
-                self.inputs = [s for s in self.inputs if s.fileno() != -1]
-                self.outputs = [s for s in self.outputs if s.fileno() != -1]
-                continue
+            # Wait for at least one of the sockets to be ready for processing
+            ready = self.sockets.select(0.05 if congested else 1)
 
-            # Handle inputs
-            for s in readable:
+            # Link the sockets that connected in the meantime to their tubes
+            while self.connected:
+                self.attach(*self.connected.popleft())
 
-                # Find the accompanying tube
-                tube_idx = self.socket_tube_dict[s]
-
-                try:
-                    # Receive buffers in chunks that are transmittable
-                    data = s.recv(850)
-
-                except (ConnectionResetError, ConnectionAbortedError, OSError) as e:
-                    self.logger.log_error(
-                        f'Exception occurred on tube {tube_idx}, will close down socket and inform peer: {e}')
-
-                    # Discard the socket locally and inform peer
-                    Thread(target=self.session.local_socket_close, args=(tube_idx,)).start()
+            for s, key, events in ready:
+                session_id, tube_idx = key
+                session = self.sessions.get(session_id)
+                if session is None:
+                    self.close_socket(session_id, tube_idx)
                     continue
 
-                # Send data through the tunnel
-                assigned_index = self.session.tubes[tube_idx].assign_index()
-                self.t_queue.put((data, assigned_index, tube_idx))
-
-                if not data:
-                    self.logger.log_inform(
-                        f'Socket {tube_idx} concluded gracefully, will close down socket and inform peer')
-
-                    # Discard the socket locally and inform the periscope node
-                    self.close_socket(tube_idx)
-
-            for s in writable:
-                # Get the packet if it's there
-                if s in self.socket_tube_dict:
-                    data = self.session.get_packet(self.socket_tube_dict[s])
-                    if data:
-                        s.sendall(data)
-                        self.logger.log_inform(f'Sending {sys.getsizeof(data)} to socket')
-
-            for s in exceptional:
-                self.inputs.remove(s)
-                if s in self.outputs:
-                    self.outputs.remove(s)
-                s.close()
-
-    def new_socket(self, port, hostname):
+                # Handle inputs
+                if events & selectors.EVENT_READ:
+                    try:
+                        # Receive buffers, the coalescer cuts them into transmittable chunks
+                        data = s.recv(RECV_SIZE)
+
+                    except (ConnectionResetError, ConnectionAbortedError, OSError) as e:
+                        self.logger.log_error(
+                            f'Exception occurred on tube {tube_idx}, will close down socket and inform peer: {e}')
+
+                        # Discard the socket locally and inform peer
+                        Thread(target=session.local_socket_close, args=(tube_idx,)).start()
+                        continue
+
+                    # Send data through the tunnel
+                    session.coalescer.write(tube_idx, data)
+
+                    if not data:
+                        self.logger.log_inform(
+                            f'Socket {tube_idx} concluded gracefully, will close down socket and inform peer')
+
+                        # Discard the socket locally and inform the periscope node
+                        self.close_socket(session_id, tube_idx)
+                        continue
+
+                # Write the packets that are in order, only watched for while there are any
+                if events & selectors.EVENT_WRITE and key in self.sockets:
+                    try:
+                        written = self.sockets.deliver(key, lambda: session.get_packet(tube_idx))
+                    except (ConnectionResetError, ConnectionAbortedError, OSError) as e:
+                        self.logger.log_error(
+                            f'Exception occurred on tube {tube_idx}, will close down socket and inform peer: {e}')
+
+                        # Discard the socket locally and inform peer
+                        Thread(target=session.local_socket_close, args=(tube_idx,)).start()
+                        continue
+                    if self.logger.debug:
+                        self.logger.log_debug(f'Sending {written} to socket', 'socket')
+
+    def apply_backpressure(self):
+        """
+        Pause reading the sockets of the sessions whose throttle is saturated, and resume those that caught up.
+        @return: Whether any session is congested.
+        """
+        congested = False
+        for session in self.sessions.values():
+            if session.throttle.congested() != session.congested:
+                session.congested = not session.congested
+                for tube_idx in list(session.tubes):
+                    self.sockets.set_paused((session.session_id, int(tube_idx)), session.congested)
+            congested = congested or session.congested
+        return congested
+
+    def new_socket(self, session_id, port, hostname, remote_port=None):
         """
         Activate a new socket. This method gets called by the session object, who just received a session message that a new socket is to be established
+        @param session_id: The session record of the submarine.
         @param port:
         @param hostname:
+        @param remote_port: The port of a plain HTTP tube, None for a tunnel to the remote port of the Periscope.
         """
-        # If not already existing, create a new socket
-        if port not in self.socket_tube_dict.values():
-            # Setup a new connection to this host
+        key = (session_id, int(port))
+        tunnel = remote_port is None
+
+        if not tunnel and remote_port not in self.plain_ports:
+            self.connection_done(key, hostname, tunnel, None, f'plain HTTP to port {remote_port} is not allowed')
+            return
+
+        # If not already existing or being set up, connect to the host without holding up the receiving thread
+        if key not in self.sockets and key not in self.connecting:
+            self.connecting.add(key)
             self.logger.log_inform(f'Trying to establish connection to {hostname}')
-            sock = socket.create_connection((hostname, 443))
-            self.logger.log_inform(f'Established connection to {hostname}')
+            self.connector.connect(hostname, self.remote_port if tunnel else remote_port,
+                                   partial(self.connection_done, key, hostname, tunnel))
+
+    def connection_done(self, key, hostname, tunnel, sock, error):
+        """
+        The connector finished setting up the connection of a tube, hand it over to the server loop.
+        """
+        self.connected.append((key, hostname, tunnel, sock, error))
+        self.sockets.notify(key)
+
+    def attach(self, key, hostname, tunnel, sock, error):
+        """
+        Link a newly connected socket to its tube, or close the tube when the connection failed.
+        Runs on the server loop, which owns the socket map.
+        """
+        self.connecting.discard(key)
+        session_id, port = key
+        session = self.sessions.get(session_id)
+
+        # The session or the tube may have been closed while connecting
+        if session is None or port not in session.tubes:
+            if sock is not None:
+                sock.close()
+            return
+
+        if sock is None:
+            Thread(target=session.connection_failed, args=(port, error)).start()
+            return
+
+        self.logger.log_inform(f'Established connection to {hostname}')
 
-            # Actively listen on the socket
-            self.inputs.append(sock)
-            self.outputs.append(sock)
+        # Link socket to the tube object, and actively listen on the socket unless the session is congested
+        self.logger.log_inform(f'New socket-tube pair for port {port}')
 
-            # Link socket to the tube object
-            self.logger.log_inform(f'New socket-tube pair for port {port}')
+        self.sockets.set_paused(key, session.congested)
+        self.sockets.add(key, sock)
+        tube = session.tubes[port]
+        tube.set_connection(sock)
+        tube.hostname = hostname
 
-            self.socket_tube_dict[sock] = port
-            tube = self.session.tubes[int(port)]
-            tube.set_connection(sock)
-            tube.hostname = hostname
+        # Packets may have arrived before the socket was there
+        self.sockets.notify(key)
 
-            # Send confirmation of established socket back
-            self.t_queue.put((b'HTTP/1.1 200 Connection established\r\n\r\n', tube.assign_index(), port))
+        # Send confirmation of established socket back, plain HTTP tubes go straight to the response
+        if tunnel:
+            session.coalescer.write(port, b'HTTP/1.1 200 Connection established\r\n\r\n')
 
-    def close_socket(self, tube_idx):
+    def close_socket(self, session_id, tube_idx):
         """
         Cleanup for the closing tube.
+        @param session_id: The session record of the submarine.
         @param tube_idx: tube identifier.
         """
-        if tube_idx in self.socket_tube_dict.values():
-            for s, idx in self.socket_tube_dict.items():
-                if idx == tube_idx:
-                    self.logger.log_inform(f'Closing socket on port {tube_idx}')
-
-                    s.shutdown(1)
-                    s.close()
-                    self.inputs.remove(s)
-                    self.outputs.remove(s)
-                    del self.socket_tube_dict[s]
-                    del s
-                    self.logger.log_inform(f'Successfully closed socket on port {tube_idx}')
-                    return
-
-
-# Preload information of the involved nodes
-nodes = {}
-with open('../creds.txt') as credentials:
-    csv_reader = csv.reader(credentials, delimiter=',')
-    line_count = 0
-    for row in csv_reader:
-        nodes[row[0]] = {'cert': row[1], 'mac': row[2], 'pk': row[3], 'port': row[4]}
-
-# Select the current node
-node = nodes['emiel']
-
-peri = Periscope(node=node, )
+        s = self.sockets.remove((session_id, int(tube_idx)))
+        if s is None:
+            return
+
+        self.logger.log_inform(f'Closing socket on port {tube_idx}')
+        try:
+            s.shutdown(1)
+        except OSError:
+            pass
+        s.close()
+        self.logger.log_inform(f'Successfully closed socket on port {tube_idx}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve submarines, tunneling their traffic over lightning payments.')
+    parser.add_argument('--creds', default='../creds.txt', help='credentials of the nodes, see load_credentials')
+    parser.add_argument('--node', default='emiel', help='name of the local node in the credentials')
+    parser.add_argument('--extra-nodes', nargs='*', default=[], help='names of additional local nodes to reply through')
+    parser.add_argument('--transport', default='lnd', choices=['lnd', 'tcp'],
+                        help='receive through lnd, or straight from the submarines over tcp on the ports of the credentials')
+    parser.add_argument('--route-cache', action='store_true', help='reply over cached routes to every submarine')
+    parser.add_argument('--dns-ttl', type=float, default=60.0,
+                        help='seconds the addresses of the remote hosts are cached, the records do not tell their TTL')
+    parser.add_argument('--metrics-port', type=int, default=None)
+    parser.add_argument('--log-level', default='info', choices=['debug', 'info', 'error'])
+    args = parser.parse_args()
+
+    # Multiple nodes can be used by listing them in extra_nodes
+    nodes = load_credentials(args.creds)
+    local_nodes = tcp_transports([args.node, *args.extra_nodes], nodes) if args.transport == 'tcp' else None
+    Periscope(node=nodes[args.node], extra_nodes=[nodes[name] for name in args.extra_nodes], local_nodes=local_nodes,
+              controller_factory=partial(RateController, rate=200.0, max_rate=1000.0), metrics_port=args.metrics_port,
+              log_level=args.log_level, route_cache=args.route_cache, dns_ttl=args.dns_ttl)
+
+
+if __name__ == '__main__':
+    main()
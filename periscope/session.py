@@ -1,32 +1,47 @@
 import time
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
 
 from helpers.tube import Tube
-from helpers.session import Session as ParentSession
+from helpers.crypt import PreimagePool
+from helpers.metrics import Registry
+from helpers.pipeline import ReceivePipeline
+from helpers.session import Session as ParentSession, wait_ready
+from helpers import packet as framing
 
 
 class Session(ParentSession):
 
-    def __init__(self, pk, cert, macaroon, port, new_socket_func, close_socket_func, logger):
-        super().__init__(pk, cert, macaroon, port, close_socket_func, logger)
+    def __init__(self, pk, cert, macaroon, port, new_socket_func, close_socket_func, logger, local_nodes=None,
+                 crypt=None):
+        super().__init__(pk, cert, macaroon, port, close_socket_func, logger, local_nodes, crypt)
 
         self.target_pk = None
         self.new_socket = new_socket_func
 
+        # Replies towards the submarine travel a different route, leaving more room in the onion
+        self.record_size = 1149
+
+        # When served by a SessionManager: the session record of the submarine, the time its last payment arrived,
+        # the throttle sending the replies and whether the throttle is saturated
+        self.session_id = None
+        self.last_seen = time.time()
+        self.throttle = None
+        self.congested = False
+
+        # The offer of the session request being received, see framing.HANDSHAKE_RECORD
+        self.offer = None
+
 
     def activate(self):
         """
         Dummy method: Listen and perform a handshake with the periscope node before continuing
         """
-        receiver_thread = Thread(target=self.receiver)
-        receiver_thread.start()
+        self.start_receivers()
 
         # Wait for acknowledgement of session before continuing
-        while True:
-            if self.target_pk is not None:
-                return self.target_pk
-            else:
-                time.sleep(0.1)
+        self.handshake_done.wait()
+        return self.target_pk
 
 
     def receive_session_message(self, message: str):
@@ -48,29 +63,312 @@ class Session(ParentSession):
 
             # Socket close message
             2: lambda c: self.remote_socket_close(c),
+
+            # Compression offer message
+            3: lambda c: self.receive_compression_offer(c),
+
+            # Acknowledgement of received packets, possibly requesting missing ones
+            5: lambda c: self.receive_feedback(c),
         }
 
         # Direct the message to the right handler, or default to logging it as invalid
         switcher.get(m_type, lambda _: self.logger.log_error(f'Invalid message type {m_type}'))(m_content)
 
 
+    def dispatch(self, context, packets):
+        """
+        Direct the decoded packets of a data record, the offer of a handshake is taken before its session request.
+        @param context: The handshake record of the payment, None when it carries none.
+        """
+        if context is not None:
+            self.offer = context.decode(errors='replace')
+        super().dispatch(context, packets)
+
+
     def incoming_socket_request(self, value):
         """
         The submarine has started a new connection, create a tube and setup a new socket
-        @param value: Session message containing the port and hostname
+        @param value: Session message containing the port and hostname, followed by the remote port for plain HTTP tubes
         """
-        port, hostname = value.split(':', 1)
+        port, hostname, *remote_port = value.split(':', 2)
+        remote_port = int(remote_port[0]) if remote_port and remote_port[0].isdigit() else None
 
         self.logger.log_inform(f'Created a new tube {port} for {hostname}')
         self.tubes[int(port)] = Tube(tube_idx=port, closing_func=self.local_socket_close)
 
-        self.new_socket(int(port), hostname)
+        self.new_socket(int(port), hostname, remote_port)
+
+
+    def connection_failed(self, port, error):
+        """
+        The connection of a tube to its host could not be set up, close the tube on both sides.
+        @param port: The index of the tube.
+        @param error: The reason the connection failed.
+        """
+        self.logger.log_error(f'Could not connect tube {port}: {error}')
+        self.tubes.pop(int(port), None)
+
+        message = f'2:{port}'
+        if self.coalescer is not None and self.frame_version != framing.LEGACY_VERSION:
+            self.coalescer.post(message.encode())
+        else:
+            self.send_session_message(message)
 
 
     def incoming_session_request(self, value):
         """
         Dummy handshake method to reply to a Submarine's session request
-        @param value: The public key of the Submarine node
+        @param value: The public key of the primary Submarine node. Its other nodes, the frame versions it supports and
+        the record of the session it replaces come with the offer, legacy Submarines do not send one.
+        """
+        offer, self.offer = self.offer or '', None
+        pks, _, rest = offer.partition(':')
+        versions, _, _ = rest.partition(':')
+        self.frame_version = framing.negotiate_version(versions)
+        self.set_targets([value] + [pk for pk in pks.split(',') if pk and pk != value])
+
+        self.handshake_done.set()
+
+        # Legacy submarines do not offer any versions and expect a bare status
+        if not versions:
+            self.send_session_message('0:ACTIVE')
+            return
+
+        # Announce our own nodes, so the submarine can stripe its payments over them
+        own_pks = ','.join(node.pk for node in self.local_nodes)
+        self.send_session_message(f'0:ACTIVE:{self.frame_version}:{own_pks}')
+
+
+def handshake_request(packets, offer: bytes = None):
+    """
+    Read the session request out of the decoded packets of a handshake and its offer.
+    @param offer: The handshake record of the payment, see framing.HANDSHAKE_RECORD.
+    @return: The primary public key of the submarine and the record of the previous session it names, either None
+    when missing.
+    """
+    # [public keys]:[frame versions]:[previous session record]
+    previous = (offer or b'').decode(errors='replace').split(':', 2)[2:]
+    try:
+        proof = bytes.fromhex(previous[0]) if previous and previous[0] else None
+    except ValueError:
+        proof = None
+
+    for tube_idx, _, _, payload in packets:
+        if tube_idx == 0 and payload.startswith(b'0:'):
+            return payload[2:].decode(errors='replace') or None, proof
+    return None, proof
+
+
+class SessionManager:
+
+    def __init__(self, local_nodes, logger, open_session, close_session, max_sessions=1024, idle_timeout=120.0,
+                 decode_workers=1, handshake_workers=4, max_handshakes=64):
+        """
+        Serves any amount of submarines through the same local nodes, with a Session for every submarine.
+        Payments are told apart by the session record the submarines send along, legacy submarines that do not send one
+        share a single session. A session is opened by the handshake of an unknown session record. A submarine
+        registering again under the same public key replaces its previous session only when its handshake names the
+        record of that session, which only the submarine knows, otherwise it is ignored while the previous one is served.
+        @param local_nodes: The Transports to receive and reply through, shared by every session.
+        @param logger: The logger.
+        @param open_session: Callable creating the Session for a session record, ready to receive its handshake.
+        @param close_session: Callable tearing down a session that has been replaced or has gone idle.
+        @param max_sessions: The maximum amount of sessions, handshakes beyond it are ignored.
+        @param idle_timeout: Seconds without payments after which a session is closed along with its tubes, None to keep
+        it. Submarines pay dummies while idle, so a session this silent has been abandoned.
+        @param decode_workers: The amount of threads decoding the data records, see ReceivePipeline.
+        @param handshake_workers: The amount of threads opening sessions.
+        @param max_handshakes: The maximum amount of handshakes waiting for or being processed by those threads,
+        handshakes beyond it are ignored.
+        """
+        self.local_nodes = list(local_nodes)
+        self.logger = logger
+        self.open_session = open_session
+        self.close_session = close_session
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.decode_workers = decode_workers
+        self.max_handshakes = max_handshakes
+
+        # Preimages shared by the sessions, they are all paying from the same nodes
+        self.crypt = PreimagePool()
+
+        # Sessions by session record, and the session record of every submarine public key
+        self.sessions = {}
+        self.by_pk = {}
+        self.lock = Lock()
+
+        # Sessions are opened on a bounded pool, the session records of the handshakes it has been handed
+        # keep a submarine paying its handshake again from taking up more than a single turn
+        self.handshakes = ThreadPoolExecutor(max_workers=handshake_workers, thread_name_prefix='handshake')
+        self.handshaking = set()
+
+        # Timing of the acknowledgements, see Session
+        self.ack_interval = 1.0
+
+        self.metrics = Registry()
+        self.create_metrics()
+
+        # Stages between the invoice streams and the sessions, created along with the receivers
+        self.pipeline = None
+
+    def create_metrics(self):
         """
-        self.target_pk = value
-        self.send_session_message('0:ACTIVE')
+        Register the metrics summed over the sessions, next to a few series per session.
+        """
+        m = self.metrics
+        m.gauge('sessions', 'Submarines being served', function=lambda: len(self.sessions))
+        m.gauge('open_tubes', 'Tubes currently open', function=lambda: sum(len(s.tubes) for s in self.values()))
+        m.gauge('queue_depth', 'Payments worth of data waiting to be sent',
+                function=lambda: sum(s.coalescer.qsize() for s in self.values() if s.coalescer is not None))
+        m.gauge('in_flight', 'Payments dispatched but not completed',
+                function=lambda: sum(s.throttle.in_flight for s in self.values() if s.throttle is not None))
+        m.gauge('fees_sat_total', 'Routing fees paid in sat', function=lambda: sum(s.fees.value() for s in self.values()))
+        m.gauge('session_payments', 'Payments per session by outcome', ('session', 'outcome'),
+                function=lambda: {(self.label(s), outcome): s.payments.value(outcome=outcome)
+                                  for s in self.values() for outcome in ('succeeded', 'failed')})
+        m.gauge('session_bytes_sent', 'Payload bytes delivered per session', ('session',),
+                function=lambda: {(self.label(s),): s.bytes_sent.value() for s in self.values()})
+        m.gauge('session_queue_depth', 'Payments worth of data waiting to be sent per session', ('session',),
+                function=lambda: {(self.label(s),): s.coalescer.qsize() for s in self.values() if s.coalescer is not None})
+
+    @staticmethod
+    def label(session):
+        return session.session_id.hex() if session.session_id is not None else 'legacy'
+
+    def start(self, timeout=10.0):
+        """
+        Start a receiving thread for every local node, and the thread acknowledging the packets of every session.
+        The transports are connected first, so the first handshake is not held up by connecting them.
+        The receivers only hand the data records to the pipeline, which decodes and dispatches them on threads of its own.
+        @param timeout: The maximum amount of seconds to wait for the transports.
+        """
+        wait_ready(self.local_nodes, timeout)
+        self.pipeline = ReceivePipeline(self.dispatch, self.logger, self.metrics, self.decode_workers)
+        for node in self.local_nodes:
+            Thread(target=self.receiver, args=(node,)).start()
+        Thread(target=self.feedback_loop).start()
+
+    def receiver(self, node):
+        """
+        Consume the incoming payments of a local node, handing every data record to the pipeline with its session.
+        """
+        for records in node.subscribe():
+            payload = records.get(framing.DATA_RECORD)
+            if payload is None:
+                continue
+
+            self.pipeline.put(payload, (records.get(framing.SESSION_RECORD), records.get(framing.HANDSHAKE_RECORD)))
+
+    def dispatch(self, context, packets):
+        """
+        Direct the decoded packets of a data record to the session it belongs to, from the dispatch stage of the pipeline.
+        @param context: The session record and the handshake record of the payment, either None when missing.
+        """
+        session_id, offer = context
+        session = self.sessions.get(session_id)
+
+        # Sessions are opened on the handshake pool, so the replies of the other sessions are not held up
+        if session is None:
+            if not framing.is_handshake(packets):
+                self.logger.log_error(f'Dropped a payment of unknown session {session_id}')
+                return
+
+            with self.lock:
+                if session_id in self.handshaking:
+                    self.logger.log_inform(f'Ignored a handshake of session {session_id}, which is already in progress')
+                    return
+                if len(self.handshaking) >= self.max_handshakes:
+                    self.logger.log_error(f'Ignored session {session_id}, already processing '
+                                          f'{len(self.handshaking)} handshakes')
+                    return
+                self.handshaking.add(session_id)
+            self.handshakes.submit(self.handshake, session_id, packets, offer)
+            return
+
+        session.last_seen = time.time()
+        session.dispatch(offer, packets)
+
+    def handshake(self, session_id, packets, offer: bytes = None):
+        """
+        Open the session of a submarine and process its handshake.
+        @param session_id: The session record of the submarine, None for legacy submarines.
+        @param packets: The decoded packets of the data record holding the handshake.
+        @param offer: The handshake record of the payment, None for legacy submarines.
+        """
+        try:
+            self.open(session_id, packets, offer)
+        except Exception as e:
+            self.logger.log_error(f'Failed to open session {session_id}: {e!r}')
+        finally:
+            with self.lock:
+                self.handshaking.discard(session_id)
+
+    def open(self, session_id, packets, offer: bytes = None):
+        """
+        Open the session of a submarine and process its handshake, see handshake.
+        """
+        pk, proof = handshake_request(packets, offer)
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                if len(self.sessions) >= self.max_sessions:
+                    self.logger.log_error(f'Ignored session {session_id}, already serving {len(self.sessions)} sessions')
+                    return
+
+                # The public key is merely claimed by the payer, only the record of the served session proves it
+                previous = self.by_pk.get(pk)
+                if previous is not None and previous in self.sessions and proof != previous:
+                    self.logger.log_error(f'Ignored session {session_id} of {pk}, which is already served under '
+                                          f'another session')
+                    return
+                session = self.open_session(session_id)
+                self.sessions[session_id] = session
+
+        session.dispatch(offer, packets)
+        self.logger.log_inform(f'Established connection with {session.target_pk}, serving {len(self.sessions)} sessions')
+
+        # A submarine registering again with the record of its previous session replaces that session
+        with self.lock:
+            previous = self.by_pk.get(session.target_pk)
+            self.by_pk[session.target_pk] = session_id
+        if previous is not None and previous != session_id:
+            self.drop(previous)
+
+    def drop(self, session_id):
+        """
+        Close a session along with all of its tubes.
+        """
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                return
+            if self.by_pk.get(session.target_pk) == session_id:
+                del self.by_pk[session.target_pk]
+
+        self.logger.log_inform(f'Closing session {self.label(session)} of {session.target_pk}')
+        self.close_session(session)
+
+    def feedback_loop(self):
+        """
+        Periodically acknowledge the received packets of every session, and close the sessions that went idle.
+        """
+        while True:
+            time.sleep(self.ack_interval / 4)
+            now = time.time()
+            for session in self.values():
+                session.acknowledge()
+                if self.idle_timeout is not None and now - session.last_seen > self.idle_timeout:
+                    self.drop(session.session_id)
+
+    def get(self, session_id):
+        """
+        The session of a session record, None if it is not (or no longer) being served.
+        """
+        return self.sessions.get(session_id)
+
+    def values(self):
+        return list(self.sessions.values())
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import sys
+
+from helpers.aio_session import AioSession, AioProxy
+from helpers.logger import Logger, INFO
+from helpers.session import load_credentials
+from helpers.transport import tcp_transports
+from helpers.throttle import AioThrottle, RateController
+from helpers.coalescer import AioCoalescer
+from session import Session as SubmarineSession
+from submarine import connect_hostname
+
+
+class Session(AioSession, SubmarineSession):
+
+    def __init__(self, pk, cert, macaroon, port, close_socket_func, logger, local_nodes=None):
+        super().__init__(pk, cert, macaroon, port, close_socket_func, logger, local_nodes)
+        self.status_event = asyncio.Event()
+        self.receiver_tasks = []
+
+    async def register(self, target_pk):
+        """
+        Announce the submarine to the periscope node with its public key, and wait for acknowledgement.
+        The invoice subscriptions are started first, so the reply can not be missed.
+        @param target_pk: The public key of the periscope node, or a list of keys to stripe payments over
+        @return: Whether the handshake succeeded
+        """
+        self.set_targets(target_pk if isinstance(target_pk, (list, tuple)) else [target_pk])
+        self.receiver_tasks = self.start_receivers()
+
+        await self.send_batch(*self.session_request())
+        await self.status_event.wait()
+        return self.session_status == 'ACTIVE'
+
+    def set_session_status(self, value):
+        super().set_session_status(value)
+        self.status_event.set()
+
+
+class AioSubmarine(AioProxy):
+
+    def __init__(self, submarine_node, periscope_pk, throttle_interval=(1/20), throttle_dummy=True, max_in_flight=32,
+                 extra_nodes=(), linger=0.005, compression=('zlib', 'lzma'), fec=4,
+                 rate_controller=None, weights=None, metrics_port=None, metrics_file=None,
+                 log_level=INFO, log_file=None, local_nodes=None):
+        """
+        @param local_nodes: Transports to pay through instead of the LND nodes, see helpers.transport.
+        """
+        super().__init__(Logger('SUB', log_level, log_file))
+        self.linger = linger
+        self.fec = fec
+        self.compression = compression
+        self.node = submarine_node
+        self.extra_nodes = extra_nodes
+        self.local_nodes = local_nodes
+        self.periscope_pk = periscope_pk
+        self.throttle_interval = throttle_interval
+        self.throttle_dummy = throttle_dummy
+        self.max_in_flight = max_in_flight
+        self.rate_controller = rate_controller
+        self.weights = weights
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+
+    async def run(self):
+        """
+        Register at the periscope node and serve the local proxy.
+        """
+        node = self.node or {}
+        self.session = Session(node.get('pk'), node.get('cert'), node.get('mac'), node.get('port'), self.close_socket,
+                               self.logger, self.local_nodes)
+        self.session.codecs = self.compression
+        for extra in self.extra_nodes:
+            self.session.add_local_node(extra['pk'], extra['cert'], extra['mac'], extra['port'])
+
+        # Register at the periscope node, waiting until handshake completed
+        self.logger.log_inform(f'Registering for a connection at {self.periscope_pk}')
+        if not await self.session.register(self.periscope_pk):
+            sys.exit()
+        self.logger.log_inform(f'Established connection with {self.periscope_pk}')
+
+        # Start the throttle with the given parameters, fed by payments packed by the coalescer
+        self.t_queue = AioCoalescer(self.session, self.linger, fec_block=self.fec, host_weights=self.weights)
+        self.throttle = AioThrottle(self.throttle_interval, self.session.send_batch, self.t_queue, self.throttle_dummy,
+                                    self.t_queue.dummy, self.max_in_flight, self.rate_controller,
+                                    logger=self.logger)
+
+        # Expose the metrics on a local HTTP port and or as a periodically written snapshot file
+        self.session.instrument(self.t_queue, self.throttle)
+        self.session.export_metrics(self.metrics_port, self.metrics_file)
+
+        server = await asyncio.start_server(self.new_connection_setup, 'localhost', 8742, backlog=10)
+        self.logger.log_inform('Starting up on localhost:8742')
+
+        async with server:
+            await server.serve_forever()
+
+    async def new_connection_setup(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        A local connection came in, set up a tube once its CONNECT message has been read.
+        """
+        port = writer.get_extra_info('peername')[1]
+        self.logger.log_inform(f'New local socket established on port {port}')
+
+        try:
+            # Extract relevant details and set up tube, the announcement has to arrive before any data
+            conn = str(await reader.read(512))[2:-1]
+            hostname = connect_hostname(conn, port)
+            self.logger.log_inform(f'Establishing a tube to connect to {hostname}')
+            await self.session.create_tube(writer, port, hostname)
+
+        except Exception as e:
+            self.logger.log_error(f'Exception occurred during new connection setup: {e}')
+            writer.close()
+            return
+
+        self.attach(port, reader, writer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tunnel local traffic through a periscope over lightning payments, '
+                                                 'on a single asyncio event loop.')
+    parser.add_argument('--creds', default='../creds.txt', help='credentials of the nodes, see load_credentials')
+    parser.add_argument('--node', default='carol', help='name of the local node in the credentials')
+    parser.add_argument('--periscope', nargs='+', default=['alice'], help='names of the periscope nodes to stripe over')
+    parser.add_argument('--extra-nodes', nargs='*', default=[], help='names of additional local nodes to pay through')
+    parser.add_argument('--transport', default='lnd', choices=['lnd', 'tcp'],
+                        help='pay through lnd, or straight to the periscope over tcp on the ports of the credentials')
+    parser.add_argument('--metrics-port', type=int, default=None)
+    parser.add_argument('--log-level', default='info', choices=['debug', 'info', 'error'])
+    args = parser.parse_args()
+
+    # Multiple nodes can be used by listing them in extra_nodes, or by passing a list of periscope keys
+    nodes = load_credentials(args.creds)
+    target_pks = [nodes[name]['pk'] for name in args.periscope]
+
+    local_nodes = tcp_transports([args.node, *args.extra_nodes], nodes) if args.transport == 'tcp' else None
+    extra_nodes = [nodes[name] for name in args.extra_nodes] if local_nodes is None else ()
+
+    asyncio.run(AioSubmarine(nodes[args.node], target_pks, extra_nodes=extra_nodes, local_nodes=local_nodes,
+                             rate_controller=RateController(), metrics_port=args.metrics_port,
+                             log_level=args.log_level).run())
+
+
+if __name__ == '__main__':
+    main()
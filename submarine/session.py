@@ -1,52 +1,224 @@
+import json
+import os
+import secrets
 import time
-from threading import Thread
+from threading import Thread, Lock
 
 from helpers.session import Session as ParentSession
 from helpers.tube import Tube
+from helpers import packet as framing
 
 
 class Session(ParentSession):
 
-    def __init__(self, pk, cert, macaroon, port, close_socket_func, logger):
-        super().__init__(pk, cert, macaroon, port, close_socket_func, logger)
+    def __init__(self, pk, cert, macaroon, port, close_socket_func, logger, local_nodes=None, state_path=None):
+        """
+        @param state_path: File keeping the session identity and the open tubes, so a restart can resume the session.
+        """
+        super().__init__(pk, cert, macaroon, port, close_socket_func, logger, local_nodes)
         self.session_status = None
         self.logger = logger
 
+        # Identify our payments to the periscope, which may be serving other submarines as well
+        self.session_record = secrets.token_bytes(framing.SESSION_ID_SIZE)
+        # The record of the session persisted by a previous run, which the periscope lets this session replace
+        self.previous_record = None
+        self.record_size -= framing.SESSION_RECORD_SIZE
+
+        # Persisted session state, the time the last packet of the periscope arrived and the time the last tube opened
+        self.state_path = state_path
+        self.last_received = 0.0
+        self.last_opened = 0.0
+
+        # Tubes of a resumed session that are still open on the periscope, closed before any new tube is announced
+        self.stale_tubes = []
+        self.stale_lock = Lock()
 
-    def register(self, target_pk):
+
+    def register(self, target_pk, timeout=30.0, attempts=3, resume=True):
         """
         Announce the submarine to the periscope node with its public key, and wait for acknowledgement.
-        @param target_pk: The public key of the periscope node
-        @return: When the handshake has been completed
+        The invoice subscriptions are started first, so the reply can not be missed. Unanswered handshakes are repeated.
+        A session persisted for the same periscope is resumed instead, without waiting for a handshake at all.
+        @param target_pk: The public key of the periscope node, or a list of keys to stripe payments over
+        @param timeout: Seconds to wait for the reply to a handshake.
+        @param attempts: The amount of handshakes sent before giving up.
+        @param resume: Whether to resume a persisted session.
+        @return: Whether the handshake has been completed
+        """
+        targets = target_pk if isinstance(target_pk, (list, tuple)) else [target_pk]
+        self.set_targets(targets)
+        if not self.start_receivers():
+            self.logger.log_error('Not every invoice subscription started in time, the reply may be missed')
+
+        registered = (resume and self.resume(targets[0])) or self.handshake(timeout, attempts)
+        if registered and self.state_path is not None:
+            Thread(target=self.persist_loop, args=(timeout,), daemon=True).start()
+        return registered
+
+
+    def handshake(self, timeout=30.0, attempts=3):
+        """
+        Send the session request and wait for the reply of the periscope.
+        @return: Whether the periscope accepted the session.
+        """
+        for attempt in range(attempts):
+            self.handshake_done.clear()
+            self.send_batch(*self.session_request())
+            if self.handshake_done.wait(timeout):
+                return self.session_status == 'ACTIVE'
+            self.logger.log_error(f'No reply to handshake {attempt + 1} of {attempts} within {timeout}s')
+        return False
+
+
+    def resume(self, target_pk):
         """
-        self.target_pk = target_pk
-        self.send_session_message(data=f'0:{self.pk}')
-        receiver_thread = Thread(target=self.receiver)
-        receiver_thread.start()
+        Take up the session persisted by a previous run with the same periscope, which still knows its session record.
+        The tubes that were open are closed on the periscope, their local connections are gone.
+        @return: Whether a session was resumed.
+        """
+        state = self.load_state()
+        if state is None:
+            return False
+        if target_pk not in state['targets'] or state['version'] == framing.LEGACY_VERSION:
+            return False
+
+        # Should the periscope no longer know the session, the handshake replacing it names the record
+        self.previous_record = bytes.fromhex(state['session'])
+        self.session_record = bytes.fromhex(state['session'])
+        self.frame_version = state['version']
+        self.set_targets(state['targets'])
+        self.session_status = 'ACTIVE'
+        self.handshake_done.set()
+        self.logger.log_inform(f'Resumed session {state["session"]}, closing {len(state["tubes"])} stale tubes')
+
+        self.stale_tubes = [int(tube_idx) for tube_idx in state['tubes']]
+        if self.stale_tubes:
+            Thread(target=self.close_stale).start()
+        return True
+
+
+    def close_stale(self, segments=()):
+        """
+        Close the tubes left open by the previous run, in the same payment as the given segments.
+        Holds the lock while sending, so a tube reusing the index of a stale one is not announced before it is closed.
+        @return: The result of sending, None when there was nothing to send.
+        """
+        with self.stale_lock:
+            segments = [(0, 0, f'2:{tube_idx}'.encode(), 0) for tube_idx in self.stale_tubes] + list(segments)
+            self.stale_tubes = []
+            return self.send_batch(segments) if segments else None
+
+
+    def state(self):
+        """
+        The state persisted for a resume: the session identity and the open tubes, which a resume closes.
+        Their local connections do not survive a restart, so their counters are of no use and are not kept.
+        """
+        return {'session': self.session_record.hex(), 'version': self.frame_version, 'targets': self.target_pks,
+                'tubes': list(self.tubes)}
+
 
-        # Wait for acknowledgement of session before continuing
+    def load_state(self):
+        """
+        @return: The persisted state, None when there is none or it could not be read.
+        """
+        if self.state_path is None:
+            return None
+        try:
+            with open(self.state_path) as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            if os.path.exists(self.state_path):
+                self.logger.log_error(f'Could not read the session state: {e}')
+            return None
+
+
+    def save_state(self, state: dict):
+        """
+        Write the state, replacing the previous one at once so a crash never leaves a partial file.
+        """
+        temporary = f'{self.state_path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(state, file)
+        os.replace(temporary, self.state_path)
+
+
+    def persist_loop(self, timeout=30.0, interval=1.0):
+        """
+        Keep the persisted state up to date, and register again when the periscope stops answering.
+        The periscope answers every new tube, a tube left unanswered for the timeout means it no longer knows the session,
+        as happens when a resumed session was dropped in the meantime. The tubes opened before registering again are
+        unknown to the new session, they are closed.
+        """
+        saved = None
         while True:
-            if self.session_status == 'DENIED':
-                return False
-            elif self.session_status == 'ACTIVE':
-                return True
-            else:
-                time.sleep(0.1)
+            time.sleep(interval)
+
+            state = self.state()
+            if self.state_path is not None and state != saved:
+                try:
+                    self.save_state(state)
+                    saved = state
+                except OSError as e:
+                    self.logger.log_error(f'Could not save the session state: {e}')
+
+            if self.last_opened > self.last_received and time.time() - self.last_opened > timeout:
+                self.logger.log_error('The periscope does not answer the session, registering again')
+                self.last_opened = 0.0
+                orphaned = list(self.tubes)
+                self.handshake(timeout)
+                for tube_idx in orphaned:
+                    if tube_idx in self.tubes:
+                        self.remote_socket_close(tube_idx)
 
 
-    def create_tube(self, connection, port, hostname):
+    def receive_packets(self, packets):
+        self.last_received = time.time()
+        return super().receive_packets(packets)
+
+
+    def session_request(self):
+        """
+        The handshake: the session message announcing our primary node, as legacy periscopes expect it, and the offer of
+        our other nodes and the frame versions we understand in a record of its own, see framing.HANDSHAKE_RECORD.
+        The record of a previous session is added when known, proving that the periscope may replace that session.
+        @return: The segments and the custom records of the payment, see send_batch.
+        """
+        pks = ','.join(node.pk for node in self.local_nodes)
+        versions = ','.join(str(v) for v in framing.SUPPORTED_VERSIONS)
+        offer = f'{pks}:{versions}'
+        if self.previous_record is not None and self.previous_record != self.session_record:
+            offer += f':{self.previous_record.hex()}'
+        return [(0, 0, f'0:{self.local_nodes[0].pk}'.encode(), 0)], {framing.HANDSHAKE_RECORD: offer.encode()}
+
+
+    def create_tube(self, connection, port, hostname, remote_port=None):
         """
         Creates a Tube object for packet management, and announce to the Periscope node that a new connection is desired.
         @param connection: The socket connection related to this Tube.
         @param port: The port, which is also the identifier of the Tube.
         @param hostname: The hostname related to the connection.
+        @param remote_port: The port to connect to for a plain HTTP tube, None for a tunnel to port 443.
+        @return: The result of sending the announcement.
         """
-        tube = Tube(port, self.local_socket_close, connection)
+        tube = Tube(port, self.local_socket_close, connection, hostname)
         self.tubes[port] = tube
-        self.send_session_message(data=f'1:{port}:{hostname}')
-        self.logger.log_inform(f'Created tube for {hostname}')
+        self.last_opened = time.time()
+        announcement = f'1:{port}:{hostname}' if remote_port is None else f'1:{port}:{hostname}:{remote_port}'
+
+        # Offer compression in the same payment, peers that understand frames also understand the offer
+        # Stale tubes of a resumed session travel along, the periscope closes them first
+        if self.codecs and self.frame_version != framing.LEGACY_VERSION:
+            offer = f'3:{port}:{",".join(self.codecs)}'
+            result = self.close_stale([(0, 0, announcement.encode(), 0), (0, 0, offer.encode(), 0)])
+        elif self.stale_tubes:
+            result = self.close_stale([(0, 0, announcement.encode(), 0)])
+        else:
+            result = self.send_session_message(data=announcement)
 
-        #Thread(target=tube.pipe_packets_to_socket, args=(0,)).start()
+        self.logger.log_inform(f'Created tube for {hostname}')
+        return result
 
 
     def receive_session_message(self, message):
@@ -68,6 +240,12 @@ class Session(ParentSession):
 
             # Socket close message
             2: lambda c: self.remote_socket_close(c),
+
+            # Compression answer message
+            4: lambda c: self.receive_compression_answer(c),
+
+            # Acknowledgement of received packets, possibly requesting missing ones
+            5: lambda c: self.receive_feedback(c),
         }
 
         switcher.get(m_type, lambda _: print('Invalid message type'))(m_content)
@@ -76,6 +254,14 @@ class Session(ParentSession):
     def set_session_status(self, value):
         """
         Helper function related to the handshake
-        @param value: The response of the Periscope related to the handshake
+        @param value: The response of the Periscope related to the handshake, optionally followed by the chosen frame version and its nodes
         """
-        self.session_status = value
+        status, _, rest = value.partition(':')
+        version, _, pks = rest.partition(':')
+        self.frame_version = framing.negotiate_version(version)
+
+        # Stripe over every node the Periscope announced as well
+        if pks:
+            self.set_targets(self.target_pks + [pk for pk in pks.split(',') if pk not in self.target_pks])
+        self.session_status = status
+        self.handshake_done.set()
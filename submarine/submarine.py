@@ -1,59 +1,152 @@
-import csv
-import select
+import argparse
+import selectors
 import socket
 import sys
-import queue
 import time
+from collections import deque
 from threading import Thread
-from helpers.throttle import Throttle
-from helpers.logger import Logger
+from helpers.throttle import Throttle, RateController
+from helpers.coalescer import Coalescer
+from helpers.logger import Logger, INFO
+from helpers.socket_map import SocketMap, INCOMING
+from helpers.http_cache import HttpCache, Exchange, Request, HeadReader
+from helpers.routes import RouteManager
+from helpers.rules import RuleSet, CostBudget
+from helpers.session import load_credentials
+from helpers.transport import tcp_transports
 from session import Session
 
-LIMIT_LIST = ['mozilla', 'telemetry', 'staticcdn.duckduckgo', 'brxt.mendeley.com', 'profile.accounts.firefox.com',
-              'api.accounts.firefox.com', 'easylist-downloads.adblockplus.org']
+# Amount of bytes read from a socket at once, the coalescer cuts them into payments
+RECV_SIZE = 16384
+
+# Hosts that are never tunneled as they could become expensive, extended by the rule files given to the Submarine
+DEFAULT_RULES = ['*mozilla*', '*telemetry*', '*staticcdn.duckduckgo*', '||brxt.mendeley.com^',
+                 '||profile.accounts.firefox.com^', '||api.accounts.firefox.com^', '||easylist-downloads.adblockplus.org^']
+RULES = RuleSet(DEFAULT_RULES)
 
 
 class Submarine:
 
-    def __init__(self, submarine_node, periscope_pk, throttle_interval=(1/20), throttle_dummy=True):
+    def __init__(self, submarine_node, periscope_pk, throttle_interval=(1/20), throttle_dummy=True, extra_nodes=(),
+                 linger=0.005, compression=('zlib', 'lzma'), fec=4, rate_controller=None,
+                 weights=None, metrics_port=None, metrics_file=None, log_level=INFO, log_file=None, plain_http=False,
+                 cache_dir=None, cache_size=64 * 2 ** 20, state_path=None, launched=None, route_cache=True,
+                 rule_files=(), host_budget=None, period_budget=None, tube_budget=None, budget_period=3600.0,
+                 over_budget='refuse', local_nodes=None, listen_port=8742):
+        """
+        @param submarine_node: Credentials of the LND node to pay through, see load_credentials.
+        @param plain_http: Also act as a plain HTTP forward proxy, next to tunneling CONNECT requests.
+        @param cache_dir: Directory keeping the cacheable responses to plain HTTP requests, None to not cache them.
+        @param cache_size: The maximum size of the cached responses in bytes.
+        @param state_path: File persisting the session, a restart with the same periscope resumes it without a handshake.
+        @param launched: time.monotonic() at launch of the process, the startup is timed from there.
+        @param route_cache: Pay the periscope over routes queried once and cached, instead of a route search per payment.
+        @param rule_files: Block lists in adblock, hosts file or plain domain format, next to the default rules.
+        @param host_budget: Sats that may be spent per host and budget_period, None for no limit.
+        @param period_budget: Sats that may be spent on all hosts per budget_period, None for no limit.
+        @param tube_budget: Sats a single tube may spend before its share of the payments is lowered, None for no limit.
+        @param budget_period: Seconds after which the spending of the hosts is counted from zero again.
+        @param over_budget: 'refuse' or 'throttle' new tubes to a host once a budget has been spent.
+        @param local_nodes: Transports to pay through instead of the LND nodes, see helpers.transport.
+        @param listen_port: The local port clients connect to.
+        """
+        # Seconds from launch to every step of the startup, up to the first byte delivered to a local client
+        self.launched = launched if launched is not None else time.monotonic()
+        self.startup = {}
 
-        self.logger = Logger('SUB')
+        # Per-packet messages are only logged at the DEBUG level, log_file receives the records as JSON lines
+        self.logger = Logger('SUB', log_level, log_file)
 
         # Set up session object
         # This will manage the socket channels as well as operational communication
-        self.session = Session(submarine_node['pk'], submarine_node['cert'], submarine_node['mac'],
-                               submarine_node['port'], self.close_socket,
-                               self.logger)
-
-        # Register at the periscope node, blocking until handshake completed
-        self.logger.log_inform(f'Registering for a connection at {periscope_pk}')
-        registered = self.session.register(periscope_pk)
-
-        if not registered:
-            sys.exit()
-        self.logger.log_inform(f'Established connection with {periscope_pk}')
+        node = submarine_node or {}
+        self.session = Session(node.get('pk'), node.get('cert'), node.get('mac'), node.get('port'), self.close_socket,
+                               self.logger, local_nodes=local_nodes, state_path=state_path)
+        self.session.metrics.gauge('startup_seconds', 'Seconds from launch to every step of the startup', ('step',),
+                                   function=lambda: {(step,): seconds for step, seconds in self.startup.items()})
+
+        # Every payment goes to the same periscope, so its routes are looked up once and reused
+        if route_cache:
+            self.session.routes = RouteManager(self.logger, self.session.metrics)
+
+        # Hosts that may not be tunneled, and the sats spent on the hosts that are
+        self.rules = RuleSet(DEFAULT_RULES)
+        for path in rule_files:
+            self.rules.load(path)
+        self.logger.log_inform(f'Loaded {len(self.rules)} domain rules, skipped {self.rules.skipped} other rules')
+        self.session.metrics.gauge('domain_rules', 'Rules deciding which hosts may be tunneled',
+                                   function=lambda: len(self.rules))
+        self.budget = CostBudget(self.session.metrics, host_budget, period_budget, tube_budget, budget_period,
+                                 over_budget)
+        self.session.budget = self.budget
+
+        # Codecs to offer for every tube, an empty tuple disables compression
+        self.session.codecs = compression
+
+        # Additional local nodes, payments are striped over all of them
+        for extra in extra_nodes:
+            self.session.add_local_node(extra['pk'], extra['cert'], extra['mac'], extra['port'])
+
+        # Connect the channels of every node at once, rather than on their first call
+        self.session.warm_up()
+        self.milestone('channels')
 
         # Create a TCP/IP socket
         self.server: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setblocking(False)
+        # A restart binds again right away, rather than waiting for the connections of the previous run to time out
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         # Bind the socket to the local port
-        server_address = ('localhost', 8742)
+        server_address = ('localhost', listen_port)
         self.server.bind(server_address)
         self.logger.log_inform(f'Starting up on {server_address[0]}:{server_address[1]}')
 
         # Listen for incoming connections, buffer of ten
+        # Listening starts before registering, clients connecting in the meantime wait in the buffer
         self.server.listen(10)
+        self.milestone('listening')
 
-        self.inputs = [self.server]
-        self.outputs = []
-
-        # Dictionary object to keep track of which sockets belong to which tube
-        self.socket_tube_dict = {}
+        # Register at the periscope node, blocking until handshake completed or a persisted session has been resumed
+        self.logger.log_inform(f'Registering for a connection at {periscope_pk}')
+        registered = self.session.register(periscope_pk)
 
-        # Start the throttle with the given parameters if desired
-        self.t_queue = queue.Queue()
-        Throttle(throttle_interval, self.session.send, self.t_queue, throttle_dummy, (b'0', -1, -1))
+        if not registered:
+            sys.exit()
+        self.logger.log_inform(f'Established connection with {periscope_pk}')
+        self.milestone('registered')
+
+        # Sockets to watch, indexed both ways between sockets and tubes
+        # The receiving threads wake up the loop as soon as a tube has data to be written to its socket
+        self.sockets = SocketMap()
+        self.sockets.register_server(self.server)
+        self.session.deliverable_func = self.sockets.notify
+
+        # Start the throttle with the given parameters if desired, fed by payments packed by the coalescer
+        # Dummy payments carry parity of the sent packets when fec is set, the amount of packets covered by each
+        # Bulk tubes share the payments by the weights of their hosts, given as a dict of hostname suffix to weight
+        self.t_queue = Coalescer(self.session, linger, fec_block=fec, host_weights=weights)
+        # With a rate controller the pace follows the measured payment completions, dummies keep to throttle_interval
+        self.throttle = Throttle(throttle_interval, self.session.send_batch, self.t_queue, throttle_dummy,
+                                 self.t_queue.dummy, controller=rate_controller, logger=self.logger)
+        # A tube that spent its own budget keeps going with a smaller share of the payments
+        self.budget.throttle_func = lambda tube_idx: self.t_queue.set_weight(tube_idx, self.budget.throttle_weight)
+
+        # Plain HTTP responses are followed on their way to the client, cache hits do not cost a single payment
+        self.plain_http = plain_http
+        self.cache = None
+        if plain_http and cache_dir is not None:
+            self.cache = HttpCache(cache_dir, cache_size, self.session.metrics, self.payment_cost,
+                                   lambda: self.session.chunk_size)
+        self.exchanges = {}
+        # Stored responses being written to the connections of cache hits, which have no tube
+        self.cached = {}
+        # Accepted connections whose request is still arriving, to the reader collecting it
+        self.incoming = {}
+
+        # Expose the metrics on a local HTTP port and or as a periodically written snapshot file
+        self.session.instrument(self.t_queue, self.throttle)
+        self.session.export_metrics(metrics_port, metrics_file)
 
         self.server_loop()
 
@@ -61,40 +154,31 @@ class Submarine:
         """
         The server loop of the Submarine, accepts new incoming connections from the client and redirects packets from existing connections to the right tube
         """
-        while self.inputs:
+        while True:
 
-            try:
-                # Wait for at least one of the sockets to be ready for processing
-                readable, writable, exceptional = select.select(self.inputs, self.outputs, self.inputs, 1)
-            except ValueError as v:
-                # Purge closed sockets from the inputs
-                self.inputs = [s for s in self.inputs if s.fileno() != -1]
-                self.outputs = [s for s in self.outputs if s.fileno() != -1]
-                continue
+            # Stop reading from the local connections while the throttle is saturated, new connections are still accepted
+            self.sockets.set_reading(not self.throttle.congested())
 
-            # Handle inputs
-            for s in readable:
+            # Wait for at least one of the sockets to be ready for processing
+            for s, tube_idx, events in self.sockets.select(1 if self.sockets.reading else 0.05):
 
                 # The server socket is readable, indicating incoming connection
                 if s is self.server:
 
                     # Handle the new connection attempt
                     self.new_connection_setup(s)
+                    continue
 
-                # Existing socket receiving data
-                else:
-
-                    # Port number is used as unique tube identifier
-                    try:
-                        tube_idx = s.getpeername()[1]
-
-                    except OSError as o:
-                        self.logger.log_error(f'fatal error for: {s}, {o}')
-                        continue
+                # A new connection sent (part of) its request
+                if tube_idx is INCOMING:
+                    self.read_request(s)
+                    continue
 
+                # Existing socket receiving data
+                if events & selectors.EVENT_READ:
                     try:
-                        # Receive buffers in chunks that are transmittable
-                        data = s.recv(729)
+                        # Receive buffers, the coalescer cuts them into transmittable chunks
+                        data = s.recv(RECV_SIZE)
 
                     except (ConnectionResetError, ConnectionAbortedError, OSError) as e:
                         self.logger.log_error(
@@ -105,8 +189,7 @@ class Submarine:
                         continue
 
                     # Send data through the tunnel
-                    assigned_index = self.session.tubes[tube_idx].assign_index()
-                    self.t_queue.put((data, assigned_index, tube_idx))
+                    self.t_queue.write(tube_idx, data)
 
                     if not data:
                         self.logger.log_inform(
@@ -114,36 +197,50 @@ class Submarine:
 
                         # Discard the socket locally and inform the periscope node
                         self.close_socket(tube_idx)
+                        continue
 
-            for s in writable:
-                # Get the packet if it's there
-                try:
-                    tube_idx = s.getpeername()[1]
-                except OSError as o:
-                    if s in self.outputs:
-                        self.outputs.remove(s)
-                    if s in self.inputs:
-                        self.inputs.remove(s)
-                    continue
-
-                data = self.session.get_packet(tube_idx)
-                if data:
+                # Write the packets that are in order, only watched for while there are any
+                if events & selectors.EVENT_WRITE and tube_idx in self.sockets:
+                    take = lambda: self.session.get_packet(tube_idx)
+
+                    # Plain HTTP responses pass the exchange, which stores them or replays a revalidated one
+                    exchange = self.exchanges.get(tube_idx)
+                    if exchange is not None:
+                        tube = self.session.tubes.get(tube_idx)
+                        take = lambda: exchange.feed(self.session.get_packet(tube_idx),
+                                                     tube is not None and tube.ended)
+
+                    # Cache hits are written from the stored response, there is no tube or peer to inform
+                    cached = self.cached.get(tube_idx)
+                    if cached is not None:
+                        take = lambda: cached.popleft() if cached else None
                     try:
-                        s.sendall(data)
+                        written = self.sockets.deliver(tube_idx, take)
                     except (ConnectionResetError, ConnectionAbortedError, OSError) as e:
+                        if cached is not None:
+                            self.logger.log_error(f'Could not serve a cached response on port {tube_idx}: {e}')
+                            self.close_socket(tube_idx)
+                            continue
                         self.logger.log_error(
                             f'Exception occurred on tube {tube_idx}, will close down socket and inform peer: {e}')
 
                         # Discard the socket locally and inform peer
                         Thread(target=self.session.local_socket_close, args=(tube_idx,)).start()
                         continue
-                    self.logger.log_inform(f'Sending {sys.getsizeof(data)} to socket')
 
-            for s in exceptional:
-                self.inputs.remove(s)
-                if s in self.outputs:
-                    self.outputs.remove(s)
-                s.close()
+                    # The connection of a cache hit is closed once the whole response has been written
+                    if cached is not None and not cached and tube_idx not in self.sockets.writing:
+                        self.close_socket(tube_idx)
+                    if self.logger.debug:
+                        self.logger.log_debug(f'Sending {written} to socket', 'socket')
+                    if written and 'first_byte' not in self.startup:
+                        self.milestone('first_byte')
+
+            # Clients that did not finish their request in time are served with what they sent
+            if self.incoming:
+                now = time.monotonic()
+                for connection in [c for c, reader in self.incoming.items() if reader.expired(now)]:
+                    self.setup_connection(connection)
 
     def new_connection_setup(self, new_socket):
         """
@@ -155,74 +252,247 @@ class Submarine:
         self.logger.log_inform(f'New local socket established on port {client_address[1]}')
 
         connection.setblocking(0)
-        self.inputs.append(connection)
-        self.outputs.append(connection)
+
+        # The request is read as it arrives, the loop keeps serving the other tubes in the meantime
+        self.incoming[connection] = HeadReader()
+        self.sockets.add_incoming(connection)
+
+    def read_request(self, connection):
+        """
+        Read what a new connection sent of its request, and set up its tube once the request is complete.
+        @param connection: The readable connection.
+        """
+        try:
+            complete = self.incoming[connection].read(connection)
+        except OSError as e:
+            self.logger.log_error(f'Could not read the request of a new connection: {e}')
+            self.incoming.pop(connection)
+            self.sockets.remove_incoming(connection)
+            connection.close()
+            return
+
+        if complete:
+            self.setup_connection(connection)
+
+    def setup_connection(self, connection):
+        """
+        The request of a new connection has been read, set up a tube.
+        @param connection: The connection
+        """
+        data = bytes(self.incoming.pop(connection).data)
+        self.sockets.remove_incoming(connection)
 
         try:
+            # Plain HTTP requests are answered from the cache where possible, otherwise forwarded through a tube
+            if self.plain_http:
+                request = Request.parse(data)
+                if request is not None and request.method != 'CONNECT':
+                    self.plain_request(connection, request)
+                    return
+            hostname, port = self.new_connection_details(connection, data)
+
             # Extract relevant details and set up tube
-            hostname, port = self.new_connection_details(connection)
+            throttled = self.admit(hostname, port)
             self.session.create_tube(connection, port, hostname)
-            self.socket_tube_dict[connection] = port
+            if throttled:
+                self.t_queue.set_weight(port, self.budget.throttle_weight)
+            self.sockets.add(port, connection)
+
+            # The Periscope may have replied before the socket was added
+            self.sockets.notify(port)
 
         except Exception as e:
             self.logger.log_error(f'Exception occurred during new connection setup: {e}')
-            # self.inputs.remove(connection)
-            connection.shutdown(1)
+            try:
+                connection.shutdown(1)
+            except OSError:
+                pass
             connection.close()
 
+    def plain_request(self, connection, request: Request):
+        """
+        Serve a plain HTTP request, from the cache when a fresh response is stored, or through a tube to its host.
+        Stale responses with a validator are revalidated, the host only sends the response again when it changed.
+        Connections carry a single request, the host is asked to close the connection after its response.
+        @param connection: The local connection the request arrived on.
+        @param request: The parsed request.
+        """
+        port = connection.getpeername()[1]
+        rule = self.rules.match(request.hostname)
+        if rule is not None:
+            raise Exception(f'Connection to {request.hostname} for tube {port} blocked by {rule} to limit traffic')
+
+        entry = None
+        if self.cache is not None:
+            if not request.cacheable():
+                self.cache.requests.inc(result='bypass')
+                # Requests changing the resource make the stored response outdated
+                if request.method not in ('GET', 'HEAD'):
+                    self.cache.remove(request.url)
+            else:
+                entry = self.cache.lookup(request)
+                if entry is not None and entry.fresh(request=request):
+                    stored = self.cache.read(entry)
+                    if stored is not None:
+                        self.serve_cached(connection, port, request, stored)
+                        return
+                    entry = None
+                if entry is None:
+                    self.cache.requests.inc(result='miss')
+
+        # Cached responses are served whatever the budget, they do not cost anything
+        throttled = self.admit(request.hostname, port)
+        if self.cache is not None:
+            self.exchanges[port] = Exchange(self.cache, request, entry)
+
+        self.logger.log_inform(f'Forwarding {request.method} {request.url} through tube {port}')
+        self.session.create_tube(connection, port, request.hostname, request.port)
+        if throttled:
+            self.t_queue.set_weight(port, self.budget.throttle_weight)
+        self.t_queue.write(port, request.forward(entry.validators() if entry is not None else None))
+        self.sockets.add(port, connection)
+        self.sockets.notify(port)
+
+    def serve_cached(self, connection, port, request: Request, response: bytes):
+        """
+        Write a stored response to the client, no payment is made at all.
+        The server loop writes it like the data of a tube and closes the connection once it has been written.
+        @param connection: The local connection the request arrived on.
+        @param port: The port of the connection, which identifies it in the socket map.
+        @param request: The parsed request.
+        @param response: The stored response.
+        """
+        self.cache.served('hit', len(response))
+        self.logger.log_inform(f'Serving {request.url} from the cache on port {port}')
+
+        # The connection carries a single request, whatever the client sends after it is not read
+        self.cached[port] = deque([response])
+        self.sockets.set_paused(port, True)
+        self.sockets.add(port, connection)
+        self.sockets.set_writing(port, True)
+
+    def admit(self, hostname: str, port):
+        """
+        Check the budgets before a tube to a host is opened.
+        @return: Whether the tube is to be throttled.
+        """
+        action, reason = self.budget.check(hostname)
+        if action == 'refuse':
+            raise Exception(f'Connection to {hostname} for tube {port} refused, the {reason} budget has been spent')
+        if action == 'throttle':
+            self.logger.log_inform(f'Throttling tube {port} to {hostname}, the {reason} budget has been spent')
+        return action == 'throttle'
+
+    def payment_cost(self):
+        """
+        The average amount and fee of a successful payment in sat.
+        """
+        return self.session.total_cost / max(self.session.payments.value(outcome='succeeded'), 1)
+
+    def milestone(self, step: str):
+        """
+        Record and log the time from launch to a step of the startup.
+        """
+        self.startup[step] = time.monotonic() - self.launched
+        self.logger.log_inform(f'Startup: {step} after {self.startup[step]:.3f}s')
+
     def close_socket(self, tube_idx):
         """
         Cleanup for the closing tube.
         @param tube_idx: tube identifier.
         """
-        if tube_idx in self.socket_tube_dict.values():
-            for s, idx in self.socket_tube_dict.items():
-                if idx == tube_idx:
-                    s.shutdown(1)
-                    s.close()
-                    self.inputs.remove(s)
-                    self.outputs.remove(s)
-                    del self.socket_tube_dict[s]
-                    del s
-                    self.logger.log_inform(f'Successfully closed socket on port {tube_idx}')
-                    return
-        else:
+        self.exchanges.pop(int(tube_idx), None)
+        self.cached.pop(int(tube_idx), None)
+        self.budget.forget(int(tube_idx))
+        s = self.sockets.remove(int(tube_idx))
+        if s is None:
             raise Exception(f'The socket {tube_idx} has already been removed')
 
-    def new_connection_details(self, connection):
+        try:
+            s.shutdown(1)
+        except OSError:
+            pass
+        s.close()
+        self.logger.log_inform(f'Successfully closed socket on port {tube_idx}')
+
+    def new_connection_details(self, connection, data: bytes):
         """
         Extract the relevant details out of the expected CONNECT message
-        @param connection: The connection that will send an CONNECT
+        @param connection: The connection that sent the CONNECT
+        @param data: The message read from the connection.
         @return: The hostname and the port.
         """
         port = connection.getpeername()[1]
 
         # Create a new socket with the port number as identifier
-        conn = str(connection.recv(512))[2:-1]
+        conn = str(data)[2:-1]
 
-        if conn is None or 'CONNECT ' not in conn:
-            raise Exception(f'No CONNECT message received, not eligible for proxy: {conn}')
-
-        hostname = conn.split(':', 1)[0].replace('CONNECT ', '')
+        hostname = connect_hostname(conn, port, self.rules)
         self.logger.log_inform(f'Establishing a tube to connect to {hostname}')
 
-        # Check if this connection could become expensive
-        if any(map(hostname.__contains__, LIMIT_LIST)):
-            raise Exception(f'Connection to {hostname} for tube {port} blocked to limit traffic')
-
         return hostname, port
 
 
-# Preload information of the involved nodes
-nodes = {}
-with open('../creds.txt') as credentials:
-    csv_reader = csv.reader(credentials, delimiter=',')
-    line_count = 0
-    for row in csv_reader:
-        nodes[row[0]] = {'cert': row[1], 'mac': row[2], 'pk': row[3], 'port': row[4]}
-
-# Select the current node and extract the pk of the periscope node
-node = nodes['carol']
-target_pk = nodes['alice']['pk']
-
-sub = Submarine(node, target_pk)
+def connect_hostname(conn: str, port, rules: RuleSet = RULES):
+    """
+    Extract the hostname out of a CONNECT message, and check whether it may be tunneled.
+    @param conn: The CONNECT message.
+    @param port: The port of the local connection, which identifies the tube.
+    @param rules: The rules blocking hosts, the default rules when not given.
+    @return: The hostname.
+    """
+    if conn is None or 'CONNECT ' not in conn:
+        raise Exception(f'No CONNECT message received, not eligible for proxy: {conn}')
+
+    hostname = conn.split(':', 1)[0].replace('CONNECT ', '')
+
+    # Check if this connection could become expensive
+    rule = rules.match(hostname)
+    if rule is not None:
+        raise Exception(f'Connection to {hostname} for tube {port} blocked by {rule} to limit traffic')
+
+    return hostname
+
+
+def main():
+    launched = time.monotonic()
+    parser = argparse.ArgumentParser(description='Tunnel local traffic through a periscope over lightning payments.')
+    parser.add_argument('--creds', default='../creds.txt', help='credentials of the nodes, see load_credentials')
+    parser.add_argument('--node', default='carol', help='name of the local node in the credentials')
+    parser.add_argument('--periscope', nargs='+', default=['alice'], help='names of the periscope nodes to stripe over')
+    parser.add_argument('--extra-nodes', nargs='*', default=[], help='names of additional local nodes to pay through')
+    parser.add_argument('--state', default=None, help='session file to keep the session in and resume it from')
+    parser.add_argument('--plain-http', action='store_true', help='also proxy plain HTTP requests')
+    parser.add_argument('--cache-dir', default='cache', help='cache the responses to plain HTTP requests here')
+    parser.add_argument('--no-cache', action='store_true', help='forward every plain HTTP request to its host')
+    parser.add_argument('--transport', default='lnd', choices=['lnd', 'tcp'],
+                        help='pay through lnd, or straight to the periscope over tcp on the ports of the credentials')
+    parser.add_argument('--no-route-cache', action='store_true', help='let lnd find the route of every payment')
+    parser.add_argument('--rules', nargs='*', default=[], help='block lists, such as EasyList or hosts files')
+    parser.add_argument('--host-budget', type=int, default=None, help='sats per host and budget period')
+    parser.add_argument('--period-budget', type=int, default=None, help='sats on all hosts per budget period')
+    parser.add_argument('--tube-budget', type=int, default=None, help='sats per tube before it is throttled')
+    parser.add_argument('--budget-period', type=float, default=3600.0, help='seconds of a budget period')
+    parser.add_argument('--over-budget', default='refuse', choices=['refuse', 'throttle'])
+    parser.add_argument('--port', type=int, default=8742, help='the local port clients connect to')
+    parser.add_argument('--metrics-port', type=int, default=None)
+    parser.add_argument('--log-level', default='info', choices=['debug', 'info', 'error'])
+    args = parser.parse_args()
+
+    # Multiple nodes can be used by listing them in extra_nodes, or by passing a list of periscope keys
+    nodes = load_credentials(args.creds)
+    target_pks = [nodes[name]['pk'] for name in args.periscope]
+
+    local_nodes = tcp_transports([args.node, *args.extra_nodes], nodes) if args.transport == 'tcp' else None
+    extra_nodes = [nodes[name] for name in args.extra_nodes] if local_nodes is None else ()
+
+    Submarine(nodes[args.node], target_pks, extra_nodes=extra_nodes, local_nodes=local_nodes,
+              rate_controller=RateController(), metrics_port=args.metrics_port, log_level=args.log_level,
+              plain_http=args.plain_http, cache_dir=None if args.no_cache else args.cache_dir, state_path=args.state or None, launched=launched,
+              route_cache=not args.no_route_cache, rule_files=args.rules, host_budget=args.host_budget,
+              period_budget=args.period_budget, tube_budget=args.tube_budget, budget_period=args.budget_period,
+              over_budget=args.over_budget, listen_port=args.port)
+
+
+if __name__ == '__main__':
+    main()